@@ -1,22 +1,28 @@
 import os
 import spacy
-from haystack.nodes import DensePassageRetriever
-from haystack.nodes import FARMReader
-from transformers import pipeline, DistilBertForSequenceClassification, AutoTokenizer
-from app.models import Evidence, EvidenceWrapper, Sentence
-from app.ESOTERIC.tools.document_retrieval import title_match_search, score_docs, text_match_search, extract_questions, extract_answers, extract_questions, extract_polar_questions
-from app.ESOTERIC.tools.NER import extract_entities
-from app.ESOTERIC.tools.docstore_conversion import listdict_to_docstore, wrapper_to_docstore
+from app.models import Evidence, EvidenceWrapper, Sentence, evidence_to_dicts
+from app.ESOTERIC.tools.document_retrieval import title_and_text_match_search, title_match_search, knn_search, fetch_embeddings, score_docs, PhraseVectors, extract_answers, answer_extraction_prompt, generate_questions, merge_retrieved_docs
+from app.ESOTERIC.tools.NER import extract_entities, entity_extraction_prompt
+from app.ESOTERIC.tools.generation import CachedGenerationPipe
+from app.ESOTERIC.tools.docstore_conversion import listdict_to_docstore, wrapper_to_documents
+from app.ESOTERIC.tools.embedding_cache import EmbeddingCache
+from app.ESOTERIC.tools.model_cache import load_pipeline, load_sentence_transformer, load_dpr, load_farm_reader
+from app.ESOTERIC.tools.sentence_index import SentenceIndex, split_sentences, normalize_rows
+from app.ESOTERIC.tools.bm25_index import BM25SentenceIndex
+from app.ESOTERIC.tools.stage_executor import Stage, StageExecutor
+from app.ESOTERIC.tools.reader import read_answers
 from elasticsearch import Elasticsearch
 from dotenv import load_dotenv
-from tqdm import tqdm
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import util
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import numpy as np
 import random
+import time
 
-from app import progress_store
+from app import progress_store, metrics, metrics_in_progress
 
-def log_progress(task_id, log, step):
+def log_progress(task_id, log, step=None):
     def generate_color():
         return "#" + ''.join([random.choice('0123456789ABCDEF') for i in range(6)])
     if task_id:
@@ -29,39 +35,55 @@ def log_progress(task_id, log, step):
             }
             
         progress_store[task_id]["status"] = "in progress"
-        progress_store[task_id]["log"].append(log)
-        progress_store[task_id]["step"] = step
+        progress_store.append_log(task_id, log)
+        if step:
+            progress_store[task_id]["step"] = step
 
         if step == "start":
             progress_store[task_id]["claim"] = log
-        elif step == "entities_extracted":
-            progress_store[task_id]["entities"] = log
-            # Create color for each entity in a dictionary
-            progress_store[task_id]["entity_colors"] = {}
-            for entity in log:
-                progress_store[task_id]["entity_colors"][entity] = generate_color()
-        elif step == "extract_answers":
-            progress_store[task_id]["answers"] = log
-            # If answers not in entities, add them
-            for answer in log:
-                entities = progress_store[task_id]["entities"]
-                if answer['focal'] not in entities:
-                    progress_store[task_id]["entities"].append(answer['focal'])
-                    progress_store[task_id]["entity_colors"][answer['focal']] = generate_color()
+            progress_store.publish(task_id, "claim", {"claim": log})
+        elif step in ("entities_extracted", "extract_answers"):
+            # Claim entities and answers are logged from stages that may run in either order, so both merge into the same entities
+            # Copied into the task's own list, the entities passed in are still being searched with
+            if step == "extract_answers":
+                progress_store[task_id]["answers"] = log
+            new_entities = log if step == "entities_extracted" else [answer['focal'] for answer in log]
+            with progress_store.lock:
+                entities = progress_store[task_id].setdefault("entities", [])
+                entity_colors = progress_store[task_id].setdefault("entity_colors", {})
+                for entity in new_entities:
+                    if entity not in entities:
+                        entities.append(entity)
+                    # Create color for each entity in a dictionary
+                    if entity not in entity_colors:
+                        entity_colors[entity] = generate_color()
+                data = {"entities": list(entities), "entity_colors": dict(entity_colors)}
+            progress_store.publish(task_id, "entities", data)
         elif step == "generate_questions":
             progress_store[task_id]["questions"].append(log)
+            progress_store.publish(task_id, "question", log)
 
+        # Publish the step after its data so the page never renders a step without it
+        if step:
+            progress_store.publish(task_id, "step", {"status": "in progress", "step": step})
+
+def publish_evidence(task_id, evidence_wrapper):
+    # Publish the evidence found so far in the form the demo page renders
+    evidence = evidence_to_dicts(evidence_wrapper)
+    progress_store[task_id]["evidence"] = evidence
+    progress_store.publish(task_id, "evidence", {"evidence": evidence})
+
+RETRIEVAL_MODES = ("local", "knn")
+SIMILARITY_MODEL = "sentence-transformers/all-mpnet-base-v2"
 
 class EvidenceRetriever:
-    def __init__(self, title_match_docs_limit=20, title_match_search_threshold=0, answerability_threshold=0.65, answerability_docs_limit=20, text_match_search_db_limit=1000, reader_threshold=0.7, questions=[], use_relevancy_model=True):
+    def __init__(self, title_match_docs_limit=20, title_match_search_threshold=0, answerability_threshold=0.65, answerability_docs_limit=20, text_match_search_db_limit=1000, reader_threshold=0.7, use_relevancy_model=True, relevance_batch_size=32, embedding_cache_size=50000, embedding_cache_dir=None, lazy_embeddings=False, generation_cache_size=2048, background_loading=False, model_load_workers=1, model_cache_dir=None, inference_backend="pytorch", sentence_index_dir=None, passage_streaming=False, passage_top_k=10, passage_confidence=0.5, passage_time_budget=None, passage_chunk_docs=4, bm25_cache_docs=5000, stage_concurrency=1, retrieval_mode="local", knn_k=10, knn_num_candidates=100, knn_filter_entities=True, knn_threshold=0.8):
         print ("Initialising evidence retriever")
 
-        self.questions = questions
         self.use_relevancy_model = use_relevancy_model
 
-        # Setup db connection and NLP models
-        load_dotenv()
-        self.es = Elasticsearch(hosts=[os.environ.get("ES_HOST_URL")], basic_auth=(os.environ.get("ES_USER"), os.environ.get("ES_PASS")))
+        # Only fetch dense embeddings for docs that reach DPR instead of for every search hit
+        self.lazy_embeddings = lazy_embeddings
 
         # Set limits and cutoffs for document retrieval
         self.title_match_docs_limit = title_match_docs_limit
@@ -72,118 +94,347 @@ class EvidenceRetriever:
         self.answerability_threshold = answerability_threshold
         self.reader_threshold = reader_threshold
 
+        # Set batch size for sentence relevance classification and similarity scoring
+        self.relevance_batch_size = relevance_batch_size
+        self.generation_cache_size = generation_cache_size
+        self.embedding_cache_size = embedding_cache_size
+        self.embedding_cache_dir = embedding_cache_dir
+        self.embedding_cache = None
+
+        # Precomputed sentence offsets and embeddings per doc, built offline with build_sentence_index.py
+        self.sentence_index_dir = sentence_index_dir
+        self.sentence_index = None
+
+        # Streaming passage retrieval scores docs passage_chunk_docs at a time in doc score order, publishing passages as they're found
+        # and stopping once passage_top_k passages score at least passage_confidence or passage_time_budget seconds have passed
+        self.passage_streaming = passage_streaming
+        self.passage_top_k = passage_top_k
+        self.passage_confidence = passage_confidence
+        self.passage_time_budget = passage_time_budget
+        self.passage_chunk_docs = passage_chunk_docs
+
+        # Without the relevance model passages are ranked by BM25, keeping the tokenization of up to bm25_cache_docs docs across claims
+        self.bm25_cache_docs = bm25_cache_docs
+        self.bm25_index = None
+        self.reader_lock = threading.Lock()
+
+        # Vectors of disambiguation phrases in titles, kept across claims
+        self.phrase_vectors = PhraseVectors()
+
+        # Document retrieval stages of one claim that may run at the same time
+        self.stage_executor = StageExecutor(metrics, max_workers=stage_concurrency)
+
+        # local scores text matched docs with DPR in memory, knn sends the DPR question embeddings to Elasticsearch as kNN queries
+        # returning the knn_k nearest docs per question, only among docs mentioning an entity when knn_filter_entities is set
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError("Unknown retrieval mode '" + str(retrieval_mode) + "', expected one of " + ", ".join(RETRIEVAL_MODES))
+        self.retrieval_mode = retrieval_mode
+        self.knn_k = knn_k
+        self.knn_num_candidates = knn_num_candidates
+        self.knn_filter_entities = knn_filter_entities
+        # kNN hits are scored on the embedding field's Elasticsearch similarity scale, (1 + cosine) / 2 for a cosine field, so they have their own cutoff
+        # Every hit scores above 0 on that scale, the default 0.8 keeps hits with a cosine similarity above 0.6
+        self.knn_threshold = knn_threshold
+
+        # Models load on up to model_load_workers threads, optionally from local copies in model_cache_dir
+        self.model_load_workers = model_load_workers
+        self.model_cache_dir = model_cache_dir
+
+        # Backend the transformer models run on, pytorch, quantized (dynamic int8) or onnx
+        self.inference_backend = inference_backend
+        self.models_ready = threading.Event()
+        self.load_error = None
+        self.load_seconds = None
+        self.load_times = {}
+
+        # Setup db connection and NLP models, in the background the app can serve pages while the models load
+        self.es = self.connect_elasticsearch()
+        if background_loading:
+            threading.Thread(target=self.load, name="model-loader", daemon=True).start()
+        else:
+            self.load()
+
+    def connect_elasticsearch(self):
+        load_dotenv()
+        return Elasticsearch(
+            hosts=[os.environ.get("ES_HOST_URL")],
+            basic_auth=(os.environ.get("ES_USER"), os.environ.get("ES_PASS")),
+            connections_per_node=int(os.environ.get("ES_CONNECTIONS_PER_NODE", 10)),
+            request_timeout=float(os.environ.get("ES_REQUEST_TIMEOUT", 30))
+        )
+
+    def load(self):
+        start = time.perf_counter()
+        try:
+            self.load_models()
+            self.embedding_cache = EmbeddingCache(self.sim_model, max_size=self.embedding_cache_size, store_dir=self.embedding_cache_dir, batch_size=self.relevance_batch_size, model_id=SIMILARITY_MODEL + " " + self.inference_backend)
+            self.sentence_index = self.load_sentence_index()
+            if not self.use_relevancy_model:
+                self.bm25_index = BM25SentenceIndex(self.nlp, max_docs=self.bm25_cache_docs)
+        except Exception as e:
+            self.load_error = str(e)
+            print("Loading models failed: " + self.load_error)
+            raise
+        self.load_seconds = time.perf_counter() - start
+        self.models_ready.set()
+        print("Evidence retriever initialised in {:.2f}s".format(self.load_seconds))
+
+    def load_models(self):
         # Setup NLP models for document retrieval
         print("Initialising NLP models")
 
-        self.nlp = spacy.load('en_core_web_sm')
-        self.NER_model = pipeline("token-classification", model="Babelscape/wikineural-multilingual-ner", grouped_entities=True)
-        self.question_generation_pipe = pipeline("text2text-generation", model="mrm8488/t5-base-finetuned-question-generation-ap", max_length=256)
-        self.answer_extraction_pipe = pipeline("text2text-generation", model="vabatista/t5-small-answer-extraction-en")
+        backend = self.inference_backend
+        relevance_classification_model_dir = os.path.join(os.path.dirname(__file__), 'models', 'relevancy_classification')
 
-        # Setup similarity model
-        self.sim_model = SentenceTransformer('sentence-transformers/all-mpnet-base-v2') 
+        # Attribute name and loader for each model, they don't depend on each other so can load concurrently
+        loaders = {
+            "nlp": lambda: spacy.load('en_core_web_sm'),
+            "NER_model": lambda: load_pipeline("token-classification", "Babelscape/wikineural-multilingual-ner", self.model_cache_dir, backend, grouped_entities=True),
 
+            # Generation pipes memoize outputs per prompt and batch the prompts they're given
+            "question_generation_pipe": lambda: CachedGenerationPipe(load_pipeline("text2text-generation", "mrm8488/t5-base-finetuned-question-generation-ap", self.model_cache_dir, backend, max_length=256), max_size=self.generation_cache_size),
+            "answer_extraction_pipe": lambda: CachedGenerationPipe(load_pipeline("text2text-generation", "vabatista/t5-small-answer-extraction-en", self.model_cache_dir, backend), max_size=self.generation_cache_size),
+
+            # Setup similarity model
+            "sim_model": lambda: load_sentence_transformer(SIMILARITY_MODEL, self.model_cache_dir, backend),
+
+            # Setup DPR encoders once, each request passes its own candidate doc store at retrieval time, haystack runs them on pytorch whatever the backend
+            "dpr_retriever": lambda: load_dpr("facebook/dpr-question_encoder-single-nq-base", "facebook/dpr-ctx_encoder-single-nq-base", self.model_cache_dir, use_gpu=False, embed_title=True, batch_size=2)
+        }
         if self.use_relevancy_model:
             # Setup relevance classification model
-            relevance_classification_model_dir = os.path.join(os.path.dirname(__file__), 'models', 'relevancy_classification')
-            relevance_classification_model = DistilBertForSequenceClassification.from_pretrained(relevance_classification_model_dir)
-            relevance_classification_tokenizer = AutoTokenizer.from_pretrained(relevance_classification_model_dir)
-            self.relevance_classification_tokenizer_pipe = pipeline('text-classification', model=relevance_classification_model, tokenizer=relevance_classification_tokenizer)
-        print("Evidence retriever initialised")
+            loaders["relevance_classification_tokenizer_pipe"] = lambda: load_pipeline('text-classification', relevance_classification_model_dir, None, backend)
+        else:
+            # Setup the reader once for question-based passage retrieval
+            loaders["reader"] = lambda: load_farm_reader("deepset/tinyroberta-squad2", self.model_cache_dir, use_gpu=False, context_window_size=250)
+
+        def timed(name):
+            start = time.perf_counter()
+            model = loaders[name]()
+            self.load_times[name] = time.perf_counter() - start
+            print(name + " loaded in {:.2f}s".format(self.load_times[name]))
+            return model
+
+        with ThreadPoolExecutor(max_workers=max(1, self.model_load_workers)) as executor:
+            futures = {name: executor.submit(timed, name) for name in loaders}
+            for name, future in futures.items():
+                setattr(self, name, future.result())
+
+    def load_sentence_index(self):
+        if not self.sentence_index_dir:
+            return None
+        sentence_index = SentenceIndex(self.sentence_index_dir)
+
+        # An index built with a different similarity model can't be compared against this model's claim embeddings
+        if sentence_index.dim != self.embedding_cache.dim:
+            print("Sentence index embeddings have dimension " + str(sentence_index.dim) + " but the similarity model has " + str(self.embedding_cache.dim) + ", ignoring the index")
+            return None
+        if sentence_index.backend != self.inference_backend:
+            print("Sentence index was built with the " + str(sentence_index.backend) + " inference backend, similarity scores will differ slightly from the " + self.inference_backend + " backend")
+        print("Sentence index loaded:", sentence_index.stats())
+        return sentence_index
+
+    def wait_until_ready(self, timeout=None):
+        # Block until the models have loaded, raising if loading failed or timed out
+        start = time.perf_counter()
+        while not self.models_ready.wait(1):
+            if self.load_error:
+                raise RuntimeError("Loading models failed: " + self.load_error)
+            if timeout is not None and time.perf_counter() - start > timeout:
+                raise TimeoutError("Models still loading after " + str(timeout) + "s")
+
+    def readiness(self):
+        return {
+            "ready": self.models_ready.is_set(),
+            "error": self.load_error,
+            "load_seconds": self.load_seconds,
+            "models": {name: round(seconds, 3) for name, seconds in self.load_times.items()}
+        }
 
     def retrieve_evidence(self, claim, task_id):
-        self.task_id = task_id
-        # Retrieve evidence for a given query
-        evidence = self.retrieve_documents(claim)
-        evidence = self.retrieve_passages(evidence)
+        # Retrieve evidence for a given query, questions are scoped to this claim so concurrent claims don't share them
+        self.wait_until_ready()
+        questions = []
+        metrics.memory(task_id, "start")
+        with metrics.stage(task_id, "retrieve_evidence"):
+            evidence = self.retrieve_documents(claim, task_id, questions)
+            with metrics.stage(task_id, "retrieve_passages"):
+                evidence = self.retrieve_passages(evidence, task_id, questions)
+        metrics.memory(task_id, "end")
+        print("Embedding cache:", self.embedding_cache.stats())
+        print("Generation cache:", self.answer_extraction_pipe.stats(), self.question_generation_pipe.stats())
+        print("Disambiguation phrase vectors:", self.phrase_vectors.stats())
+        if self.sentence_index:
+            print("Sentence index:", self.sentence_index.stats())
+        if self.bm25_index:
+            print("BM25 index:", self.bm25_index.stats())
+
+        # Publish this claim's metrics so they can be shown with its progress or collected from a worker process
+        task_metrics = metrics.summary(task_id)
+        print("Stage timings:", {stage: round(seconds, 3) for stage, seconds in task_metrics["stages"].items()})
+        if task_id:
+            if metrics_in_progress:
+                progress_store[task_id]["metrics"] = task_metrics
+            progress_store.publish(task_id, "metrics", task_metrics)
         return evidence
 
-    def retrieve_documents(self, claim):
+    def retrieve_documents(self, claim, task_id=None, questions=None):
+        questions = questions if questions is not None else []
         print("Starting document retrieval for claim: '" + str(claim) + "'")
-        log_progress(self.task_id, claim, "start")
-
-        # Extract entities from claim
-        print("Extracting entities from claim")
-        log_progress(self.task_id, "Extracting entities from claim", "extract_entities")
-        entities = extract_entities(self.answer_extraction_pipe, self.NER_model, claim)
-        print("Entities:", entities)
-        log_progress(self.task_id, entities, "entities_extracted")
-
-        # Retrieve documents with exact title match inc. docs with disambiguation in title and score them
-        print("Searching for titles containing keywords:", entities)
-        log_progress(self.task_id, "Searching for titles containing keywords: " + str(entities), "title_match_search")
-        title_match_docs = title_match_search(entities, self.es)
-        print("Scoring documents")
-        log_progress(self.task_id, "Scoring documents", "score_docs")
-        title_match_docs = score_docs(title_match_docs, claim, self.nlp)
-
-        # Split docs into title matched and disambiguated docs
-        exact_title_matched_docs = [doc for doc in title_match_docs if doc['method'] == "title_match"]
-        disambiguated_docs = [doc for doc in title_match_docs if doc['method'] == "disambiguation"]
-
-        # Sort title matched docs by score, taking top N docs or docs above a certain threshold
-        disambiguated_docs = sorted(disambiguated_docs, key=lambda x: x['score'], reverse=True)[:self.title_match_docs_limit]
-        disambiguated_docs = [doc for doc in disambiguated_docs if doc['score'] > self.title_match_search_threshold]
-
-        # Retrieve X documents where entity is mentioned in the text
-        print("Searching for documents containing keywords:", entities)
-        log_progress(self.task_id, "Searching for documents containing keywords: " + str(entities), "text_match_search")
-        textually_matched_docs = text_match_search(entities, self.es, self.text_match_search_db_limit)
-
-        # Generate questions for each answer in the query
-        claim_answers = extract_answers(self.answer_extraction_pipe, claim)
-        print("Claim answers:", claim_answers)
-        log_progress(self.task_id, claim_answers, "extract_answers")
-        # questions = []
-        for answer in claim_answers:
-            question = extract_questions(self.question_generation_pipe, answer['focal'], claim)
-            self.questions.append(question)
-            print("Question for answer '" + answer['focal'] + "':", question)
-            log_progress(self.task_id, {"answer": answer['focal'], "question": question}, "generate_questions")
-
-        # Manually generate polar questions (yes/no questions)
-        polar_questions = extract_polar_questions(self.nlp, self.question_generation_pipe, claim)
-        for polar_question in polar_questions:
-            self.questions.append(polar_question)
-            print("Polar question:", polar_question)
-            log_progress(self.task_id, {"answer": "Yes/No", "question": polar_question}, "generate_questions")
-
-        # For doc in both disambiguated and textually matched docs, add to doc store
-        doc_store = listdict_to_docstore(disambiguated_docs + textually_matched_docs)
-
-        # Initialise retriever
-        print("Initialising DPR")
-        log_progress(self.task_id, "Initialising DPR", "initialise_DPR")
-        retriever = DensePassageRetriever(
-            document_store=doc_store,
-            query_embedding_model="facebook/dpr-question_encoder-single-nq-base",
-            passage_embedding_model="facebook/dpr-ctx_encoder-single-nq-base",
-            use_gpu=False,
-            embed_title=True,
-            batch_size=2,
-        )
-
-        # Set docs to return
-        return_docs = []
-        for doc in exact_title_matched_docs:
-            return_docs.append(doc)
-
-        # Retrieve docs for each question keeping the highest scoring docs
-        print("Retrieving documents for each question")
-        log_progress(self.task_id, "Retrieving documents for each question", "retrieve_docs")
-        for question in tqdm(self.questions):
-            results = retriever.retrieve(query=question)
-            for result in results:
-                id = result.id
-                score = result.score
-
-                if score > self.answerability_threshold:
-                    for doc in disambiguated_docs + textually_matched_docs:
-                        if doc['id'] == id and doc['score'] < score:
-                            if doc["id"] not in [d["id"] for d in return_docs]:
-                                doc['score'] = score
-                                return_docs.append(doc)
-
+        log_progress(task_id, claim, "start")
+
+        with metrics.stage(task_id, "retrieve_documents"):
+            # Stages run as soon as the stages they need have finished, so the ES round trips and doc scoring
+            # overlap with question generation, which only needs the claim's answers
+            def extract_claim_answers():
+                # Entity and answer extraction prompts go through the answer extraction model as one batch
+                print("Extracting entities from claim")
+                log_progress(task_id, "Extracting entities from claim", "extract_entities")
+                outputs = self.answer_extraction_pipe([entity_extraction_prompt(claim), answer_extraction_prompt(claim)])
+                metrics.count(task_id, "answer_extraction_calls")
+                return outputs
+
+            def extract_claim_entities(outputs):
+                entity_output, _ = outputs
+                entities = extract_entities(self.answer_extraction_pipe, self.NER_model, claim, output=[entity_output])
+                metrics.count(task_id, "ner_calls")
+                print("Entities:", entities)
+                log_progress(task_id, entities, "entities_extracted")
+                return entities
+
+            def search_titles(entities):
+                # kNN mode only needs the title matches, text matched candidates come from the kNN queries
+                print("Searching for titles containing keywords:", entities)
+                log_progress(task_id, "Searching for titles containing keywords: " + str(entities), "title_match_search")
+                title_match_docs = title_match_search(entities, self.es, fetch_embeddings=False)
+                metrics.count(task_id, "title_match_docs_fetched", len(title_match_docs))
+                return title_match_docs, []
+
+            def search_documents(entities):
+                # Docs with the entities in their title (inc. disambiguations) and X docs mentioning them in their text in one round trip
+                print("Searching for titles containing keywords:", entities)
+                log_progress(task_id, "Searching for titles containing keywords: " + str(entities), "title_match_search")
+                title_match_docs, textually_matched_docs = title_and_text_match_search(entities, self.es, self.text_match_search_db_limit, fetch_embeddings=not self.lazy_embeddings)
+                metrics.count(task_id, "title_match_docs_fetched", len(title_match_docs))
+                metrics.count(task_id, "text_match_docs_fetched", len(textually_matched_docs))
+                print("Searching for documents containing keywords:", entities)
+                log_progress(task_id, "Searching for documents containing keywords: " + str(entities), "text_match_search")
+                return title_match_docs, textually_matched_docs
+
+            def score_title_docs(searched):
+                title_match_docs, _ = searched
+                print("Scoring documents")
+                log_progress(task_id, "Scoring documents", "score_docs")
+                title_match_docs = score_docs(title_match_docs, claim, self.nlp, self.phrase_vectors)
+
+                # Split docs into title matched and disambiguated docs
+                exact_title_matched_docs = [doc for doc in title_match_docs if doc['method'] == "title_match"]
+                disambiguated_docs = [doc for doc in title_match_docs if doc['method'] == "disambiguation"]
+
+                # Sort title matched docs by score, taking top N docs or docs above a certain threshold
+                disambiguated_docs = sorted(disambiguated_docs, key=lambda x: x['score'], reverse=True)[:self.title_match_docs_limit]
+                disambiguated_docs = [doc for doc in disambiguated_docs if doc['score'] > self.title_match_search_threshold]
+                return exact_title_matched_docs, disambiguated_docs
+
+            def fetch_candidate_embeddings(searched, scored):
+                candidate_docs = scored[1] + searched[1]
+                if self.lazy_embeddings:
+                    fetch_embeddings(candidate_docs, self.es)
+                return candidate_docs
+
+            def generate_claim_questions(outputs):
+                # Generate questions for each answer in the query
+                _, answer_output = outputs
+                claim_answers = extract_answers(self.answer_extraction_pipe, claim, output=[answer_output])
+                print("Claim answers:", claim_answers)
+                log_progress(task_id, claim_answers, "extract_answers")
+
+                # Answer questions and polar questions (yes/no questions) are generated as one batch
+                answer_questions, polar_questions = generate_questions(self.nlp, self.question_generation_pipe, [answer['focal'] for answer in claim_answers], claim)
+                metrics.count(task_id, "question_generation_calls")
+                metrics.count(task_id, "questions_generated", len(answer_questions) + len(polar_questions))
+                for answer, question in zip(claim_answers, answer_questions):
+                    questions.append(question)
+                    print("Question for answer '" + answer['focal'] + "':", question)
+                    log_progress(task_id, {"answer": answer['focal'], "question": question}, "generate_questions")
+
+                for polar_question in polar_questions:
+                    questions.append(polar_question)
+                    print("Polar question:", polar_question)
+                    log_progress(task_id, {"answer": "Yes/No", "question": polar_question}, "generate_questions")
+
+            def search_nearest_documents(entities, _):
+                # Nearest docs to each question's DPR embedding, found by Elasticsearch without fetching any embeddings
+                print("Searching for documents nearest to each question")
+                log_progress(task_id, "Searching for documents nearest to each question", "knn_search")
+                if not questions:
+                    return [], []
+                query_vectors = self.dpr_retriever.embed_queries(questions)
+                knn_docs, results = knn_search(query_vectors, self.es, entities if self.knn_filter_entities else None, self.knn_k, self.knn_num_candidates)
+                metrics.count(task_id, "knn_questions", len(questions))
+                metrics.count(task_id, "knn_docs_fetched", len(knn_docs))
+                return knn_docs, results
+
+            def build_candidate_docstore(candidate_docs):
+                # For doc in both disambiguated and textually matched docs, add to doc store
+                doc_store = listdict_to_docstore(candidate_docs)
+                metrics.count(task_id, "dpr_candidate_docs", doc_store.get_document_count())
+                return doc_store
+
+            stages = [
+                Stage("answer_extraction", extract_claim_answers),
+                Stage("extract_entities", extract_claim_entities, ["answer_extraction"]),
+                Stage("es_search", search_titles if self.retrieval_mode == "knn" else search_documents, ["extract_entities"]),
+                Stage("score_docs", score_title_docs, ["es_search"])
+            ]
+            if self.retrieval_mode == "knn":
+                stages += [
+                    Stage("generate_questions", generate_claim_questions, ["answer_extraction"]),
+                    Stage("knn_search", search_nearest_documents, ["extract_entities", "generate_questions"])
+                ]
+            else:
+                stages += [
+                    Stage("es_fetch_embeddings", fetch_candidate_embeddings, ["es_search", "score_docs"]),
+                    Stage("generate_questions", generate_claim_questions, ["answer_extraction"]),
+                    Stage("build_docstore", build_candidate_docstore, ["es_fetch_embeddings"])
+                ]
+            stage_results, critical_path = self.stage_executor.run(stages, task_id)
+            print("Critical path:", {name: round(seconds, 3) for name, seconds in critical_path.items()})
+            exact_title_matched_docs, disambiguated_docs = stage_results["score_docs"]
+
+            # Set docs to return
+            return_docs = []
+            for doc in exact_title_matched_docs:
+                return_docs.append(doc)
+
+            if self.retrieval_mode == "knn":
+                # kNN hits scored above the cutoff are returned, disambiguated docs among them keep their own doc
+                knn_docs, results = stage_results["knn_search"]
+                return_docs = merge_retrieved_docs(return_docs, disambiguated_docs + knn_docs, results, self.knn_threshold)
+                metrics.count(task_id, "docs_returned", len(return_docs))
+                return self.docs_to_wrapper(claim, return_docs)
+
+            textually_matched_docs = stage_results["es_search"][1]
+            doc_store = stage_results["build_docstore"]
+
+            # Attach candidate docs to the shared retriever, encoders are loaded once in __init__
+            print("Initialising DPR")
+            log_progress(task_id, "Initialising DPR", "initialise_DPR")
+            retriever = self.dpr_retriever
+
+            # Retrieve docs for all questions in one batch keeping the highest scoring docs
+            print("Retrieving documents for each question")
+            log_progress(task_id, "Retrieving documents for each question", "retrieve_docs")
+            if questions:
+                with metrics.stage(task_id, "dpr_retrieve"):
+                    batch_results = retriever.retrieve_batch(queries=questions, document_store=doc_store)
+                metrics.count(task_id, "dpr_questions", len(questions))
+                results = [result for question_results in batch_results for result in question_results]
+                return_docs = merge_retrieved_docs(return_docs, disambiguated_docs + textually_matched_docs, results, self.answerability_threshold)
+            metrics.count(task_id, "docs_returned", len(return_docs))
+        return self.docs_to_wrapper(claim, return_docs)
+
+    def docs_to_wrapper(self, claim, return_docs):
         # Add evidence to evidence wrapper
         evidence_wrapper = EvidenceWrapper(claim)
         for id, doc_id, score, method, text, embedding in [(doc['id'], doc['doc_id'], doc['score'], doc['method'], doc['text'], doc['embedding']) for doc in return_docs]:
@@ -192,117 +443,161 @@ class EvidenceRetriever:
 
         return evidence_wrapper
 
-    def retrieve_passages(self, evidence_wrapper):
-        def get_semantic_sim(self, claim, sentence):
-            embeddings = self.sim_model.encode([claim, sentence])
-            return util.cos_sim(embeddings[0], embeddings[1]).item()
-        
+    def retrieve_passages(self, evidence_wrapper, task_id=None, questions=None):
+        questions = questions if questions is not None else []
         claim = evidence_wrapper.get_claim()
 
         if self.use_relevancy_model:
-            evidences = evidence_wrapper.get_evidences()
-            for evidence in evidences:
-                evidence_text = evidence.evidence_text
-                doc = self.nlp(evidence_text)
-
-                evidence_sentences = []
-                for sentence in doc.sents:
-                    sentence = sentence.text
-                    input_pair = f"{claim} [SEP] {sentence}"
-                    result = self.relevance_classification_tokenizer_pipe(input_pair)
-                    label = result[0]['label']
-                    relevance_score = result[0]['score']
-                    similarity_score = get_semantic_sim(self, claim, sentence)
-                    if label == "LABEL_1":
-                        evidence_sentence = Sentence(sentence=sentence, score=similarity_score, doc_id=evidence.doc_id)
-                        evidence_sentences.append(evidence_sentence)
-
-                for sentence in evidence_sentences:
-                    sentence.set_start_end(evidence_text)
-                    evidence.add_sentence(sentence)
+            if self.passage_streaming:
+                # Publish the evidence after each chunk that found passages so the page can show it before scoring finishes
+                start = time.perf_counter()
+                first_passage = True
+                for sentences in self.stream_passages(evidence_wrapper, task_id):
+                    if sentences and task_id:
+                        if first_passage:
+                            metrics.record_stage(task_id, "time_to_first_passage", time.perf_counter() - start)
+                            first_passage = False
+                        publish_evidence(task_id, evidence_wrapper)
+            else:
+                self.score_sentences(claim, evidence_wrapper.get_evidences(), task_id)
 
         else:
             # Retrieve passages using BM25 between the claim and evidence sentences
             print("Retrieving passages using BM25")
-            log_progress(self.task_id, "Retrieving passages using BM25")
+            log_progress(task_id, "Retrieving passages using BM25")
             
-            evidence_texts = [{"doc_id": evidence.doc_id, "text": evidence.evidence_text} for evidence in evidence_wrapper.get_evidences()]
-
-            # Prepare evidence sentences and mappings
-            evidence_sentences = []
-            original_sentences = []
-            sent_doc_ids_map = {}
-
-            # Clean the claim
-            cleaned_claim = [token.text for token in self.nlp(claim) if not token.is_stop and not token.is_punct]
-
-            # Process documents
-            print("Processing documents")
-            log_progress(self.task_id, "Processing documents")
-            for doc in evidence_texts:
-                for sent in self.nlp(doc["text"]).sents:
-                    original_sentences.append(sent.text)
-
-                    # Tokenize and clean
-                    cleaned = [token.text for token in sent if not token.is_stop and not token.is_punct]
-                    evidence_sentences.append(cleaned)
-                    sent_doc_ids_map[" ".join(cleaned)] = (doc["doc_id"], sent.text)
-
-            # Create BM25 object and score sentences
+            # Score every sentence of the evidences, docs already tokenized for an earlier claim come from the BM25 index's cache
             print("Scoring sentences")
-            log_progress(self.task_id, "Scoring sentences")
-            bm25 = BM25Okapi(evidence_sentences)
-            scores = bm25.get_scores(cleaned_claim)
-
-            # Prepare ranked sentences with original text
-            ranked_sentences = sorted([(evidence_sentences[i], scores[i], original_sentences[i]) for i in range(len(evidence_sentences))], key=lambda x: x[1], reverse=True)
+            log_progress(task_id, "Scoring sentences")
+            with metrics.stage(task_id, "bm25_scoring"):
+                sentence_rows, scores, tokenized = self.bm25_index.score(claim, evidence_wrapper.get_evidences())
+            metrics.count(task_id, "sentences_scored", len(sentence_rows))
+            metrics.count(task_id, "bm25_docs_tokenized", tokenized)
 
-            # Only keep sentences with a score above 0
-            ranked_sentences = [sentence for sentence in ranked_sentences if sentence[1] > 0]
-
-            # Only keep the top N sentences
+            # Only keep the top N sentences with a score above 0, ties in sentence order
             N = 5
-            ranked_sentences = ranked_sentences[:N]
-
-            # Add sentences to evidence
-            for cleaned, score, original in ranked_sentences:
-                doc_id, original_text = sent_doc_ids_map[" ".join(cleaned)]
-                for evidence in evidence_wrapper.get_evidences():
-                    if evidence.doc_id == doc_id:
-                        sentence = Sentence(sentence=original, score=get_semantic_sim(self, claim, original), doc_id=doc_id, method="BM25")
-                        sentence.set_start_end(evidence.evidence_text)
-                        evidence.add_sentence(sentence)
-
-            # Retrieve passages using the FARM reader
-            doc_store = wrapper_to_docstore(evidence_wrapper)
-
-            # Initialise reader
-            reader = FARMReader(
-                model_name_or_path="deepset/tinyroberta-squad2",
-                use_gpu=False,
-                context_window_size=250,
-                )
-
-            # Retrieve passages for each question
-            for question in self.questions:
-                print("Retrieving passages for question:", question)
-                log_progress(self.task_id, "Retrieving passages for question: " + question)
-                results = reader.predict(query=question, documents=doc_store, top_k=30)
-
-                for answer in results['answers']:
-                    passage = answer.context
-                    id = answer.document_ids[0]
-                    score = get_semantic_sim(self, claim, passage)
-
+            ranked = [i for i in np.argsort(-scores, kind="stable")[:N] if scores[i] > 0]
+
+            # Add sentences to the evidence they came from, scored against the claim in one pass
+            ranked_rows = [sentence_rows[i] for i in ranked]
+            similarity_scores = self.get_semantic_sims(claim, [evidence.evidence_text[start:end] for evidence, start, end in ranked_rows])
+            for (evidence, start, end), similarity_score in zip(ranked_rows, similarity_scores):
+                sentence = Sentence(sentence=evidence.evidence_text[start:end], score=similarity_score, doc_id=evidence.doc_id, start=start, end=end, method="BM25")
+                evidence.add_sentence(sentence)
+
+            # Retrieve passages for all questions with one batched reader pass over the evidence docs
+            if questions:
+                print("Retrieving passages for questions:", questions)
+                log_progress(task_id, "Retrieving passages for " + str(len(questions)) + " questions")
+                documents = wrapper_to_documents(evidence_wrapper)
+                with metrics.stage(task_id, "farm_reader"):
+                    # The reader is shared between claims, one prediction runs at a time
+                    with self.reader_lock:
+                        answers = read_answers(self.reader, questions, documents, top_k=30)
+                metrics.count(task_id, "reader_calls")
+                metrics.count(task_id, "reader_questions", len(questions))
+
+                # Score every answer context against the claim in one pass
+                with metrics.stage(task_id, "similarity_scoring"):
+                    scores = self.get_semantic_sims(claim, [answer.context for _, answer in answers])
+                metrics.count(task_id, "sentences_scored", len(answers))
+
+                for (question, answer), score in zip(answers, scores):
                     if score > self.reader_threshold:
-                        evidence = evidence_wrapper.get_evidence_by_id(id)
+                        evidence = evidence_wrapper.get_evidence_by_id(answer.document_ids[0])
                         if evidence:
+                            passage = answer.context
                             sentence = Sentence(sentence=passage, score=score, doc_id=evidence.doc_id, question=question, method="FARM")
-                            sentence.set_start_end(evidence.evidence_text)
+
+                            # The context's offset in the doc follows from where the answer sits in both
+                            if answer.offsets_in_document and answer.offsets_in_context:
+                                sentence.start = answer.offsets_in_document[0].start - answer.offsets_in_context[0].start
+                                sentence.end = sentence.start + len(passage)
+                            else:
+                                sentence.set_start_end(evidence.evidence_text)
                             evidence.add_sentence(sentence)
         
         return evidence_wrapper
-    
-    def flush_questions(self):
-        self.questions = []
-        print("Questions flushed")
\ No newline at end of file
+
+    def score_sentences(self, claim, evidences, task_id=None):
+        # Add the sentences of the given evidences the relevance model accepts, scored by similarity to the claim, and return them
+
+        # Collect every sentence across all evidences as (evidence, start, end, embedding) so they can be scored in batches
+        # Offsets and embeddings of indexed docs come from the sentence index, other docs are split here and embedded when scored
+        sentence_rows = []
+        with metrics.stage(task_id, "sentence_split"):
+            unindexed = []
+            for evidence in evidences:
+                indexed = self.sentence_index.lookup(evidence.id, evidence.evidence_text) if self.sentence_index else None
+                if indexed is None:
+                    unindexed.append(evidence)
+                    continue
+                spans, embeddings = indexed
+                sentence_rows.extend((evidence, int(start), int(end), embedding) for (start, end), embedding in zip(spans, embeddings))
+            for evidence, spans in zip(unindexed, split_sentences(self.nlp, [evidence.evidence_text for evidence in unindexed])):
+                sentence_rows.extend((evidence, start, end, None) for start, end in spans)
+        metrics.count(task_id, "sentence_index_hits", len(evidences) - len(unindexed))
+
+        # Classify relevance of each (claim, sentence) pair in batches
+        input_pairs = [f"{claim} [SEP] {evidence.evidence_text[start:end]}" for evidence, start, end, _ in sentence_rows]
+        with metrics.stage(task_id, "relevance_classification"):
+            results = self.relevance_classification_tokenizer_pipe(input_pairs, batch_size=self.relevance_batch_size, truncation=True) if input_pairs else []
+        relevant_rows = [row for row, result in zip(sentence_rows, results) if result['label'] == "LABEL_1"]
+        metrics.count(task_id, "sentences_classified", len(input_pairs))
+        metrics.count(task_id, "relevance_batches", -(-len(input_pairs) // self.relevance_batch_size))
+        metrics.count(task_id, "sentences_relevant", len(relevant_rows))
+
+        # Score relevant sentences against the claim, encoding the claim only once
+        with metrics.stage(task_id, "similarity_scoring"):
+            similarity_scores = self.get_row_semantic_sims(claim, relevant_rows)
+        metrics.count(task_id, "sentences_scored", len(relevant_rows))
+        sentences = []
+        for (evidence, start, end, _), similarity_score in zip(relevant_rows, similarity_scores):
+            evidence_sentence = Sentence(sentence=evidence.evidence_text[start:end], score=similarity_score, doc_id=evidence.doc_id, start=start, end=end)
+            evidence.add_sentence(evidence_sentence)
+            sentences.append(evidence_sentence)
+        return sentences
+
+    def stream_passages(self, evidence_wrapper, task_id=None):
+        # Score evidences in doc score order a chunk at a time, yielding the sentences each chunk adds
+        claim = evidence_wrapper.get_claim()
+        evidences = sorted(evidence_wrapper.get_evidences(), key=lambda evidence: evidence.doc_score, reverse=True)
+        chunk_size = max(1, self.passage_chunk_docs)
+
+        start = time.perf_counter()
+        confident = 0
+        scored = 0
+        for i in range(0, len(evidences), chunk_size):
+            sentences = self.score_sentences(claim, evidences[i:i + chunk_size], task_id)
+            scored += len(evidences[i:i + chunk_size])
+            confident += len([sentence for sentence in sentences if sentence.score >= self.passage_confidence])
+            yield sentences
+
+            # Stop early once enough confident passages are found or the time budget is spent, the remaining docs are returned without passages
+            if self.passage_top_k and confident >= self.passage_top_k:
+                print("Found " + str(confident) + " confident passages, skipping " + str(len(evidences) - scored) + " docs")
+                break
+            if self.passage_time_budget is not None and time.perf_counter() - start >= self.passage_time_budget:
+                print("Passage time budget of " + str(self.passage_time_budget) + "s spent, skipping " + str(len(evidences) - scored) + " docs")
+                break
+        metrics.count(task_id, "passage_docs_skipped", len(evidences) - scored)
+
+    def get_semantic_sims(self, claim, sentences):
+        # Cosine similarity between the claim and each sentence, computed as one matrix operation
+        if not sentences:
+            return []
+        embeddings = self.embedding_cache.encode([claim] + sentences)
+        return util.cos_sim(embeddings[:1], embeddings[1:])[0].tolist()
+
+    def get_row_semantic_sims(self, claim, sentence_rows):
+        # Cosine similarity between the claim and (evidence, start, end, embedding) sentences as one matrix-vector product
+        # Sentences without a precomputed embedding are encoded alongside the claim
+        if not sentence_rows:
+            return []
+        missing = [i for i, (_, _, _, embedding) in enumerate(sentence_rows) if embedding is None]
+        encoded = normalize_rows(self.embedding_cache.encode([claim] + [sentence_rows[i][0].evidence_text[sentence_rows[i][1]:sentence_rows[i][2]] for i in missing]))
+
+        embeddings = [embedding for _, _, _, embedding in sentence_rows]
+        for i, embedding in zip(missing, encoded[1:]):
+            embeddings[i] = embedding
+        return (np.stack(embeddings) @ encoded[0]).tolist()
\ No newline at end of file
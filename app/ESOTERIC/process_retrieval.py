@@ -0,0 +1,167 @@
+import os
+import time
+import uuid
+import threading
+import multiprocessing
+
+from app import progress_store, metrics
+from app.progress import FINISHED_STATUSES
+
+def worker_main(worker_index, retriever_kwargs, torch_threads, task_queue, event_queue):
+    # Each worker process holds its own full model set
+    import torch
+    from app.ESOTERIC import evidence_retrieval
+    from app.ESOTERIC.evidence_retrieval import EvidenceRetriever
+
+    # Workers report ready over the event queue once their models are loaded, so load in the foreground
+    torch.set_num_threads(torch_threads)
+    # The on-disk embedding store is appended to without coordination between processes, so each worker keeps its own
+    embedding_cache_dir = retriever_kwargs.get("embedding_cache_dir")
+    if embedding_cache_dir:
+        embedding_cache_dir = os.path.join(embedding_cache_dir, "worker-" + str(worker_index))
+    retriever = EvidenceRetriever(**dict(retriever_kwargs, background_loading=False, embedding_cache_dir=embedding_cache_dir))
+
+    # Forward progress events and log lines published in this process back to the server process, which merges them into its own copy of the task
+    def forward_progress(task_id, event, data):
+        event_queue.put(("progress", task_id, (event, data)))
+    evidence_retrieval.progress_store.listeners.append(forward_progress)
+
+    event_queue.put(("ready", os.getpid(), None))
+    while True:
+        job = task_queue.get()
+        if job is None:
+            break
+        job_id, claim, task_id, deadline = job
+        # The server process has already given up on a job still queued past its deadline
+        if time.time() > deadline:
+            event_queue.put(("error", job_id, "Evidence retrieval was given up before a worker took it"))
+            continue
+        # Tell the server process which worker took the job, so the job fails if this process dies
+        event_queue.put(("started", job_id, os.getpid()))
+        try:
+            evidence_wrapper = retriever.retrieve_evidence(claim, task_id)
+            event_queue.put(("result", job_id, evidence_wrapper))
+        except Exception as e:
+            event_queue.put(("error", job_id, str(e)))
+        finally:
+            evidence_retrieval.progress_store.pop(task_id, None)
+
+# Evidence retriever that dispatches claims to a pool of model-serving worker processes
+class ProcessEvidenceRetriever:
+    def __init__(self, workers=2, job_timeout=600, **retriever_kwargs):
+        print("Starting " + str(workers) + " evidence retrieval worker processes")
+        context = multiprocessing.get_context("spawn")
+        self.task_queue = context.Queue()
+        self.event_queue = context.Queue()
+
+        # Split the available cores between workers so torch threads don't contend
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+
+        self.processes = []
+        for i in range(workers):
+            process = context.Process(target=worker_main, args=(i, retriever_kwargs, torch_threads, self.task_queue, self.event_queue), name=f"evidence-worker-{i}", daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        # Seconds a claim may take from being queued to its result before it fails
+        self.job_timeout = job_timeout
+
+        self.pending = {}
+        # Task ids of jobs given up on while a worker may still be running them, by job id, their progress is dropped
+        self.abandoned = {}
+        self.lock = threading.Lock()
+        self.ready = 0
+        self.started = time.perf_counter()
+        self.load_seconds = None
+        threading.Thread(target=self.listen, name="evidence-worker-listener", daemon=True).start()
+
+    def listen(self):
+        while True:
+            self.handle(*self.event_queue.get())
+
+    def handle(self, kind, key, payload):
+        if kind == "ready":
+            self.ready += 1
+            if self.load_seconds is None:
+                self.load_seconds = time.perf_counter() - self.started
+            print("Evidence retrieval worker " + str(key) + " ready")
+        elif kind == "progress":
+            event, data = payload
+            with self.lock:
+                if key in self.abandoned.values():
+                    return
+            # Progress never brings back a task that has finished or been dropped from the store
+            with progress_store.lock:
+                entry = progress_store.get(key)
+                if entry is None or entry.get("status") in FINISHED_STATUSES:
+                    return
+                progress_store.merge_event(key, event, data)
+            # Log lines update the task but aren't streamed
+            if event != "log":
+                progress_store.publish(key, event, data)
+            if event == "metrics":
+                metrics.merge(key, data)
+        elif kind == "started":
+            with self.lock:
+                job = self.pending.get(key)
+                if job:
+                    job["pid"] = payload
+        else:
+            # Delivered under the lock so a job that is giving up either sees its result or no longer receives one
+            with self.lock:
+                self.abandoned.pop(key, None)
+                job = self.pending.pop(key, None)
+                if job:
+                    job["kind"] = kind
+                    job["payload"] = payload
+                    job["done"].set()
+
+    def readiness(self):
+        # Ready to serve claims once the first worker has loaded its models, claims queue until then
+        return {
+            "ready": self.ready > 0,
+            "error": None if any(process.is_alive() for process in self.processes) else "All evidence retrieval worker processes have exited",
+            "load_seconds": self.load_seconds,
+            "workers_ready": self.ready,
+            "workers": len(self.processes)
+        }
+
+    def retrieve_evidence(self, claim, task_id):
+        # Block until a worker process has retrieved evidence for the claim
+        job_id = str(uuid.uuid4())
+        job = {"done": threading.Event(), "pid": None}
+        with self.lock:
+            self.pending[job_id] = job
+        # Workers get the deadline as wall clock time, so they can skip a job that has already been given up on
+        self.task_queue.put((job_id, claim, task_id, time.time() + self.job_timeout))
+        deadline = time.monotonic() + self.job_timeout
+        while not job["done"].wait(min(5, max(0, deadline - time.monotonic()))):
+            # Give up if the worker running the job has died, no worker is left to take it, or it has run out of time
+            error = None
+            worker = next((process for process in self.processes if process.pid == job["pid"]), None)
+            if worker is not None and not worker.is_alive():
+                error = "Evidence retrieval worker " + str(job["pid"]) + " exited while retrieving evidence (exit code " + str(worker.exitcode) + ")"
+            elif not any(process.is_alive() for process in self.processes):
+                error = "All evidence retrieval worker processes have exited"
+            elif time.monotonic() >= deadline:
+                error = "Evidence retrieval timed out after " + str(self.job_timeout) + "s"
+            if error:
+                with self.lock:
+                    delivered = job["done"].is_set()
+                    self.pending.pop(job_id, None)
+                    # A live worker may still be running it, until it reports back its progress is dropped
+                    if not delivered and (worker is None or worker.is_alive()):
+                        self.abandoned[job_id] = task_id
+                if delivered:
+                    break
+                raise RuntimeError(error)
+
+        if job["kind"] == "error":
+            raise RuntimeError("Evidence retrieval worker failed: " + job["payload"])
+        return job["payload"]
+
+    def shutdown(self):
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join()
@@ -1,8 +1,11 @@
-def extract_entities(answer_pipe, NER_pipe, text):
+def entity_extraction_prompt(text):
+    return "extract entities: <ha> " + text + " <ha>"
+
+def extract_entities(answer_pipe, NER_pipe, text, output=None):
     
-    # Extract entities from text through pipeline
-    input = "extract entities: <ha> " + text + " <ha>"
-    output = answer_pipe(input)
+    # Extract entities from text through pipeline, unless the generated output was already batched with other prompts
+    if output is None:
+        output = answer_pipe(entity_extraction_prompt(text))
 
     entities = []
     answers = output[0]['generated_text'].split("<sep>")
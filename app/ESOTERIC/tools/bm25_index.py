@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from app.ESOTERIC.tools.sentence_index import content_hash
+
+# BM25 over the sentences of a claim's candidate docs, scoring the same as rank_bm25's BM25Okapi built on those sentences
+# Each doc's sentence offsets and term frequencies are cached as sparse rows over a shared vocabulary, so docs that recur across claims skip spaCy
+# Once the vocabulary passes max_vocabulary it is started again along with the doc cache, as cached rows index into it
+class BM25SentenceIndex:
+    def __init__(self, nlp, max_docs=5000, max_vocabulary=200000, k1=1.5, b=0.75, epsilon=0.25):
+        self.nlp = nlp
+        self.max_docs = max_docs
+        self.max_vocabulary = max_vocabulary
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.vocabulary = {}
+        self.docs = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.resets = 0
+
+    def clean(self, span):
+        # Tokens without stop words and punctuation
+        return [token.text for token in span if not token.is_stop and not token.is_punct]
+
+    def term_ids(self, vocabulary, tokens):
+        # Called with the lock held, adds new tokens to the vocabulary
+        return [vocabulary.setdefault(token, len(vocabulary)) for token in tokens]
+
+    def doc_entries(self, evidences):
+        # Cached entry for each evidence, tokenizing the ones not seen before in one spaCy pass
+        # Returns the entries, the vocabulary their rows index into and how many were tokenized
+        keys = [(evidence.id or evidence.doc_id, content_hash(evidence.evidence_text)) for evidence in evidences]
+        entries = [None] * len(evidences)
+        missing = {}
+        with self.lock:
+            if len(self.vocabulary) > self.max_vocabulary:
+                self.vocabulary = {}
+                self.docs = OrderedDict()
+                self.resets += 1
+            vocabulary = self.vocabulary
+            for i, key in enumerate(keys):
+                if key in self.docs:
+                    self.docs.move_to_end(key)
+                    entries[i] = self.docs[key]
+                    self.hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+
+        if missing:
+            missing_keys = list(missing.keys())
+            texts = [evidences[missing[key][0]].evidence_text for key in missing_keys]
+            tokenized = [[(sentence.start_char, sentence.end_char, self.clean(sentence)) for sentence in doc.sents] for doc in self.nlp.pipe(texts)]
+
+            # New rows go on the vocabulary the cached entries use, they're only cached if another call hasn't started a new one meanwhile
+            with self.lock:
+                for key, sentences in zip(missing_keys, tokenized):
+                    indices = []
+                    data = []
+                    row_nnz = []
+                    for _, _, tokens in sentences:
+                        term_ids, counts = np.unique(np.array(self.term_ids(vocabulary, tokens), dtype=np.int64), return_counts=True)
+                        indices.append(term_ids)
+                        data.append(counts)
+                        row_nnz.append(len(term_ids))
+                    entry = {
+                        "spans": [(start, end) for start, end, _ in sentences],
+                        "indices": np.concatenate(indices).astype(np.int32) if indices else np.zeros(0, dtype=np.int32),
+                        "data": np.concatenate(data).astype(np.float32) if data else np.zeros(0, dtype=np.float32),
+                        "row_nnz": np.array(row_nnz, dtype=np.int64),
+                        "lengths": np.array([len(tokens) for _, _, tokens in sentences], dtype=np.float32)
+                    }
+                    if vocabulary is self.vocabulary:
+                        self.docs[key] = entry
+                    for i in missing[key]:
+                        entries[i] = entry
+                while len(self.docs) > self.max_docs:
+                    self.docs.popitem(last=False)
+        return entries, vocabulary, len(missing)
+
+    def score(self, query, evidences):
+        # Returns (evidence, start, end) for every sentence of the evidences, their BM25 scores against the query and how many docs were tokenized
+        entries, vocabulary, tokenized = self.doc_entries(evidences)
+        rows = [(evidence, start, end) for evidence, entry in zip(evidences, entries) for start, end in entry["spans"]]
+        if not rows:
+            return rows, np.zeros(0, dtype=np.float32), tokenized
+
+        # The query is parsed before taking the lock, other calls may be adding to the vocabulary meanwhile
+        query_tokens = self.clean(self.nlp(query))
+        with self.lock:
+            vocabulary_size = len(vocabulary)
+            query_ids = [vocabulary[token] for token in query_tokens if token in vocabulary]
+
+        # Sentence by term frequency matrix of this claim's candidate sentences
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate([entry["row_nnz"] for entry in entries]))])
+        matrix = csr_matrix((np.concatenate([entry["data"] for entry in entries]), np.concatenate([entry["indices"] for entry in entries]), indptr), shape=(len(rows), vocabulary_size))
+        lengths = np.concatenate([entry["lengths"] for entry in entries])
+        average_length = lengths.mean()
+        if not query_ids or average_length == 0:
+            return rows, np.zeros(len(rows), dtype=np.float32), tokenized
+
+        # Inverse document frequencies over the candidate sentences, negative ones replaced by a fraction of the average like BM25Okapi
+        document_frequencies = np.bincount(matrix.indices, minlength=vocabulary_size)
+        present = document_frequencies > 0
+        idf = np.zeros(vocabulary_size)
+        idf[present] = np.log(len(rows) - document_frequencies[present] + 0.5) - np.log(document_frequencies[present] + 0.5)
+        idf[present & (idf < 0)] = self.epsilon * idf[present].mean()
+
+        # Repeated query terms count once per occurrence
+        term_frequencies = matrix[:, query_ids].toarray()
+        normalization = self.k1 * (1 - self.b + self.b * lengths / average_length)
+        scores = (idf[query_ids] * term_frequencies * (self.k1 + 1) / (term_frequencies + normalization[:, None])).sum(axis=1)
+        return rows, scores, tokenized
+
+    def stats(self):
+        with self.lock:
+            return {"docs": len(self.docs), "vocabulary": len(self.vocabulary), "vocabulary_resets": self.resets, "hits": self.hits, "misses": self.misses}
@@ -1,34 +1,35 @@
 from haystack import Document
 from haystack.document_stores import InMemoryDocumentStore
+import numpy as np
 
-def wrapper_to_docstore(evidence_wrapper):
-    doc_store = InMemoryDocumentStore()
-    for evidence in evidence_wrapper.get_evidences():
-        id = evidence.id
-        doc_id = evidence.doc_id
-        content = evidence.evidence_text
-        content_type = "text"
-        embedding = evidence.embedding
+def rows_to_documents(rows):
+    # Deduplicate by id, keeping the first occurrence
+    docs = []
+    seen_ids = set()
+    for id, doc_id, content, embedding in rows:
+        if id in seen_ids:
+            continue
+        seen_ids.add(id)
+
+        # Reuse the embedding already stored in Elasticsearch so it is not recomputed
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        # haystack's Document has no doc_id field, it's carried in meta
         meta = {"doc_id": doc_id}
-        
-        # if not already in doc store, add to doc store
-        if id not in [d.id for d in doc_store.get_all_documents()]:
-            doc = Document(id=id, doc_id=doc_id, content=content, content_type=content_type, embedding=embedding, meta=meta)
-            doc_store.write_documents([doc])
+        docs.append(Document(id=id, content=content, content_type="text", embedding=embedding, meta=meta))
+    return docs
+
+def rows_to_docstore(rows):
+    # Write all documents in one call
+    doc_store = InMemoryDocumentStore()
+    doc_store.write_documents(rows_to_documents(rows))
     return doc_store
 
+def wrapper_to_docstore(evidence_wrapper):
+    return rows_to_docstore((evidence.id, evidence.doc_id, evidence.evidence_text, evidence.embedding) for evidence in evidence_wrapper.get_evidences())
+
+def wrapper_to_documents(evidence_wrapper):
+    return rows_to_documents((evidence.id, evidence.doc_id, evidence.evidence_text, evidence.embedding) for evidence in evidence_wrapper.get_evidences())
+
 def listdict_to_docstore(listdict):
-    doc_store = InMemoryDocumentStore()
-    for doc in listdict:
-        id = doc['id']
-        doc_id = doc['doc_id']
-        content = doc['text']
-        content_type = "text"
-        embedding = doc['embedding']
-        meta = {"doc_id": doc_id}
-        
-        # if not already in doc store, add to doc store
-        if id not in [d.id for d in doc_store.get_all_documents()]:
-            doc = Document(id=id, doc_id=doc_id, content=content, content_type=content_type, embedding=embedding, meta=meta)
-            doc_store.write_documents([doc])
-    return doc_store
\ No newline at end of file
+    return rows_to_docstore((doc['id'], doc['doc_id'], doc['text'], doc['embedding']) for doc in listdict)
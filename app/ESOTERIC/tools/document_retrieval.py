@@ -1,7 +1,13 @@
 import re
+import threading
+from collections import OrderedDict, namedtuple
+import numpy as np
 
-# Retrieve documents with exact title match inc. docs with disambiguation in title
-def title_match_search(queries, es):
+# Fields returned for each hit, the dense embedding is only included when it is needed straight away
+def source_fields(fetch_embeddings=True):
+    return ["doc_id", "content", "embedding"] if fetch_embeddings else ["doc_id", "content"]
+
+def title_match_query(queries, fetch_embeddings=True):
     # Convert query to lowercase and replace spaces with underscores
     formatted_queries = [query.replace(' ', '_').replace(':', '-COLON-').lower() for query in queries] 
 
@@ -20,97 +26,217 @@ def title_match_search(queries, es):
             }
         })
 
-    query_body = {
+    return {
         "query": {
             "bool": {
                 "should": should_conditions,
                 "minimum_should_match": 1
             }
+        },
+        "_source": source_fields(fetch_embeddings)
+    }
+
+def entity_filter(entities):
+    return {
+        "bool": {
+            "should": [
+                {"match_phrase": {"content": entity}}
+                for entity in entities
+            ],
+            "minimum_should_match": 1
         }
     }
 
-    response = es.search(index="documents", body=query_body)
+def text_match_query(entities, limit=100, fetch_embeddings=True):
+    return {
+        "query": entity_filter(entities),
+        "size": limit,
+        "_source": source_fields(fetch_embeddings)
+    }
+
+def knn_query(query_vector, entities=None, k=10, num_candidates=100):
+    # Approximate nearest neighbours of a question embedding on the stored doc embeddings, optionally only among docs mentioning an entity
+    knn = {
+        "field": "embedding",
+        "query_vector": [float(value) for value in query_vector],
+        "k": k,
+        "num_candidates": max(num_candidates, k)
+    }
+    if entities:
+        knn["filter"] = entity_filter(entities)
+    return {
+        "knn": knn,
+        "size": k,
+        "_source": source_fields(fetch_embeddings=False)
+    }
 
+def as_vector(embedding):
+    # Dense embeddings from ES are held as float32 arrays instead of lists of Python floats
+    return np.asarray(embedding, dtype=np.float32) if embedding is not None else None
+
+def title_match_hits_to_docs(hits, queries):
     docs = []
-    for hit in response['hits']['hits']:
+    for hit in hits:
         id = hit['_id']
         doc_id = hit['_source']['doc_id']
         text = hit['_source']['content']
-        embedding = hit['_source']['embedding']
+        embedding = as_vector(hit['_source'].get('embedding'))
         docs.append({"id" : id, "doc_id" : doc_id, "entity" : [query for query in queries if queries], "text" : text, "embedding" : embedding})
     return docs
 
-
-def text_match_search(entities, es, limit=100):
-    # Retrieve documents from db containing query
-    query_body = {
-        "query": {
-            "bool": {
-                "should": [
-                    {"match_phrase": {"content": entity}}
-                    for entity in entities
-                ],
-                "minimum_should_match": 1
-            }
-        },
-        "size": limit
-    }
-
-    response = es.search(index="documents", body=query_body)
-    rows = response['hits']['hits']
-
-    # Return empty list if no documents found
-    if len(rows) == 0:
-        return []
-    
-    # Add to docs
+def text_match_hits_to_docs(hits, entities):
     docs = []
-    for hit in rows:
+    for hit in hits:
         id = hit['_id']
         doc_id = hit['_source']['doc_id']
         text = hit['_source']['content']
-        embedding = hit['_source']['embedding']
+        embedding = as_vector(hit['_source'].get('embedding'))
         docs.append({"id" : id, "doc_id" : doc_id, "entity" : entities, "text" : text, "embedding" : embedding, "score": 0, "method": "text_match"})
     return docs
 
+# Retrieve documents with exact title match inc. docs with disambiguation in title
+def title_match_search(queries, es, fetch_embeddings=True):
+    response = es.search(index="documents", body=title_match_query(queries, fetch_embeddings))
+    return title_match_hits_to_docs(response['hits']['hits'], queries)
+
+
+def text_match_search(entities, es, limit=100, fetch_embeddings=True):
+    # Retrieve documents from db containing query
+    response = es.search(index="documents", body=text_match_query(entities, limit, fetch_embeddings))
+    return text_match_hits_to_docs(response['hits']['hits'], entities)
+
+# Run title and text match searches in a single multi-search round trip
+def title_and_text_match_search(entities, es, limit=100, fetch_embeddings=True):
+    searches = [
+        {"index": "documents"}, title_match_query(entities, fetch_embeddings),
+        {"index": "documents"}, text_match_query(entities, limit, fetch_embeddings)
+    ]
+    title_response, text_response = es.msearch(searches=searches)['responses']
+    for response in (title_response, text_response):
+        if 'error' in response:
+            raise RuntimeError("Elasticsearch multi-search failed: " + str(response['error']))
+
+    title_match_docs = title_match_hits_to_docs(title_response['hits']['hits'], entities)
+    textually_matched_docs = text_match_hits_to_docs(text_response['hits']['hits'], entities)
+    return title_match_docs, textually_matched_docs
+
+# Doc id and ES similarity score of a kNN hit, scored like a DPR result
+KnnResult = namedtuple("KnnResult", ["id", "score"])
+
+# kNN search for every question in a single multi-search round trip, returns the hit docs (first hit for each id, without embeddings) and every hit's score
+def knn_search(query_vectors, es, entities=None, k=10, num_candidates=100):
+    searches = []
+    for query_vector in query_vectors:
+        searches.extend([{"index": "documents"}, knn_query(query_vector, entities, k, num_candidates)])
+    if not searches:
+        return [], []
+    responses = es.msearch(searches=searches)['responses']
+
+    docs = {}
+    results = []
+    for response in responses:
+        if 'error' in response:
+            raise RuntimeError("Elasticsearch kNN search failed: " + str(response['error']))
+        for hit in response['hits']['hits']:
+            results.append(KnnResult(hit['_id'], hit['_score']))
+            if hit['_id'] not in docs:
+                docs[hit['_id']] = {"id": hit['_id'], "doc_id": hit['_source']['doc_id'], "entity": entities, "text": hit['_source']['content'], "embedding": None, "score": 0, "method": "knn"}
+    return list(docs.values()), results
+
+# Fetch embeddings only for docs that are missing them, e.g. after a search without embeddings
+def fetch_embeddings(docs, es):
+    ids = list({doc['id'] for doc in docs if doc.get('embedding') is None})
+    if not ids:
+        return docs
+
+    response = es.mget(index="documents", ids=ids, source=["embedding"])
+    embeddings = {hit['_id']: as_vector(hit['_source']['embedding']) for hit in response['docs'] if hit.get('found')}
+    for doc in docs:
+        if doc.get('embedding') is None:
+            doc['embedding'] = embeddings.get(doc['id'])
+    return docs
+
 # Score title matched and disambiguated docs
-def score_docs(docs, query, nlp):
-    # Disambiguate documents with disambiguation in title e.g. "Frederick Trump (businessman)"
+DISAMBIGUATION_PATTERN = re.compile(r'\-LRB\-(.+)\-RRB\-')
+
+# spaCy vectors of disambiguation phrases, the same few like "film" or "band" come up for many titles
+class PhraseVectors:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, nlp, phrases, batch_size=64):
+        # (len(phrases), dim) matrix, running the phrases not seen before through nlp.pipe in batches
+        # Cached vectors are taken in the first locked section, another call may evict them before the second
+        with self.lock:
+            found = {}
+            missing = []
+            for phrase in dict.fromkeys(phrases):
+                if phrase in self.vectors:
+                    found[phrase] = self.vectors[phrase]
+                    self.vectors.move_to_end(phrase)
+                else:
+                    missing.append(phrase)
+            self.hits += len(phrases) - len(missing)
+            self.misses += len(missing)
+        found.update((phrase, doc.vector) for phrase, doc in zip(missing, nlp.pipe(missing, batch_size=batch_size)))
+
+        with self.lock:
+            for phrase in missing:
+                self.vectors[phrase] = found[phrase]
+            while len(self.vectors) > self.max_size:
+                self.vectors.popitem(last=False)
+        return np.stack([found[phrase] for phrase in phrases])
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.vectors), "hits": self.hits, "misses": self.misses}
+
+def score_docs(docs, query, nlp, phrase_vectors=None):
+    # Split into exact title matches and docs with disambiguation in title e.g. "Frederick Trump (businessman)"
+    exact_docs = []
     disambiguated_docs = []
+    phrases = []
     for doc in docs:
-        doc_id = doc['doc_id']
-        pattern = r'\-LRB\-.+\-RRB\-'
-
-        if re.search(pattern, doc_id):
-                disambiguated_docs.append(doc)
-                docs = [d for d in docs if d['doc_id'] != doc_id]
-
-    # Score disambiguated docs by cosine similarity between disambiguated info and query
-    for doc in disambiguated_docs:
-        doc_id = doc['doc_id']
-    
-        pattern = r'\-LRB\-(.+)\-RRB\-'
-        info = re.search(pattern, doc_id).group(1)
-        info = info.replace('_', ' ')
-
-        nlp_info = nlp(info)
-        nlp_query = nlp(query)
-        score = nlp_info.similarity(nlp_query)
-        doc['score'] = score
-        doc['method'] = "disambiguation"
+        match = DISAMBIGUATION_PATTERN.search(doc['doc_id'])
+        if match:
+            disambiguated_docs.append(doc)
+            phrases.append(match.group(1).replace('_', ' '))
+        else:
+            exact_docs.append(doc)
+
+    # Score disambiguated docs by cosine similarity between disambiguated info and query, the query is parsed once
+    if disambiguated_docs:
+        query_vector = nlp(query).vector
+        if phrase_vectors is not None:
+            info_vectors = phrase_vectors.get(nlp, phrases)
+        else:
+            info_vectors = np.stack([info.vector for info in nlp.pipe(phrases, batch_size=64)])
+        norms = np.linalg.norm(info_vectors, axis=1) * np.linalg.norm(query_vector)
+        # Like Doc.similarity a zero vector scores 0
+        scores = np.divide(info_vectors @ query_vector, norms, out=np.zeros(len(phrases), dtype=np.float32), where=norms > 0)
+        for doc, score in zip(disambiguated_docs, scores):
+            doc['score'] = float(score)
+            doc['method'] = "disambiguation"
 
     # Score exact match docs with 1
-    for doc in docs:
+    for doc in exact_docs:
         doc['score'] = 1
         doc['method'] = "title_match"
 
     # Combine exact match and disambiguated docs
-    docs = docs + disambiguated_docs
-    return docs
+    return exact_docs + disambiguated_docs
 
-def extract_answers(pipe, context):
-    input = "extract answers: <ha> " + context + " <ha>"
-    output = pipe(input)
+def answer_extraction_prompt(context):
+    return "extract answers: <ha> " + context + " <ha>"
+
+def extract_answers(pipe, context, output=None):
+    # Generate answers, unless the generated output was already batched with other prompts
+    if output is None:
+        output = pipe(answer_extraction_prompt(context))
 
     focals = []
     answers = output[0]['generated_text'].split("<sep>")
@@ -119,47 +245,89 @@ def extract_answers(pipe, context):
             focals.append({'focal': answer.strip(), 'type': "ANSWER"})
     return focals
 
+def question_generation_prompt(focal_point, claim):
+    return "answer: " + focal_point + " context: " + claim
+
+def parse_generated_question(output):
+    return output['generated_text'].replace("question: ", "")
+
 def extract_questions(nlp, focal_point, claim):
-    question_generation_string = "answer: " + focal_point + " context: " + claim
-    question_generation_output = nlp(question_generation_string)
-    question = question_generation_output[0]['generated_text'].replace("question: ", "")
+    question_generation_output = nlp(question_generation_prompt(focal_point, claim))
+    question = parse_generated_question(question_generation_output[0])
     return question
 
-def extract_polar_questions(nlp, pipe, claim):
+def polar_question_drafts(nlp, claim):
+    # Rearrange each sentence of the claim into a yes/no question, None where it has to be generated instead
     doc = nlp(claim)
-    questions = []
+    drafts = []
 
     for sentence in doc.sents:
-        altered = False
+        question = None
         for token in sentence:
             if token.dep_ == "ROOT":
                 if token.pos_ == "AUX":
                     # remove the auxiliary verb and add to the beginning of the sentence
                     question = sentence.text.replace(token.text, "")
                     question = token.text + " " + question
-                    altered = True
                 elif token.pos_ == "VERB":
                     # if there is an auxiliary verb, remove it and add to the beginning of the sentence
                     aux = [child for child in token.children if child.dep_ == "aux"]
                     if aux:
                         question = sentence.text.replace(aux[0].text, "")
                         question = aux[0].text + " " + question
-                        altered = True
-        if not altered:
-            input_string = "answer: " + "No" + " context: " + claim
-            output = pipe(input_string)
-            question = output[0]['generated_text'].replace("question: ", "")
+        drafts.append(question)
+    return drafts
+
+def format_polar_question(question):
+    # capitalize the first letter of the question
+    question = question[0].upper() + question[1:]
+
+    # remove the period at the end of the question if it exists and add a question mark
+    if question[-1] == ".":
+        question = question[:-1] + "?"
+
+    # remove any double spaces
+    question = question.replace("  ", " ")
+    return question
+
+def extract_polar_questions(nlp, pipe, claim):
+    return generate_questions(nlp, pipe, [], claim)[1]
+
+def generate_questions(nlp, pipe, focal_points, claim):
+    # Generate questions for each focal point and the polar questions of the claim through the pipeline as one batch
+    drafts = polar_question_drafts(nlp, claim)
+    polar_prompt = question_generation_prompt("No", claim)
+
+    prompts = [question_generation_prompt(focal_point, claim) for focal_point in focal_points]
+    if None in drafts:
+        prompts.append(polar_prompt)
+    outputs = pipe(prompts) if prompts else []
+
+    questions = [parse_generated_question(output) for output in outputs[:len(focal_points)]]
+    generated_polar = parse_generated_question(outputs[-1]) if None in drafts else None
+    polar_questions = [format_polar_question(draft if draft is not None else generated_polar) for draft in drafts]
+    return questions, polar_questions
 
-        # capitalize the first letter of the question
-        question = question[0].upper() + question[1:]
+# Merge DPR results into the docs to return, keeping the highest score per doc and never returning a doc twice
+def merge_retrieved_docs(return_docs, candidate_docs, results, threshold):
+    # Index candidates by ES id, the first candidate with a given id is kept
+    candidates_by_id = {}
+    for doc in candidate_docs:
+        candidates_by_id.setdefault(doc['id'], doc)
 
-        # remove the period at the end of the question if it exists and add a question mark
-        if question[-1] == ".":
-            question = question[:-1] + "?"
+    # Docs already being returned (exact title matches) keep their own score
+    fixed_ids = {doc['id'] for doc in return_docs}
+    return_ids = set(fixed_ids)
 
-        # remove any double spaces
-        question = question.replace("  ", " ")
-        
-        questions.append(question)
+    for result in results:
+        if result.score <= threshold or result.id in fixed_ids:
+            continue
+        doc = candidates_by_id.get(result.id)
+        if doc is None or doc['score'] >= result.score:
+            continue
 
-    return questions
\ No newline at end of file
+        doc['score'] = result.score
+        if doc['id'] not in return_ids:
+            return_ids.add(doc['id'])
+            return_docs.append(doc)
+    return return_docs
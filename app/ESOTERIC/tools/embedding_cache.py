@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Cache of sentence/passage embeddings keyed by a hash of the text, backed by an in-memory LRU and an optional memory-mapped store on disk
+# model_id names the model and inference backend the vectors come from, a store written by another model or dimension is started again
+class EmbeddingCache:
+    def __init__(self, model, max_size=50000, store_dir=None, batch_size=32, model_id=None):
+        self.model = model
+        self.model_id = model_id
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.dim = model.get_sentence_embedding_dimension()
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Setup on-disk store, rows of float32 vectors in one file, the matching text hashes line by line in another and the model they came from in meta.json
+        self.store_dir = store_dir
+        self.disk_index = {}
+        self.disk_vectors = None
+        if self.store_dir:
+            self.vectors_path = os.path.join(self.store_dir, "embeddings.f32")
+            self.index_path = os.path.join(self.store_dir, "index.txt")
+            self.meta_path = os.path.join(self.store_dir, "meta.json")
+            self.open_store()
+            self.map_disk_vectors()
+
+    def open_store(self):
+        meta = {"model": self.model_id, "dim": self.dim}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                stored_meta = json.load(f)
+            if stored_meta != meta:
+                print("Embedding store at " + self.store_dir + " holds " + str(stored_meta) + " vectors, not " + str(meta) + ", starting a new store")
+                os.remove(self.meta_path)
+        elif os.path.exists(self.index_path):
+            print("Embedding store at " + self.store_dir + " has no meta.json, starting a new store")
+
+        if not os.path.exists(self.meta_path):
+            os.makedirs(self.store_dir, exist_ok=True)
+            for path in (self.vectors_path, self.index_path):
+                open(path, "wb").close()
+            temp_path = self.meta_path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(temp_path, self.meta_path)
+
+        # Vectors are appended before their keys, so after a crash either file can have rows the other lacks
+        # Only rows present in both are kept, trimming the files back to them so later appends line up
+        with open(self.index_path, "r") as f:
+            lines = f.read().split("\n")
+        keys = lines[:-1]
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        rows = min(len(keys), os.path.getsize(self.vectors_path) // row_bytes)
+        if rows < len(keys) or lines[-1]:
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, "w") as f:
+                f.writelines(key + "\n" for key in keys[:rows])
+            os.replace(temp_path, self.index_path)
+        if os.path.getsize(self.vectors_path) != rows * row_bytes:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(rows * row_bytes)
+        for row, key in enumerate(keys[:rows]):
+            self.disk_index[key] = row
+
+    def map_disk_vectors(self):
+        if self.disk_index:
+            self.disk_vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.disk_index), self.dim))
+
+    def hash_text(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.disk_index:
+            embedding = np.array(self.disk_vectors[self.disk_index[key]])
+            self.remember(key, embedding)
+            return embedding
+        return None
+
+    def remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def persist(self, keys, embeddings):
+        new = [(key, embedding) for key, embedding in zip(keys, embeddings) if key not in self.disk_index]
+        if not new:
+            return
+        with open(self.vectors_path, "ab") as f:
+            for _, embedding in new:
+                f.write(embedding.astype(np.float32).tobytes())
+        with open(self.index_path, "a") as f:
+            for key, _ in new:
+                self.disk_index[key] = len(self.disk_index)
+                f.write(key + "\n")
+        self.map_disk_vectors()
+
+    def encode(self, texts):
+        # Return a (len(texts), dim) float32 array, only running the model on texts not already cached
+        keys = [self.hash_text(text) for text in texts]
+        embeddings = [None] * len(texts)
+        missing = {}
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                embedding = self.lookup(key)
+                if embedding is not None:
+                    embeddings[i] = embedding
+                    self.hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+
+        if missing:
+            missing_keys = list(missing.keys())
+            missing_texts = [texts[missing[key][0]] for key in missing_keys]
+            encoded = self.model.encode(missing_texts, batch_size=self.batch_size, convert_to_numpy=True).astype(np.float32)
+
+            with self.lock:
+                for key, embedding in zip(missing_keys, encoded):
+                    self.remember(key, embedding)
+                    for i in missing[key]:
+                        embeddings[i] = embedding
+                if self.store_dir:
+                    self.persist(missing_keys, encoded)
+
+        if not embeddings:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack(embeddings)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": len(self.disk_index),
+                "max_size": self.max_size
+            }
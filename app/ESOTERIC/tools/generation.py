@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+# Wraps a text2text-generation pipeline, memoizing outputs per (model, prompt) and sending uncached prompts through as one batch
+class CachedGenerationPipe:
+    def __init__(self, pipe, max_size=2048, batch_size=8):
+        self.pipe = pipe
+        self.model_name = getattr(pipe.model, "name_or_path", None) or pipe.model.config.name_or_path
+        self.max_size = max_size
+        self.batch_size = batch_size
+
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+
+    def __call__(self, inputs):
+        # Same output shape as the pipeline, a list with one dict for a single prompt or one dict per prompt for a list
+        if isinstance(inputs, str):
+            return [self.generate([inputs])[0]]
+        return self.generate(inputs)
+
+    def generate(self, prompts):
+        outputs = [None] * len(prompts)
+        missing = {}
+        with self.lock:
+            for i, prompt in enumerate(prompts):
+                key = (self.model_name, prompt)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    outputs[i] = self.cache[key]
+                    self.hits += 1
+                else:
+                    missing.setdefault(prompt, []).append(i)
+                    self.misses += 1
+
+        if missing:
+            missing_prompts = list(missing.keys())
+            results = self.pipe(missing_prompts, batch_size=self.batch_size)
+            with self.lock:
+                self.calls += 1
+                for prompt, result in zip(missing_prompts, results):
+                    self.cache[(self.model_name, prompt)] = result
+                    for i in missing[prompt]:
+                        outputs[i] = result
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        return outputs
+
+    def stats(self):
+        with self.lock:
+            return {"model": self.model_name, "hits": self.hits, "misses": self.misses, "pipeline_calls": self.calls, "entries": len(self.cache)}
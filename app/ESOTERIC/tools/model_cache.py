@@ -0,0 +1,121 @@
+import os
+import re
+import shutil
+
+# Local serialized copies of the hub models, saved on first load so later starts read them straight from disk without resolving the hub
+# Models run on an inference backend, full precision pytorch, pytorch with dynamic int8 quantization of the linear layers, or ONNX Runtime
+
+INFERENCE_BACKENDS = ("pytorch", "quantized", "onnx")
+
+# ONNX Runtime model class for each pipeline task
+ONNX_MODEL_CLASSES = {
+    "token-classification": "ORTModelForTokenClassification",
+    "text2text-generation": "ORTModelForSeq2SeqLM",
+    "text-classification": "ORTModelForSequenceClassification"
+}
+
+def local_model_path(cache_dir, model_name):
+    return os.path.join(cache_dir, re.sub(r"[^\w.-]", "--", model_name))
+
+def save_atomically(path, save):
+    # Save into a temporary directory first so an interrupted save never leaves a half-written model behind
+    temp_path = path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    save(temp_path)
+    os.replace(temp_path, path)
+
+def check_backend(backend):
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError("Unknown inference backend '" + str(backend) + "', expected one of " + ", ".join(INFERENCE_BACKENDS))
+
+def quantize(model):
+    # Dynamic int8 quantization, weights of linear layers are stored as int8 and activations quantized on the fly
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_pipeline(task, model, cache_dir=None, backend="pytorch", **kwargs):
+    from transformers import pipeline
+
+    check_backend(backend)
+    if backend == "onnx":
+        return load_onnx_pipeline(task, model, cache_dir, **kwargs)
+
+    if not cache_dir:
+        pipe = pipeline(task, model=model, **kwargs)
+    else:
+        path = local_model_path(cache_dir, model)
+        if os.path.isdir(path):
+            pipe = pipeline(task, model=path, tokenizer=path, **kwargs)
+        else:
+            pipe = pipeline(task, model=model, **kwargs)
+            save_atomically(path, pipe.save_pretrained)
+
+    if backend == "quantized":
+        pipe.model = quantize(pipe.model)
+    return pipe
+
+def load_onnx_pipeline(task, model, cache_dir=None, **kwargs):
+    # Export the model to ONNX on first load, the export is kept in the cache dir when one is given
+    try:
+        import optimum.onnxruntime
+    except ImportError:
+        raise ImportError("The onnx inference backend needs optimum[onnxruntime] installed, pip install -r requirements-onnx.txt")
+    from transformers import pipeline, AutoTokenizer
+
+    model_class = getattr(optimum.onnxruntime, ONNX_MODEL_CLASSES[task])
+    path = local_model_path(cache_dir, model + "-onnx") if cache_dir else None
+    if path and os.path.isdir(path):
+        onnx_model = model_class.from_pretrained(path)
+        tokenizer = AutoTokenizer.from_pretrained(path)
+    else:
+        onnx_model = model_class.from_pretrained(model, export=True)
+        tokenizer = AutoTokenizer.from_pretrained(model)
+        if path:
+            def save(temp_path):
+                onnx_model.save_pretrained(temp_path)
+                tokenizer.save_pretrained(temp_path)
+            save_atomically(path, save)
+    return pipeline(task, model=onnx_model, tokenizer=tokenizer, **kwargs)
+
+def load_sentence_transformer(model, cache_dir=None, backend="pytorch"):
+    from sentence_transformers import SentenceTransformer
+
+    check_backend(backend)
+    if not cache_dir:
+        sentence_model = SentenceTransformer(model)
+    else:
+        path = local_model_path(cache_dir, model)
+        if os.path.isdir(path):
+            sentence_model = SentenceTransformer(path)
+        else:
+            sentence_model = SentenceTransformer(model)
+            save_atomically(path, sentence_model.save)
+
+    # This sentence-transformers version has no ONNX backend, so the onnx option quantizes the similarity model instead
+    if backend in ("quantized", "onnx"):
+        sentence_model = quantize(sentence_model)
+    return sentence_model
+
+def load_dpr(query_embedding_model, passage_embedding_model, cache_dir=None, **kwargs):
+    from haystack.nodes import DensePassageRetriever
+
+    if not cache_dir:
+        return DensePassageRetriever(document_store=None, query_embedding_model=query_embedding_model, passage_embedding_model=passage_embedding_model, **kwargs)
+    path = local_model_path(cache_dir, query_embedding_model + "+" + passage_embedding_model)
+    if os.path.isdir(path):
+        return DensePassageRetriever.load(load_dir=path, document_store=None, **kwargs)
+    retriever = DensePassageRetriever(document_store=None, query_embedding_model=query_embedding_model, passage_embedding_model=passage_embedding_model, **kwargs)
+    save_atomically(path, retriever.save)
+    return retriever
+
+def load_farm_reader(model, cache_dir=None, **kwargs):
+    from haystack.nodes import FARMReader
+
+    if not cache_dir:
+        return FARMReader(model_name_or_path=model, **kwargs)
+    path = local_model_path(cache_dir, model)
+    if os.path.isdir(path):
+        return FARMReader(model_name_or_path=path, **kwargs)
+    reader = FARMReader(model_name_or_path=model, **kwargs)
+    save_atomically(path, reader.save)
+    return reader
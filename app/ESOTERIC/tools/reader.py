@@ -0,0 +1,9 @@
+# Reading comprehension answers for several questions over the same documents in one batched reader pass
+
+def read_answers(reader, questions, documents, top_k=30):
+    # Every question is paired with the full document list, so predict_batch returns one answer list per question ranked across all documents
+    # A flat document list would instead have each question answered against each document separately, top_k answers per document
+    if not questions:
+        return []
+    results = reader.predict_batch(queries=questions, documents=[documents] * len(questions), top_k=top_k)
+    return [(question, answer) for question, question_answers in zip(questions, results['answers']) for answer in question_answers if answer.context]
@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+# Precomputed sentence boundaries and normalized sentence embeddings per Elasticsearch document
+# Stored as flat arrays on disk, sentence rows of (start, end) offsets and float32 vectors, with each doc's row range listed line by line
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def normalize_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1, norms)
+
+def split_sentences(nlp, texts, batch_size=64):
+    # Sentence (start, end) character offsets for each text, exact so no searching the text afterwards
+    return [[(sentence.start_char, sentence.end_char) for sentence in doc.sents] for doc in nlp.pipe(texts, batch_size=batch_size)]
+
+class SentenceIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.backend = meta.get("backend")
+        self.sentence_count = meta["sentences"]
+
+        # ES id to (content hash, first row, sentence count)
+        self.docs = {}
+        with open(os.path.join(index_dir, "docs.txt"), "r") as f:
+            for line in f:
+                id, text_hash, first_row, count = line.rstrip("\n").split("\t")
+                self.docs[id] = (text_hash, int(first_row), int(count))
+
+        if self.sentence_count:
+            self.spans = np.memmap(os.path.join(index_dir, "spans.i32"), dtype=np.int32, mode="r", shape=(self.sentence_count, 2))
+            self.embeddings = np.memmap(os.path.join(index_dir, "embeddings.f32"), dtype=np.float32, mode="r", shape=(self.sentence_count, self.dim))
+        else:
+            self.spans = np.zeros((0, 2), dtype=np.int32)
+            self.embeddings = np.zeros((0, self.dim), dtype=np.float32)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def lookup(self, id, text):
+        # (spans, embeddings) for a doc, None if it isn't indexed or its text has changed since indexing
+        entry = self.docs.get(id)
+        if entry is None or entry[0] != content_hash(text):
+            with self.lock:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.stale += 1
+            return None
+        _, first_row, count = entry
+        with self.lock:
+            self.hits += 1
+        return np.asarray(self.spans[first_row:first_row + count]), np.asarray(self.embeddings[first_row:first_row + count])
+
+    def stats(self):
+        with self.lock:
+            return {"docs": len(self.docs), "sentences": self.sentence_count, "hits": self.hits, "misses": self.misses, "stale": self.stale}
+
+def build_sentence_index(docs, nlp, encode, index_dir, dim, backend=None, batch_size=256):
+    # Index (id, text) docs, encode maps a list of sentences to a (n, dim) array
+    # Written to a temporary directory first so a crashed build never replaces a working index
+    temp_dir = index_dir.rstrip("/\\") + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    doc_count = 0
+    sentence_count = 0
+    with open(os.path.join(temp_dir, "docs.txt"), "w") as docs_file, open(os.path.join(temp_dir, "spans.i32"), "wb") as spans_file, open(os.path.join(temp_dir, "embeddings.f32"), "wb") as embeddings_file:
+        def flush(batch):
+            nonlocal doc_count, sentence_count
+            ids, texts = zip(*batch)
+            doc_spans = split_sentences(nlp, texts)
+            sentences = [text[start:end] for text, spans in zip(texts, doc_spans) for start, end in spans]
+            embeddings = normalize_rows(encode(sentences)) if sentences else np.zeros((0, dim), dtype=np.float32)
+
+            for id, text, spans in zip(ids, texts, doc_spans):
+                docs_file.write(id + "\t" + content_hash(text) + "\t" + str(sentence_count) + "\t" + str(len(spans)) + "\n")
+                sentence_count += len(spans)
+                if spans:
+                    spans_file.write(np.array(spans, dtype=np.int32).tobytes())
+            embeddings_file.write(embeddings.astype(np.float32).tobytes())
+            doc_count += len(batch)
+            print("Indexed " + str(doc_count) + " docs, " + str(sentence_count) + " sentences")
+
+        batch = []
+        for id, text in docs:
+            batch.append((id, text))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+    with open(os.path.join(temp_dir, "meta.json"), "w") as f:
+        json.dump({"dim": dim, "backend": backend, "docs": doc_count, "sentences": sentence_count}, f)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(temp_dir, index_dir)
+    return doc_count, sentence_count
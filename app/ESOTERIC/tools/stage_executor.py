@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class Stage:
+    def __init__(self, name, func, after=()):
+        # func is called with the results of the stages in after, in that order
+        self.name = name
+        self.func = func
+        self.after = list(after)
+
+# Runs a claim's stages as soon as the stages they depend on have finished, up to max_workers at a time
+# Each stage is timed under the caller's current metrics stage, and the chain of stages that bounded the total time is reported as the critical path
+class StageExecutor:
+    def __init__(self, metrics, max_workers=1):
+        self.metrics = metrics
+        self.max_workers = max_workers
+
+    def check(self, stages):
+        # Every stage must be able to run: unique names, dependencies that exist and no cycles
+        stages_by_name = {}
+        for stage in stages:
+            if stage.name in stages_by_name:
+                raise ValueError("Stage '" + stage.name + "' is defined more than once")
+            stages_by_name[stage.name] = stage
+        for stage in stages:
+            missing = [name for name in stage.after if name not in stages_by_name]
+            if missing:
+                raise ValueError("Stage '" + stage.name + "' depends on stages that don't exist: " + ", ".join(missing))
+
+        resolved = set()
+        pending = list(stages)
+        while pending:
+            ready = [stage for stage in pending if all(name in resolved for name in stage.after)]
+            if not ready:
+                raise ValueError("Stages " + ", ".join("'" + stage.name + "'" for stage in pending) + " can't run, their dependencies form a cycle")
+            for stage in ready:
+                pending.remove(stage)
+                resolved.add(stage.name)
+        return stages_by_name
+
+    def run(self, stages, task_id=None):
+        stages_by_name = self.check(stages)
+        parent_stack = self.metrics.current_stack()
+        results = {}
+        times = {}
+        start = time.perf_counter()
+
+        def run_stage(stage):
+            # Stages run on pool threads, so they're nested under the caller's stages explicitly
+            with self.metrics.nested(parent_stack):
+                stage_start = time.perf_counter() - start
+                with self.metrics.stage(task_id, stage.name):
+                    result = stage.func(*[results[name] for name in stage.after])
+                return result, stage_start, time.perf_counter() - start
+
+        pending = list(stages)
+        if self.max_workers <= 1:
+            # Run in dependency order on the calling thread
+            while pending:
+                stage = next(stage for stage in pending if all(name in results for name in stage.after))
+                pending.remove(stage)
+                results[stage.name], stage_start, stage_end = run_stage(stage)
+                times[stage.name] = (stage_start, stage_end)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stage") as pool:
+                running = {}
+                try:
+                    while pending or running:
+                        for stage in [stage for stage in pending if all(name in results for name in stage.after)]:
+                            pending.remove(stage)
+                            running[pool.submit(run_stage, stage)] = stage
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            stage = running.pop(future)
+                            results[stage.name], stage_start, stage_end = future.result()
+                            times[stage.name] = (stage_start, stage_end)
+                finally:
+                    for future in running:
+                        future.cancel()
+
+        critical_path = self.critical_path(stages_by_name, times)
+        self.metrics.critical_path(task_id, critical_path)
+        return results, critical_path
+
+    def critical_path(self, stages_by_name, times):
+        # Walk back from the last stage to finish through the dependency each stage waited on longest
+        if not times:
+            return {}
+        name = max(times, key=lambda name: times[name][1])
+        path = []
+        while name is not None:
+            stage_start, stage_end = times[name]
+            path.append((name, stage_end - stage_start))
+            after = stages_by_name[name].after
+            name = max(after, key=lambda dependency: times[dependency][1]) if after else None
+        return dict(reversed(path))
@@ -1,14 +1,32 @@
 from flask import Flask
 from dotenv import load_dotenv
+from multiprocessing import parent_process
 
 import os
+import time
+import numpy as np
+
+# Startup timings, from importing the app to it being created and to the first request it serves
+startup = {"started": time.perf_counter(), "app_created_seconds": None, "first_request_seconds": None}
 
 load_dotenv()
 
 # Create the Flask app
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
-progress_store = {}
+
+# Store task progress with expiry and size limits
+from app.progress import ProgressStore
+progress_store = ProgressStore(
+    ttl=int(os.getenv("PROGRESS_TTL", 3600)),
+    max_entries=int(os.getenv("PROGRESS_MAX_ENTRIES", 1000)),
+    max_log_entries=int(os.getenv("PROGRESS_MAX_LOG_ENTRIES", 200))
+)
+
+# Collect stage timings and counters per task, optionally shown with each task's progress
+from app.metrics import Metrics
+metrics = Metrics(max_tasks=int(os.getenv("METRICS_MAX_TASKS", 200)))
+metrics_in_progress = os.getenv("METRICS_IN_PROGRESS", "false").lower() == "true"
 
 # Specify parameters for evidence retrieval using environment variables
 title_match_docs_limit = int(os.getenv("TITLE_MATCH_DOCS_LIMIT"))
@@ -16,16 +34,145 @@ text_match_search_db_limit = int(os.getenv("TEXT_MATCH_SEARCH_DB_LIMIT"))
 title_match_search_threshold = float(os.getenv("TITLE_MATCH_SEARCH_THRESHOLD"))
 answerability_threshold = float(os.getenv("ANSWERABILITY_THRESHOLD"))
 reader_threshold = float(os.getenv("READER_THRESHOLD"))
+relevance_batch_size = int(os.getenv("RELEVANCE_BATCH_SIZE", 32))
+embedding_cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", 50000))
+# With EVIDENCE_WORKERS>0 each worker process keeps its store in its own worker-<n> subdirectory
+embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+lazy_embeddings = os.getenv("LAZY_EMBEDDINGS", "false").lower() == "true"
+generation_cache_size = int(os.getenv("GENERATION_CACHE_SIZE", 2048))
+
+# MODEL_LOADING=background serves pages straight away while models load on MODEL_LOAD_WORKERS threads, claims wait until they're ready
+background_loading = os.getenv("MODEL_LOADING", "eager").lower() == "background"
+model_load_workers = int(os.getenv("MODEL_LOAD_WORKERS", 1))
+model_cache_dir = os.getenv("MODEL_CACHE_DIR")
+
+# Backend for the transformer models, pytorch (full precision), quantized (dynamic int8) or onnx (ONNX Runtime, needs optimum)
+inference_backend = os.getenv("INFERENCE_BACKEND", "pytorch").lower()
+
+# Precomputed sentence offsets and embeddings, built with build_sentence_index.py
+sentence_index_dir = os.getenv("SENTENCE_INDEX_DIR")
+
+# PASSAGE_STREAMING=true publishes passages as they're found, stopping after PASSAGE_TOP_K passages scoring at least PASSAGE_CONFIDENCE or PASSAGE_TIME_BUDGET seconds
+passage_streaming = os.getenv("PASSAGE_STREAMING", "false").lower() == "true"
+passage_top_k = int(os.getenv("PASSAGE_TOP_K", 10))
+passage_confidence = float(os.getenv("PASSAGE_CONFIDENCE", 0.5))
+passage_time_budget = float(os.getenv("PASSAGE_TIME_BUDGET")) if os.getenv("PASSAGE_TIME_BUDGET") else None
+passage_chunk_docs = int(os.getenv("PASSAGE_CHUNK_DOCS", 4))
 
-# Load evidence retriever
-from app.ESOTERIC.evidence_retrieval import EvidenceRetriever
-evidence_retriever = EvidenceRetriever(
+# Docs whose BM25 tokenization is kept across claims when passages are ranked without the relevance model
+bm25_cache_docs = int(os.getenv("BM25_CACHE_DOCS", 5000))
+
+# Document retrieval stages of one claim run at the same time where they don't depend on each other, up to STAGE_CONCURRENCY
+stage_concurrency = int(os.getenv("STAGE_CONCURRENCY", 1))
+
+# RETRIEVAL_MODE=knn finds candidate docs with Elasticsearch kNN queries on the stored embeddings instead of scoring text matches with DPR in memory
+# KNN_K nearest docs per question out of KNN_NUM_CANDIDATES, among docs mentioning an entity unless KNN_FILTER_ENTITIES=false, scoring above KNN_THRESHOLD
+# KNN_THRESHOLD is on Elasticsearch's (1 + cosine) / 2 scale, where every hit scores above 0
+retrieval_mode = os.getenv("RETRIEVAL_MODE", "local").lower()
+knn_k = int(os.getenv("KNN_K", 10))
+knn_num_candidates = int(os.getenv("KNN_NUM_CANDIDATES", 100))
+knn_filter_entities = os.getenv("KNN_FILTER_ENTITIES", "true").lower() == "true"
+knn_threshold = float(os.getenv("KNN_THRESHOLD", 0.8))
+
+retriever_kwargs = dict(
     title_match_docs_limit=title_match_docs_limit,
     text_match_search_db_limit=text_match_search_db_limit,
     title_match_search_threshold=title_match_search_threshold,
     answerability_threshold=answerability_threshold,
-    reader_threshold=reader_threshold
+    reader_threshold=reader_threshold,
+    relevance_batch_size=relevance_batch_size,
+    embedding_cache_size=embedding_cache_size,
+    embedding_cache_dir=embedding_cache_dir,
+    lazy_embeddings=lazy_embeddings,
+    generation_cache_size=generation_cache_size,
+    background_loading=background_loading,
+    model_load_workers=model_load_workers,
+    model_cache_dir=model_cache_dir,
+    inference_backend=inference_backend,
+    sentence_index_dir=sentence_index_dir,
+    passage_streaming=passage_streaming,
+    passage_top_k=passage_top_k,
+    passage_confidence=passage_confidence,
+    passage_time_budget=passage_time_budget,
+    passage_chunk_docs=passage_chunk_docs,
+    bm25_cache_docs=bm25_cache_docs,
+    stage_concurrency=stage_concurrency,
+    retrieval_mode=retrieval_mode,
+    knn_k=knn_k,
+    knn_num_candidates=knn_num_candidates,
+    knn_filter_entities=knn_filter_entities,
+    knn_threshold=knn_threshold
 )
-print("App created")
 
-from app import routes
\ No newline at end of file
+# Number of model-serving worker processes, 0 keeps the models inside the Flask process
+evidence_workers = int(os.getenv("EVIDENCE_WORKERS", 0))
+
+# Worker processes import this package too, only the main process loads the retriever and serves the app
+if parent_process() is None:
+    # Load evidence retriever, RETRIEVER_FACTORY ("module:function") swaps in another retriever e.g. stand-in models for benchmarks
+    retriever_factory = os.getenv("RETRIEVER_FACTORY")
+    if retriever_factory:
+        import importlib
+        factory_module, factory_name = retriever_factory.split(":")
+        evidence_retriever = getattr(importlib.import_module(factory_module), factory_name)(**retriever_kwargs)
+    elif evidence_workers > 0:
+        from app.ESOTERIC.process_retrieval import ProcessEvidenceRetriever
+        evidence_retriever = ProcessEvidenceRetriever(workers=evidence_workers, job_timeout=float(os.getenv("EVIDENCE_JOB_TIMEOUT", 600)), **retriever_kwargs)
+    else:
+        from app.ESOTERIC.evidence_retrieval import EvidenceRetriever
+        evidence_retriever = EvidenceRetriever(**retriever_kwargs)
+
+    # Run claims on a fixed pool of workers with a bounded queue
+    from app.jobs import JobQueue
+    job_queue = JobQueue(
+        workers=int(os.getenv("JOB_WORKERS", evidence_workers or 2)),
+        max_queue_size=int(os.getenv("JOB_QUEUE_SIZE", 20))
+    )
+    # Verdicts from a chat completions API over a pooled session, VERDICT_BACKEND ("module:function") swaps in another backend
+    from app.verdict import ChatCompletionsBackend, VerdictClient
+    verdict_backend_factory = os.getenv("VERDICT_BACKEND")
+    if verdict_backend_factory:
+        import importlib
+        factory_module, factory_name = verdict_backend_factory.split(":")
+        verdict_backend = getattr(importlib.import_module(factory_module), factory_name)()
+    else:
+        verdict_backend = ChatCompletionsBackend(
+            url=os.getenv("MISTRAL_API_URL", "https://api.mistral.ai/v1/chat/completions"),
+            api_key=os.getenv("MISTRAL_KEY"),
+            model=os.getenv("VERDICT_MODEL", "mistral-small-latest"),
+            connect_timeout=float(os.getenv("VERDICT_CONNECT_TIMEOUT", 5)),
+            read_timeout=float(os.getenv("VERDICT_READ_TIMEOUT", 60)),
+            total_timeout=float(os.getenv("VERDICT_TOTAL_TIMEOUT", 120)),
+            retries=int(os.getenv("VERDICT_RETRIES", 2)),
+            backoff=float(os.getenv("VERDICT_BACKOFF", 0.5)),
+            streaming=os.getenv("VERDICT_STREAMING", "true").lower() == "true",
+            pool_size=len(job_queue.workers)
+        )
+    verdict_client = VerdictClient(verdict_backend, cache_size=int(os.getenv("VERDICT_CACHE_SIZE", 512)))
+
+    # Cache finished results per claim, near-duplicate lookup needs the in-process similarity model
+    from app.claim_cache import ClaimCache
+    def encode_claim(claim):
+        embedding = evidence_retriever.embedding_cache.encode([claim])[0]
+        return embedding / np.linalg.norm(embedding)
+    claim_similarity_threshold = os.getenv("CLAIM_CACHE_SIMILARITY")
+    # Only settings that change a claim's results are in the cache fingerprint, so changing cache sizes, directories or batching keeps cached results
+    result_settings = ("title_match_docs_limit", "text_match_search_db_limit", "title_match_search_threshold", "answerability_threshold", "reader_threshold",
+                       "inference_backend", "passage_streaming", "passage_top_k", "passage_confidence", "passage_time_budget", "passage_chunk_docs",
+                       "retrieval_mode", "knn_k", "knn_num_candidates", "knn_filter_entities", "knn_threshold")
+    claim_cache_config = {name: retriever_kwargs[name] for name in result_settings}
+    claim_cache = ClaimCache(
+        config=dict(claim_cache_config, use_relevancy_model=getattr(evidence_retriever, "use_relevancy_model", True), verdict_model=getattr(verdict_backend, "model", None)),
+        max_size=int(os.getenv("CLAIM_CACHE_SIZE", 500)),
+        ttl=int(os.getenv("CLAIM_CACHE_TTL", 86400)),
+        path=os.getenv("CLAIM_CACHE_PATH"),
+        encode=encode_claim if hasattr(evidence_retriever, "embedding_cache") else None,
+        similarity_threshold=float(claim_similarity_threshold) if claim_similarity_threshold else None,
+        ready=lambda: evidence_retriever.readiness()["ready"],
+        save_interval=float(os.getenv("CLAIM_CACHE_SAVE_INTERVAL", 30))
+    )
+
+    startup["app_created_seconds"] = time.perf_counter() - startup["started"]
+    print("App created in {:.2f}s".format(startup["app_created_seconds"]))
+
+    from app import routes
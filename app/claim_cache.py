@@ -0,0 +1,145 @@
+import os
+import copy
+import json
+import time
+import hashlib
+import atexit
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def normalize_claim(claim):
+    # Case and whitespace insensitive, ignoring trailing punctuation
+    claim = " ".join(claim.lower().split())
+    return claim.rstrip(".!?")
+
+def config_fingerprint(config):
+    # Hash of the retrieval settings results were produced with
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# Cache of finished task results keyed on the normalized claim, with optional near-duplicate lookup by claim embedding
+class ClaimCache:
+    def __init__(self, config, max_size=500, ttl=86400, path=None, encode=None, similarity_threshold=None, ready=None, save_interval=30):
+        self.fingerprint = config_fingerprint(config)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.encode = encode if similarity_threshold else None
+        self.similarity_threshold = similarity_threshold
+        # Near-duplicate lookups are skipped until ready() is true, so requests don't wait on the similarity model loading
+        self.ready = ready
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+        # Changes are written to disk every save_interval seconds and on exit, rather than on every put
+        self.save_interval = save_interval
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        if self.path:
+            self.load()
+            threading.Thread(target=self.save_periodically, name="claim-cache-saver", daemon=True).start()
+            atexit.register(self.save)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            stored = json.load(f)
+
+        # Results produced with different retrieval settings are discarded
+        if stored.get("fingerprint") != self.fingerprint:
+            print("Claim cache settings changed, discarding " + str(len(stored.get("entries", []))) + " cached results")
+            return
+        for entry in stored.get("entries", []):
+            self.entries[entry["key"]] = entry
+        self.expire()
+
+    def save(self):
+        # Entries are snapshotted under the lock and written outside it
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries = list(self.entries.values())
+                self.dirty = False
+
+            # Write to a temporary file first so a crash never leaves a half-written cache
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump({"fingerprint": self.fingerprint, "entries": entries}, f)
+            os.replace(temp_path, self.path)
+
+    def save_periodically(self):
+        while True:
+            time.sleep(self.save_interval)
+            try:
+                self.save()
+            except OSError as e:
+                print("Failed to save claim cache: " + str(e))
+
+    def encoder_ready(self):
+        return self.encode is not None and (self.ready is None or self.ready())
+
+    def expire(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]:
+            del self.entries[key]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, claim):
+        if self.max_size <= 0:
+            return None
+        key = normalize_claim(claim)
+        with self.lock:
+            self.expire()
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry["result"])
+
+            candidates = [entry for entry in self.entries.values() if entry.get("embedding") is not None]
+
+        # Fall back to the most similar cached claim above the threshold
+        if candidates and self.encoder_ready():
+            embedding = self.encode(claim)
+            embeddings = np.array([entry["embedding"] for entry in candidates], dtype=np.float32)
+            similarities = embeddings @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                with self.lock:
+                    self.near_hits += 1
+                print("Claim cache near-duplicate hit: '" + candidates[best]["claim"] + "' ({:.3f})".format(similarities[best]))
+                return copy.deepcopy(candidates[best]["result"])
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, claim, result):
+        # Results are copied in and out so cached entries never share lists or dicts with live tasks
+        if self.max_size <= 0:
+            return
+        result = copy.deepcopy(result)
+        key = normalize_claim(claim)
+        embedding = self.encode(claim).tolist() if self.encoder_ready() else None
+        with self.lock:
+            self.entries[key] = {"key": key, "claim": claim, "created": time.time(), "embedding": embedding, "result": result}
+            self.entries.move_to_end(key)
+            self.expire()
+            self.dirty = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "near_duplicate_hits": self.near_hits,
+                "misses": self.misses,
+                "max_size": self.max_size
+            }
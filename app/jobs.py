@@ -0,0 +1,62 @@
+import threading
+from collections import deque
+
+class QueueFullError(Exception):
+    pass
+
+# Fixed-size pool of worker threads fed by a bounded job queue
+class JobQueue:
+    def __init__(self, workers=2, max_queue_size=20):
+        self.max_queue_size = max_queue_size
+
+        self.pending = deque()
+        self.running = set()
+        self.condition = threading.Condition()
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, task_id, func, *args):
+        # Queue a job and return its 1-based queue position, rejecting it if the queue is full
+        with self.condition:
+            if len(self.pending) >= self.max_queue_size:
+                raise QueueFullError(f"Job queue is full ({self.max_queue_size} jobs waiting)")
+            self.pending.append((task_id, func, args))
+            self.condition.notify()
+            return len(self.pending)
+
+    def position(self, task_id):
+        # Position of a waiting job in the queue, 0 if it is running or unknown
+        with self.condition:
+            for i, (pending_task_id, _, _) in enumerate(self.pending):
+                if pending_task_id == task_id:
+                    return i + 1
+            return 0
+
+    def stats(self):
+        with self.condition:
+            return {
+                "workers": len(self.workers),
+                "running": len(self.running),
+                "queued": len(self.pending),
+                "max_queue_size": self.max_queue_size
+            }
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                task_id, func, args = self.pending.popleft()
+                self.running.add(task_id)
+
+            try:
+                func(task_id, *args)
+            except Exception as e:
+                print("Job " + str(task_id) + " failed:", e)
+            finally:
+                with self.condition:
+                    self.running.discard(task_id)
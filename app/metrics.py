@@ -0,0 +1,146 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def rss_bytes():
+    # Current resident memory of this process, None where /proc isn't available
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Stage timings, counters and memory snapshots per task, aggregated across tasks for the metrics endpoint
+class Metrics:
+    def __init__(self, max_tasks=200):
+        self.max_tasks = max_tasks
+        self.tasks = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.stage_totals = {}
+        self.counter_totals = {}
+        self.tasks_recorded = 0
+
+    def task(self, task_id):
+        # Metrics for one task, created on first use
+        with self.lock:
+            if task_id not in self.tasks:
+                self.tasks[task_id] = {"stages": {}, "counters": {}, "memory": {}, "critical_path": {}}
+                self.tasks_recorded += 1
+                while len(self.tasks) > self.max_tasks:
+                    self.tasks.popitem(last=False)
+            return self.tasks[task_id]
+
+    @contextmanager
+    def stage(self, task_id, name):
+        # Time a stage, nested stages are recorded under their parent's path e.g. retrieve_documents/score_docs
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(name)
+        path = "/".join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.record_stage(task_id, path, time.perf_counter() - start)
+
+    def current_stack(self):
+        return list(getattr(self.local, "stack", None) or [])
+
+    @contextmanager
+    def nested(self, stack):
+        # Time stages on this thread as if nested under the given stages, e.g. stages run on a pool thread for another thread's stage
+        previous = getattr(self.local, "stack", None)
+        self.local.stack = list(stack)
+        try:
+            yield
+        finally:
+            self.local.stack = previous
+
+    def record_stage(self, task_id, path, seconds):
+        task = self.task(task_id)
+        with self.lock:
+            task["stages"][path] = task["stages"].get(path, 0) + seconds
+            total = self.stage_totals.setdefault(path, {"count": 0, "sum": 0, "buckets": [0] * len(STAGE_BUCKETS)})
+            total["count"] += 1
+            total["sum"] += seconds
+            for i, bucket in enumerate(STAGE_BUCKETS):
+                if seconds <= bucket:
+                    total["buckets"][i] += 1
+
+    def count(self, task_id, name, value=1):
+        task = self.task(task_id)
+        with self.lock:
+            task["counters"][name] = task["counters"].get(name, 0) + value
+            self.counter_totals[name] = self.counter_totals.get(name, 0) + value
+
+    def memory(self, task_id, label):
+        rss = rss_bytes()
+        if rss is not None:
+            task = self.task(task_id)
+            with self.lock:
+                task["memory"][label] = rss
+
+    def critical_path(self, task_id, path):
+        # Stages that bounded a claim's time when its stages run concurrently, in order with their durations
+        task = self.task(task_id)
+        with self.lock:
+            task["critical_path"] = dict(path)
+
+    def summary(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id, {"stages": {}, "counters": {}, "memory": {}, "critical_path": {}})
+            return {key: dict(value) for key, value in task.items()}
+
+    def merge(self, task_id, summary):
+        # Record a summary produced by another process, e.g. a model-serving worker
+        for path, seconds in summary["stages"].items():
+            self.record_stage(task_id, path, seconds)
+        for name, value in summary["counters"].items():
+            self.count(task_id, name, value)
+        task = self.task(task_id)
+        with self.lock:
+            task["memory"].update(summary["memory"])
+            task["critical_path"] = dict(summary.get("critical_path", {}))
+
+    def prometheus(self, gauges=None):
+        # Aggregated metrics in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            lines.append("# HELP esoteric_stage_seconds Time spent in each pipeline stage")
+            lines.append("# TYPE esoteric_stage_seconds histogram")
+            for path, total in sorted(self.stage_totals.items()):
+                label = "stage=\"" + escape_label(path) + "\""
+                for bucket, count in zip(STAGE_BUCKETS, total["buckets"]):
+                    lines.append("esoteric_stage_seconds_bucket{" + label + ",le=\"" + str(bucket) + "\"} " + str(count))
+                lines.append("esoteric_stage_seconds_bucket{" + label + ",le=\"+Inf\"} " + str(total["count"]))
+                lines.append("esoteric_stage_seconds_sum{" + label + "} " + repr(total["sum"]))
+                lines.append("esoteric_stage_seconds_count{" + label + "} " + str(total["count"]))
+
+            lines.append("# HELP esoteric_events_total Pipeline counters e.g. docs fetched, sentences scored, model calls")
+            lines.append("# TYPE esoteric_events_total counter")
+            for name, value in sorted(self.counter_totals.items()):
+                lines.append("esoteric_events_total{name=\"" + escape_label(name) + "\"} " + str(value))
+
+            lines.append("# TYPE esoteric_tasks_total counter")
+            lines.append("esoteric_tasks_total " + str(self.tasks_recorded))
+
+        rss = rss_bytes()
+        if rss is not None:
+            lines.append("# TYPE esoteric_process_resident_memory_bytes gauge")
+            lines.append("esoteric_process_resident_memory_bytes " + str(rss))
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append("# TYPE esoteric_" + name + " gauge")
+            lines.append("esoteric_" + name + " " + str(value))
+        return "\n".join(lines) + "\n"
@@ -1,4 +1,11 @@
+import re
+from bisect import bisect_right
+from functools import lru_cache
+import numpy as np
+
 class Evidence:
+    __slots__ = ("query", "id", "doc_id", "doc_score", "evidence_text", "sentence_list", "score_keys", "embedding", "doc_retrieval_method")
+
     def __init__(self, query, evidence_text, id=None, doc_id=None, doc_score=0, sentences=None, embedding=None, doc_retrieval_method=None):
         self.query = query
 
@@ -8,104 +15,94 @@ class Evidence:
         self.evidence_text = evidence_text
         self.sentences = sentences if sentences is not None else []
 
-        self.embedding = embedding
+        # Dense ES embedding kept as a float32 array rather than a list of Python floats
+        self.embedding = np.asarray(embedding, dtype=np.float32) if embedding is not None else None
         self.doc_retrieval_method = doc_retrieval_method
 
+    # Sentences kept in descending score order for add_sentence, score_keys holds their negated scores for bisect
+    # and is rebuilt on the next insert whenever the list is replaced, as the new list may be in another order
+    @property
+    def sentences(self):
+        return self.sentence_list
+
+    @sentences.setter
+    def sentences(self, sentences):
+        self.sentence_list = sentences
+        self.score_keys = None
+
     def set_evidence_sentences(self, sentences):
         self.sentences = sorted(sentences, key=lambda x: x.score, reverse=True)
-        
+        self.score_keys = [-sentence.score for sentence in self.sentence_list]
+
     def add_sentence(self, sentence):
-        self.sentences.append(sentence)
-        self.sentences.sort(key=lambda x: x.score, reverse=True)
+        if self.score_keys is None:
+            self.set_evidence_sentences(self.sentence_list)
+        # After any sentences with the same score, as a stable sort after appending would place it
+        i = bisect_right(self.score_keys, -sentence.score)
+        self.score_keys.insert(i, -sentence.score)
+        self.sentence_list.insert(i, sentence)
 
     def merge_overlapping_sentences(self):
-        self.sentences = sorted(self.sentences, key=lambda x: x.start)
-        merged_sentences = []
-
-        for sentence in self.sentences:
-            if not merged_sentences:
-                merged_sentences.append(Sentence(
-                    sentence=sentence.sentence,
-                    score=sentence.score,
-                    start=sentence.start,
-                    end=sentence.end
-                ))
-            else:
-                last = merged_sentences[-1]
-                if sentence.start <= last.end:
-                    score = max(last.score, sentence.score)
-                    start = min(last.start, sentence.start)
-                    end = max(last.end, sentence.end)
-                    merged_sentence = Sentence(
-                        score=score,
-                        start=start,
-                        end=end,
-                        sentence = self.evidence_text[start:end]
-                    )
-                    merged_sentences[-1] = merged_sentence
-                else:
-                    merged_sentences.append(Sentence(
-                        sentence=sentence.sentence,
-                        score=sentence.score,
-                        start=sentence.start,
-                        end=sentence.end
-                    ))
-        self.sentences = merged_sentences
+        self.sentences = merge_overlapping_sentences(self.sentence_list, self.evidence_text)
 
     def __str__(self):
         return f"Query: {self.query}\nDoc ID: {self.doc_id}\nDoc Score: {self.doc_score}\nEvidence Text: {self.evidence_text}\nSentences: {self.sentences}\nDoc Retrieval Method: {self.doc_retrieval_method}"
 
 class EvidenceWrapper:
+    __slots__ = ("query", "evidences", "evidences_by_id")
+
     def __init__(self, query):
         self.query = query
         self.evidences = []
+        # First evidence added for each id
+        self.evidences_by_id = {}
 
     def add_evidence(self, evidence):
         self.evidences.append(evidence)
+        self.evidences_by_id.setdefault(evidence.id, evidence)
 
     def get_evidences(self):
         return self.evidences
-    
+
     def get_evidence_by_id(self, id):
-        for evidence in self.evidences:
-            if evidence.id == id:
-                return evidence
-        return None
-    
+        return self.evidences_by_id.get(id)
+
     def get_claim(self):
         return self.query
-    
+
     def remove_evidence(self, evidence):
         self.evidences.remove(evidence)
+        if self.evidences_by_id.get(evidence.id) is evidence:
+            self.index()
+
+    def index(self):
+        # Rebuild the id index so it points at the first evidence for each id in the current order
+        self.evidences_by_id = {}
+        for evidence in self.evidences:
+            self.evidences_by_id.setdefault(evidence.id, evidence)
 
     def sort_by_doc_score(self):
         self.evidences = sorted(self.evidences, key=lambda x: x.doc_score, reverse=True)
+        self.index()
 
     def sort_by_sentence_score(self):
         for evidence in self.evidences:
-            evidence.sentences = sorted(evidence.sentences, key=lambda x: x.score, reverse=True)
+            evidence.set_evidence_sentences(evidence.sentences)
 
         self.evidences = sorted(self.evidences, key=lambda x: x.sentences[0].score if x.sentences else 0, reverse=True)
+        self.index()
 
-        def __str__(self):
-            return f"Query: {self.query}\nEvidences: {self.evidences}"
-        
     def seperate_sort(self):
         # Display documents containing passages first, ordered by their passage score, and then to display documents without passages, ordered by their document score
-        evidences_with_sentences = []
-        evidences_without_sentences = []
-        for evidence in self.evidences:
-            if evidence.sentences:
-                evidences_with_sentences.append(evidence)
-            else:
-                evidences_without_sentences.append(evidence)
-
-        evidences_with_sentences.sort(key=lambda x: max(sentence.score for sentence in x.sentences), reverse=True)
-        evidences_without_sentences.sort(key=lambda x: x.doc_score, reverse=True)
+        self.evidences = seperate_sorted(self.evidences, lambda evidence: [sentence.score for sentence in evidence.sentences], lambda evidence: evidence.doc_score)
+        self.index()
 
-        self.evidences = evidences_with_sentences + evidences_without_sentences
+    def __str__(self):
+        return f"Query: {self.query}\nEvidences: {self.evidences}"
 
 class Sentence:
+    __slots__ = ("doc_id", "sentence", "score", "start", "end", "question", "method")
+
     def __init__(self, sentence=None, score=0, doc_id=None, start=None, end=None, question=None, method=None):
         self.doc_id = doc_id
         self.sentence = sentence
@@ -120,4 +117,47 @@ class Sentence:
         self.end = self.start + len(self.sentence)
 
     def __str__(self):
-        return f"Doc ID: {self.doc_id}\nSentence ID: {self.sent_id}\nSentence: {self.sentence}\nScore: {self.score}"
\ No newline at end of file
+        return f"Doc ID: {self.doc_id}\nSentence: {self.sentence}\nScore: {self.score}"
+
+def merge_overlapping_sentences(sentences, evidence_text):
+    # New sentences in start order with overlapping ones merged, keeping the higher score
+    merged_sentences = []
+    for sentence in sorted(sentences, key=lambda x: x.start):
+        if merged_sentences and sentence.start <= merged_sentences[-1].end:
+            last = merged_sentences[-1]
+            start = min(last.start, sentence.start)
+            end = max(last.end, sentence.end)
+            merged_sentences[-1] = Sentence(sentence=evidence_text[start:end], score=max(last.score, sentence.score), start=start, end=end)
+        else:
+            merged_sentences.append(Sentence(sentence=sentence.sentence, score=sentence.score, start=sentence.start, end=sentence.end))
+    return merged_sentences
+
+def seperate_sorted(items, get_passage_scores, get_doc_score):
+    # Items with passages by their best passage score, then items without passages by doc score
+    with_sentences = [item for item in items if get_passage_scores(item)]
+    without_sentences = [item for item in items if not get_passage_scores(item)]
+    with_sentences.sort(key=lambda item: max(get_passage_scores(item)), reverse=True)
+    without_sentences.sort(key=get_doc_score, reverse=True)
+    return with_sentences + without_sentences
+
+# FEVER style bracket and colon escapes in doc ids
+BRC_REPLACEMENTS = {"-LRB-": "(", "-RRB-": ")", "-LSB-": "[", "-RSB-": "]", "-LCB-": "{", "-RCB-": "}", "-COLON-": ":"}
+BRC_PATTERN = re.compile("|".join(re.escape(escape) for escape in BRC_REPLACEMENTS))
+
+@lru_cache(maxsize=10000)
+def convert_brc(string):
+    return BRC_PATTERN.sub(lambda match: BRC_REPLACEMENTS[match.group()], string)
+
+def evidence_to_dicts(evidence_wrapper):
+    # Evidence as shown on the demo page, overlapping sentences merged and docs with passages first
+    # Reads the wrapper without changing it so it can be called while passages are still being added
+    evidences = []
+    for evidence in evidence_wrapper.get_evidences():
+        sentences = merge_overlapping_sentences(list(evidence.sentences), evidence.evidence_text)
+        evidences.append({
+            "doc_id": convert_brc(evidence.doc_id),
+            "doc_score": evidence.doc_score,
+            "evidence_text": evidence.evidence_text,
+            "sentences": [{"sentence": sentence.sentence, "score": sentence.score, "start": sentence.start, "end": sentence.end} for sentence in sentences]
+        })
+    return seperate_sorted(evidences, lambda evidence: [sentence["score"] for sentence in evidence["sentences"]], lambda evidence: evidence["doc_score"])
@@ -0,0 +1,206 @@
+import sys
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+FINISHED_STATUSES = ("completed", "failed", "rejected")
+# Tasks a worker still holds or will pick up, these are never expired or evicted
+RUNNING_STATUSES = ("queued", "in progress")
+
+# Fields the demo page reads once a task has finished, everything else is dropped on completion
+COMPLETED_FIELDS = ("status", "step", "claim", "entities", "entity_colors", "questions", "evidence", "verdict", "error", "metrics")
+
+def deep_sizeof(obj, seen=None):
+    # Approximate memory footprint of nested dicts/lists of plain values
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+# Task progress keyed by task id, with TTL expiry, a maximum entry count and a cap on each task's log
+class ProgressStore:
+    def __init__(self, ttl=3600, max_entries=1000, max_log_entries=200):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_log_entries = max_log_entries
+
+        self.entries = OrderedDict()
+        self.updated = {}
+        self.lock = threading.RLock()
+
+        # Incremental events per task for streaming, numbered by a store-wide sequence
+        self.events = {}
+        self.sequence = 0
+        # Highest sequence number trimmed from each task's events, a stream behind it gets a fresh snapshot instead
+        self.dropped = {}
+        self.condition = threading.Condition(self.lock)
+
+        # Functions called with (task_id, event, data) after each published event and with a "log" event for each appended log line,
+        # e.g. to forward progress from a worker process
+        self.listeners = []
+        self.evicted = 0
+        self.expired = 0
+
+    def __contains__(self, task_id):
+        with self.lock:
+            return task_id in self.entries
+
+    def __getitem__(self, task_id):
+        with self.lock:
+            entry = self.entries[task_id]
+            self.touch(task_id)
+            return entry
+
+    def __setitem__(self, task_id, entry):
+        with self.lock:
+            self.entries[task_id] = entry
+            self.touch(task_id)
+            self.prune()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, task_id, default=None):
+        with self.lock:
+            return self.entries.get(task_id, default)
+
+    def setdefault(self, task_id, entry):
+        with self.lock:
+            if task_id not in self.entries:
+                self[task_id] = entry
+            return self[task_id]
+
+    def pop(self, task_id, default=None):
+        with self.lock:
+            self.updated.pop(task_id, None)
+            self.events.pop(task_id, None)
+            self.dropped.pop(task_id, None)
+            self.condition.notify_all()
+            return self.entries.pop(task_id, default)
+
+    def touch(self, task_id):
+        self.updated[task_id] = time.monotonic()
+        self.entries.move_to_end(task_id)
+
+    def append_log(self, task_id, log):
+        # Append to a task's log, keeping only the most recent entries
+        with self.lock:
+            task_log = self[task_id]["log"]
+            task_log.append(log)
+            if len(task_log) > self.max_log_entries:
+                del task_log[:len(task_log) - self.max_log_entries]
+        for listener in self.listeners:
+            listener(task_id, "log", log)
+
+    def publish(self, task_id, event, data):
+        # Record an incremental update for a task and wake up any streams waiting on it
+        with self.lock:
+            if task_id in self.entries:
+                self.sequence += 1
+                task_events = self.events.setdefault(task_id, [])
+                task_events.append((self.sequence, event, data))
+                if len(task_events) > self.max_log_entries:
+                    trimmed = len(task_events) - self.max_log_entries
+                    self.dropped[task_id] = task_events[trimmed - 1][0]
+                    del task_events[:trimmed]
+                self.condition.notify_all()
+        for listener in self.listeners:
+            listener(task_id, event, data)
+
+    def snapshot(self, task_id, exclude=()):
+        # Copy of a task's progress and the sequence number it is current up to
+        # Deep copied under the lock, the nested entities and questions keep changing while the copy is serialized
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None:
+                return self.sequence, None
+            return self.sequence, copy.deepcopy({key: value for key, value in entry.items() if key not in exclude})
+
+    def merge_event(self, task_id, event, data):
+        # Apply an event published in another process to this process's copy of the task
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None:
+                return
+            if event == "log":
+                self.append_log(task_id, data)
+            elif event == "question":
+                entry.setdefault("questions", []).append(data)
+            elif event != "metrics" and isinstance(data, dict):
+                entry.update(data)
+
+    def events_since(self, task_id, sequence, timeout=None):
+        # Wait for events newer than sequence, returns None once the task is gone
+        # If some of those events were already trimmed, a single snapshot event with the task's current progress is returned instead
+        with self.condition:
+            def newer():
+                return [event for event in self.events.get(task_id, []) if event[0] > sequence]
+            self.condition.wait_for(lambda: task_id not in self.entries or newer(), timeout)
+            if task_id not in self.entries:
+                return None
+            if self.dropped.get(task_id, 0) > sequence:
+                return [(self.sequence, "snapshot", self.snapshot(task_id, exclude=("log",))[1])]
+            return newer()
+
+    def finish(self, task_id, status, error=None):
+        # Mark a task as finished with the given status and tell any streams
+        with self.lock:
+            entry = self.setdefault(task_id, {})
+            entry["status"] = status
+            data = {"status": status}
+            if error is not None:
+                entry["error"] = data["error"] = error
+        self.publish(task_id, "status", data)
+
+    def complete(self, task_id):
+        # Mark a task completed and drop fields the finished page doesn't render
+        with self.lock:
+            entry = self[task_id]
+            entry["status"] = "completed"
+            self.entries[task_id] = {key: value for key, value in entry.items() if key in COMPLETED_FIELDS}
+        self.publish(task_id, "status", {"status": "completed"})
+
+    def running(self, task_id):
+        return self.entries[task_id].get("status") in RUNNING_STATUSES
+
+    def prune(self):
+        # Drop expired tasks, then evict finished tasks before any others until under the entry limit
+        # Queued and running tasks are kept, so the store can briefly hold more than max_entries
+        now = time.monotonic()
+        for task_id in [task_id for task_id, updated in self.updated.items() if now - updated > self.ttl and not self.running(task_id)]:
+            self.pop(task_id)
+            self.expired += 1
+
+        if len(self.entries) > self.max_entries:
+            finished = [task_id for task_id, entry in self.entries.items() if entry.get("status") in FINISHED_STATUSES]
+            finished_ids = set(finished)
+            candidates = finished + [task_id for task_id in self.entries if task_id not in finished_ids and not self.running(task_id)]
+            for task_id in candidates[:len(self.entries) - self.max_entries]:
+                self.pop(task_id)
+                self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            self.prune()
+            statuses = {}
+            for entry in self.entries.values():
+                statuses[entry.get("status")] = statuses.get(entry.get("status"), 0) + 1
+            return {
+                "entries": len(self.entries),
+                "statuses": statuses,
+                "events": sum(len(task_events) for task_events in self.events.values()),
+                "approx_bytes": deep_sizeof(self.entries) + deep_sizeof(self.events),
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "max_log_entries": self.max_log_entries
+            }
@@ -1,14 +1,24 @@
 import uuid
-from app import app, evidence_retriever, progress_store
-from flask import render_template, session, redirect, url_for, request, jsonify
-from threading import Thread
-import requests
-import os
-import re
-from dotenv import load_dotenv
+import time
+from app import app, evidence_retriever, progress_store, job_queue, claim_cache, verdict_client, metrics, metrics_in_progress, startup
+from flask import render_template, session, redirect, url_for, jsonify, Response
+import json
 
 from app.forms import ClaimForm
-from app.models import Evidence, EvidenceWrapper, Sentence
+from app.jobs import QueueFullError
+from app.progress import COMPLETED_FIELDS
+from app.models import evidence_to_dicts
+from app.verdict import verdict_prompt
+
+# Seconds between publishing a streamed verdict's partial text
+VERDICT_PUBLISH_INTERVAL = 0.1
+
+@app.after_request
+def record_first_request(response):
+    if startup["first_request_seconds"] is None:
+        startup["first_request_seconds"] = time.perf_counter() - startup["started"]
+        print("First request served {:.2f}s after start".format(startup["first_request_seconds"]))
+    return response
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -23,61 +33,146 @@ def demo():
     claim = session.get('claim', 'Not specified')
     task_id = str(uuid.uuid4())
     session["task_id"] = task_id
-    Thread(target=background_task, args=(task_id, claim)).start()
+
+    # Serve repeated claims straight from the cache
+    cached_result = claim_cache.get(claim)
+    if cached_result:
+        progress_store[task_id] = dict(cached_result, status="completed")
+        return render_template("demo.html", claim=claim, task_id=task_id)
+
+    # Queue the claim, rejecting it if too many claims are already waiting
+    progress_store[task_id] = {
+        "status": "queued",
+        "log": [],
+        "questions": [],
+        "should_continue": True
+    }
+    try:
+        job_queue.submit(task_id, run_task, claim)
+    except QueueFullError as e:
+        progress_store.finish(task_id, "rejected", str(e))
     return render_template("demo.html", claim=claim, task_id=task_id)
 
 @app.route("/progress/<task_id>")
 def progress(task_id):
-    return jsonify(progress_store.get(task_id, None))
+    _, task_progress = progress_store.snapshot(task_id)
+    if task_progress and task_progress["status"] == "queued":
+        task_progress["queue_position"] = job_queue.position(task_id)
+    return jsonify(task_progress)
+
+@app.route("/progress/<task_id>/stream")
+def progress_stream(task_id):
+    # Server-sent events: a snapshot of the task's progress followed by incremental updates as they are published
+    def format_event(event, data, sequence=None):
+        message = "event: " + event + "\n"
+        if sequence is not None:
+            message += "id: " + str(sequence) + "\n"
+        return message + "data: " + json.dumps(data) + "\n\n"
+
+    def stream():
+        sequence, task_progress = progress_store.snapshot(task_id, exclude=("log",))
+        if task_progress is None:
+            yield format_event("status", {"status": "missing"})
+            return
+        if task_progress.get("status") == "queued":
+            task_progress["queue_position"] = job_queue.position(task_id)
+        yield format_event("snapshot", task_progress, sequence)
+
+        status = task_progress.get("status")
+        queue_position = task_progress.get("queue_position")
+        while status not in ("completed", "failed", "rejected"):
+            events = progress_store.events_since(task_id, sequence, timeout=1 if status == "queued" else 15)
+            if events is None:
+                yield format_event("status", {"status": "missing"})
+                return
+            if not events:
+                # Queue position changes without events, otherwise keep the connection alive
+                if status == "queued" and job_queue.position(task_id) != queue_position:
+                    queue_position = job_queue.position(task_id)
+                    yield format_event("queue", {"queue_position": queue_position})
+                else:
+                    yield ": keepalive\n\n"
+                continue
+            for sequence, event, data in events:
+                if "status" in data:
+                    status = data["status"]
+                yield format_event(event, data, sequence)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/progress/stats")
+def progress_stats():
+    return jsonify(dict(progress_store.stats(), claim_cache=claim_cache.stats(), verdict=verdict_client.stats()))
+
+@app.route("/ready")
+def ready():
+    # Readiness probe, 503 until the models have loaded so traffic can be held back from a starting instance
+    readiness = dict(evidence_retriever.readiness(), app_created_seconds=startup["app_created_seconds"], first_request_seconds=startup["first_request_seconds"])
+    return jsonify(readiness), 200 if readiness["ready"] else 503
+
+@app.route("/metrics")
+def prometheus_metrics():
+    # Stage timings and counters aggregated over all tasks, plus current queue, store and cache sizes
+    job_stats = job_queue.stats()
+    progress_stats = progress_store.stats()
+    claim_cache_stats = claim_cache.stats()
+    gauges = {
+        "jobs_running": job_stats["running"],
+        "jobs_queued": job_stats["queued"],
+        "progress_store_entries": progress_stats["entries"],
+        "progress_store_bytes": progress_stats["approx_bytes"],
+        "claim_cache_entries": claim_cache_stats["entries"],
+        "claim_cache_hits": claim_cache_stats["hits"],
+        "claim_cache_misses": claim_cache_stats["misses"]
+    }
+    for name, value in verdict_client.stats().items():
+        gauges["verdict_" + name] = value
+
+    # Startup timings once they're known
+    readiness = evidence_retriever.readiness()
+    gauges["models_ready"] = int(readiness["ready"])
+    for name, seconds in (("startup_app_created_seconds", startup["app_created_seconds"]), ("startup_models_loaded_seconds", readiness["load_seconds"]), ("startup_first_request_seconds", startup["first_request_seconds"])):
+        if seconds is not None:
+            gauges[name] = round(seconds, 3)
+    return Response(metrics.prometheus(gauges), mimetype="text/plain; version=0.0.4")
+
+def run_task(task_id, claim):
+    # Mark the task as failed instead of leaving it in progress if retrieval raises
+    try:
+        background_task(task_id, claim)
+    except Exception as e:
+        progress_store.finish(task_id, "failed", str(e))
+        raise
 
 def background_task(task_id, claim):
-    evidence_retriever.flush_questions()
     evidence_wrapper = evidence_retriever.retrieve_evidence(claim, task_id)
-    
-    evidences = []
-    for evidence in evidence_wrapper.get_evidences():
-        evidence.merge_overlapping_sentences()
-    
-    evidence_wrapper.seperate_sort()
-    for evidence in evidence_wrapper.get_evidences():
-        evidence_dict = {
-            "doc_id": convert_brc(evidence.doc_id),
-            "doc_score": evidence.doc_score,
-            "evidence_text": evidence.evidence_text,
-            "sentences": []
-        }
-        for sentence in evidence.sentences:
-            sentence_dict = {
-                "sentence": sentence.sentence,
-                "score": sentence.score,
-                "start": sentence.start,
-                "end": sentence.end
-            }
-            evidence_dict["sentences"].append(sentence_dict)
-        evidences.append(evidence_dict)
+    evidences = evidence_to_dicts(evidence_wrapper)
     progress_store[task_id]["evidence"] = evidences
+    progress_store.publish(task_id, "evidence", {"evidence": evidences})
     evidence_sentences = [sentence["sentence"] for evidence in evidences for sentence in evidence["sentences"]]
-    prompt = "Is the following claim supported, refuted or not enough evidence based on the evidence listed below? The evidence is to be taken as completely factual. \n\nClaim: " + claim + "\n\nEvidence:\n" + "\n".join(evidence_sentences)
-   
-    model = "mistral-small-latest"
-    messages = [{
-        "role": "system",
-        "content": prompt
-        }]
-    
-    load_dotenv()
-    response = requests.post("https://api.mistral.ai/v1/chat/completions", json={"model": model, "messages": messages}, headers={"Authorization": "Bearer " + os.environ.get("MISTRAL_KEY")})
-    verdict = response.json()['choices'][0]['message']['content']
+    prompt = verdict_prompt(claim, evidence_sentences)
+
+    # Tokens are published as they arrive, throttled so long verdicts don't flood the event log
+    streamed = {"text": "", "published": 0, "first_token": None}
+    start = time.perf_counter()
+    def on_token(token):
+        now = time.perf_counter()
+        if streamed["first_token"] is None:
+            streamed["first_token"] = now - start
+        streamed["text"] += token
+        if now - streamed["published"] >= VERDICT_PUBLISH_INTERVAL:
+            streamed["published"] = now
+            progress_store[task_id]["verdict"] = streamed["text"]
+            progress_store.publish(task_id, "verdict", {"verdict": streamed["text"]})
+
+    with metrics.stage(task_id, "verdict"):
+        verdict = verdict_client.verdict(prompt, on_token)
+    if streamed["first_token"] is not None:
+        metrics.record_stage(task_id, "verdict_first_token", streamed["first_token"])
     print(verdict)
     progress_store[task_id]["verdict"] = verdict
-    progress_store[task_id]["status"] = "completed"
-
-def convert_brc(string):
-    string = re.sub('-LRB-', '(', string)
-    string = re.sub('-RRB-', ')', string)
-    string = re.sub('-LSB-', '[', string)
-    string = re.sub('-RSB-', ']', string)
-    string = re.sub('-LCB-', '{', string)
-    string = re.sub('-RCB-', '}', string)
-    string = re.sub('-COLON-', ':', string)
-    return string
\ No newline at end of file
+    progress_store.publish(task_id, "verdict", {"verdict": verdict})
+    if metrics_in_progress:
+        progress_store[task_id]["metrics"] = metrics.summary(task_id)
+    progress_store.complete(task_id)
+    claim_cache.put(claim, {key: value for key, value in progress_store.get(task_id, {}).items() if key in COMPLETED_FIELDS})
@@ -0,0 +1,135 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+
+# Verdict generation for a claim and its evidence, through a chat completions backend with a cache of verdicts per prompt
+
+class VerdictError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def verdict_prompt(claim, evidence_sentences):
+    return "Is the following claim supported, refuted or not enough evidence based on the evidence listed below? The evidence is to be taken as completely factual. \n\nClaim: " + claim + "\n\nEvidence:\n" + "\n".join(evidence_sentences)
+
+def prompt_hash(model, messages):
+    return hashlib.sha1(json.dumps({"model": model, "messages": messages}, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Mistral style chat completions API over one pooled session, with connect/read timeouts, an overall deadline and retries with exponential backoff
+# Any backend with a model attribute and complete(messages, on_token) returning the full text can take its place
+class ChatCompletionsBackend:
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, api_key=None, model="mistral-small-latest", connect_timeout=5, read_timeout=60, total_timeout=120, retries=2, backoff=0.5, streaming=True, pool_size=10):
+        self.url = url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.streaming = streaming
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = "Bearer " + api_key
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+
+    def complete(self, messages, on_token=None):
+        deadline = time.monotonic() + self.total_timeout
+        for attempt in range(self.retries + 1):
+            with self.lock:
+                self.requests += 1
+            tokens = []
+            try:
+                return self.request(messages, deadline, tokens, on_token)
+            except (requests.ConnectionError, requests.Timeout, VerdictError) as e:
+                # Only retried before any tokens were passed on, a retry after that would repeat them
+                status = getattr(e, "status", None)
+                retryable = not tokens and (status is None or status in self.RETRY_STATUSES)
+                wait = self.backoff * 2 ** attempt
+                if not retryable or attempt == self.retries or time.monotonic() + wait > deadline:
+                    with self.lock:
+                        self.failures += 1
+                    raise VerdictError("Verdict request failed: " + str(e), status) from e
+                print("Verdict request failed (" + str(e) + "), retrying in {:.1f}s".format(wait))
+                with self.lock:
+                    self.retried += 1
+                time.sleep(wait)
+
+    def request(self, messages, deadline, tokens, on_token):
+        streaming = self.streaming and on_token is not None
+        with self.session.post(self.url, json={"model": self.model, "messages": messages, "stream": streaming}, timeout=self.timeout, stream=streaming) as response:
+            if response.status_code != 200:
+                raise VerdictError("HTTP " + str(response.status_code) + " " + response.text[:200], response.status_code)
+            if not streaming:
+                return response.json()["choices"][0]["message"]["content"]
+
+            # Server-sent events, one chunk with a content delta per data line until [DONE]
+            for line in response.iter_lines(decode_unicode=True):
+                if time.monotonic() > deadline:
+                    raise requests.Timeout("Verdict stream exceeded " + str(self.total_timeout) + "s")
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                token = json.loads(data)["choices"][0]["delta"].get("content")
+                if token:
+                    tokens.append(token)
+                    on_token(token)
+            return "".join(tokens)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "retries": self.retried, "failures": self.failures}
+
+# Verdicts cached by a hash of the model and prompt, so a repeated prompt skips the API call
+class VerdictClient:
+    def __init__(self, backend, cache_size=512):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verdict(self, prompt, on_token=None):
+        messages = [{"role": "system", "content": prompt}]
+        key = prompt_hash(getattr(self.backend, "model", None), messages)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if cached is not None:
+            if on_token:
+                on_token(cached)
+            return cached
+
+        verdict = self.backend.complete(messages, on_token)
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[key] = verdict
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return verdict
+
+    def stats(self):
+        with self.lock:
+            stats = {"cache_entries": len(self.cache), "cache_hits": self.hits, "cache_misses": self.misses}
+        if hasattr(self.backend, "stats"):
+            stats.update(self.backend.stats())
+        return stats
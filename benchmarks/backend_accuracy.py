@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Accuracy, speed and memory of each inference backend (INFERENCE_BACKEND) for the transformer models
+# Relevance classification is scored against a fixed labeled set, the other models by agreement with the pytorch outputs
+
+PAIRS_FILE = os.path.join(ROOT, "benchmarks", "fixtures", "relevance_pairs.jsonl")
+CLAIMS_FILE = os.path.join(ROOT, "benchmarks", "fixtures", "claims.txt")
+RELEVANCE_MODEL_DIR = os.path.join(ROOT, "app", "ESOTERIC", "models", "relevancy_classification")
+
+def run(backend, model_cache_dir):
+    # Runs inside a fresh interpreter so memory is measured for one backend at a time
+    from app.metrics import rss_bytes
+    from app.ESOTERIC.tools.model_cache import load_pipeline, load_sentence_transformer
+    from app.ESOTERIC.tools.NER import entity_extraction_prompt
+    from app.ESOTERIC.tools.document_retrieval import question_generation_prompt
+
+    with open(PAIRS_FILE, "r") as f:
+        pairs = [json.loads(line) for line in f if line.strip()]
+    with open(CLAIMS_FILE, "r") as f:
+        claims = [line.strip() for line in f if line.strip()]
+
+    rss_before = rss_bytes()
+    relevance_pipe = load_pipeline("text-classification", RELEVANCE_MODEL_DIR, None, backend)
+    ner_pipe = load_pipeline("token-classification", "Babelscape/wikineural-multilingual-ner", model_cache_dir, backend, grouped_entities=True)
+    answer_pipe = load_pipeline("text2text-generation", "vabatista/t5-small-answer-extraction-en", model_cache_dir, backend)
+    question_pipe = load_pipeline("text2text-generation", "mrm8488/t5-base-finetuned-question-generation-ap", model_cache_dir, backend, max_length=256)
+    sim_model = load_sentence_transformer("sentence-transformers/all-mpnet-base-v2", model_cache_dir, backend)
+    rss_after = rss_bytes()
+
+    # Warm up each model once so first-call overheads aren't timed
+    relevance_pipe(pairs[0]["claim"] + " [SEP] " + pairs[0]["sentence"])
+    ner_pipe(claims[0])
+    answer_pipe(entity_extraction_prompt(claims[0]))
+    question_pipe(question_generation_prompt("No", claims[0]))
+    sim_model.encode([claims[0]])
+
+    timings = {}
+    def timed(name, func):
+        start = time.perf_counter()
+        result = func()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    relevance = timed("relevance", lambda: relevance_pipe([pair["claim"] + " [SEP] " + pair["sentence"] for pair in pairs], batch_size=32, truncation=True))
+    entities = timed("ner", lambda: [sorted(entity["word"] for entity in ner_pipe(claim)) for claim in claims])
+    answers = timed("answer_extraction", lambda: answer_pipe([entity_extraction_prompt(claim) for claim in claims], batch_size=8))
+    questions = timed("question_generation", lambda: question_pipe([question_generation_prompt("No", claim) for claim in claims], batch_size=8))
+    embeddings = timed("similarity", lambda: sim_model.encode([pair["claim"] for pair in pairs] + [pair["sentence"] for pair in pairs], convert_to_numpy=True))
+
+    claim_embeddings, sentence_embeddings = embeddings[:len(pairs)], embeddings[len(pairs):]
+    similarities = np.sum(claim_embeddings * sentence_embeddings, axis=1) / (np.linalg.norm(claim_embeddings, axis=1) * np.linalg.norm(sentence_embeddings, axis=1))
+
+    print("RESULT " + json.dumps({
+        "relevance_correct": [int((result["label"] == "LABEL_1") == bool(pair["label"])) for pair, result in zip(pairs, relevance)],
+        "entities": entities,
+        "answers": [output["generated_text"] for output in answers],
+        "questions": [output["generated_text"] for output in questions],
+        "similarities": similarities.tolist(),
+        "timings": timings,
+        "model_memory_bytes": rss_after - rss_before if rss_before is not None and rss_after is not None else None
+    }))
+
+def agreement(outputs, baseline_outputs):
+    return sum(output == baseline for output, baseline in zip(outputs, baseline_outputs)) / len(baseline_outputs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", default=["pytorch", "quantized", "onnx"], help="Inference backends to compare, the first is the baseline for agreement")
+    parser.add_argument("--model-cache-dir", help="MODEL_CACHE_DIR to load local model copies from")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run, args.model_cache_dir)
+        sys.exit(0)
+
+    results = {}
+    for backend in args.backends:
+        command = [sys.executable, os.path.abspath(__file__), "--run", backend]
+        if args.model_cache_dir:
+            command += ["--model-cache-dir", args.model_cache_dir]
+        output = subprocess.run(command, capture_output=True, text=True)
+        lines = [line for line in output.stdout.splitlines() if line.startswith("RESULT ")]
+        if not lines:
+            print(backend + " failed:\n" + output.stderr[-2000:])
+            continue
+        results[backend] = json.loads(lines[-1][len("RESULT "):])
+
+    if not results:
+        sys.exit(1)
+    baseline = results[next(iter(results))]
+
+    print("{:>10} {:>10} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format("backend", "relevance", "ner", "answers", "questions", "sim diff", "seconds", "memory MB"))
+    for backend, result in results.items():
+        memory = result["model_memory_bytes"]
+        print("{:>10} {:>10.3f} {:>8.3f} {:>8.3f} {:>10.3f} {:>10.4f} {:>10.2f} {:>10}".format(
+            backend,
+            np.mean(result["relevance_correct"]),
+            agreement(result["entities"], baseline["entities"]),
+            agreement(result["answers"], baseline["answers"]),
+            agreement(result["questions"], baseline["questions"]),
+            float(np.max(np.abs(np.array(result["similarities"]) - np.array(baseline["similarities"])))),
+            sum(result["timings"].values()),
+            "{:.0f}".format(memory / 1024 / 1024) if memory is not None else "n/a"
+        ))
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from haystack import Document
+from haystack.document_stores import InMemoryDocumentStore
+from app.ESOTERIC.tools.docstore_conversion import listdict_to_docstore
+
+# Micro-benchmark for building the DPR candidate doc store from Elasticsearch hits
+
+def generate_docs(n, duplicate_rate=0.1, dim=768):
+    docs = []
+    for i in range(n):
+        # Reuse earlier ids to mimic docs returned by both title and text matching
+        id = str(random.randrange(i)) if i and random.random() < duplicate_rate else str(i)
+        docs.append({"id": id, "doc_id": "doc_" + id, "text": "Sentence about document " + id + ".", "embedding": [random.random() for _ in range(dim)]})
+    return docs
+
+def baseline_listdict_to_docstore(listdict):
+    # Previous implementation as it was, rescanning the store before every single insert
+    # Its Document call also passed doc_id=doc_id, which haystack's Document rejects, so that argument is left out here as it now is in the real path
+    doc_store = InMemoryDocumentStore()
+    for doc in listdict:
+        id = doc['id']
+        doc_id = doc['doc_id']
+        content = doc['text']
+        content_type = "text"
+        embedding = doc['embedding']
+        meta = {"doc_id": doc_id}
+        
+        # if not already in doc store, add to doc store
+        if id not in [d.id for d in doc_store.get_all_documents()]:
+            doc = Document(id=id, content=content, content_type=content_type, embedding=embedding, meta=meta)
+            doc_store.write_documents([doc])
+    return doc_store
+
+def time_call(func, docs, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(docs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--baseline-limit", type=int, default=1000, help="Largest size to also time the previous quadratic implementation on")
+    args = parser.parse_args()
+
+    random.seed(0)
+    print("{:>8} {:>12} {:>12}".format("docs", "bulk (s)", "baseline (s)"))
+    for size in args.sizes:
+        docs = generate_docs(size)
+        bulk = time_call(listdict_to_docstore, docs, args.repeats)
+        baseline = time_call(baseline_listdict_to_docstore, docs, 1) if size <= args.baseline_limit else None
+        print("{:>8} {:>12.4f} {:>12}".format(size, bulk, "{:.4f}".format(baseline) if baseline is not None else "-"))
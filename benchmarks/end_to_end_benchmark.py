@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import uuid
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_llm import start_stub_llm
+
+# Whole claim pipeline (retrieval, passages, verdict) run offline against a fake Elasticsearch, stand-in models and a stub LLM
+# Reports per-stage and end-to-end latency percentiles, throughput and peak memory over a fixed claim set
+
+CLAIMS_FILE = os.path.join(ROOT, "benchmarks", "fixtures", "claims.txt")
+
+def peak_rss_bytes():
+    # Peak resident memory of this process, None where the resource module isn't available (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def percentiles(values):
+    return np.percentile(values, 50), np.percentile(values, 95)
+
+def configure(args, llm_url):
+    # Defaults for the settings the app requires, anything already set in the environment wins
+    defaults = {
+        "TITLE_MATCH_DOCS_LIMIT": "20",
+        "TEXT_MATCH_SEARCH_DB_LIMIT": "1000",
+        "TITLE_MATCH_SEARCH_THRESHOLD": "0",
+        "ANSWERABILITY_THRESHOLD": "0.1",
+        "READER_THRESHOLD": "0.7",
+        "CLAIM_CACHE_SIZE": "0",
+        "EVIDENCE_WORKERS": "0",
+        "METRICS_MAX_TASKS": str(args.repeats * 1000),
+        "MISTRAL_KEY": "benchmark"
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    if not args.real_models:
+        os.environ.setdefault("RETRIEVER_FACTORY", "benchmarks.stand_ins:build_retriever")
+    os.environ["MISTRAL_API_URL"] = llm_url
+    os.environ["BENCHMARK_ES_LATENCY_MS"] = str(args.es_latency_ms)
+    os.environ["BENCHMARK_MODEL_DELAY_MS"] = str(args.model_delay_ms)
+
+def run_claim(claim):
+    from app import progress_store, routes
+
+    task_id = str(uuid.uuid4())
+    progress_store[task_id] = {"status": "in progress", "log": [], "questions": [], "should_continue": True}
+    start = time.perf_counter()
+    routes.background_task(task_id, claim)
+    return task_id, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--claims-file", default=CLAIMS_FILE, help="File with one claim per line")
+    parser.add_argument("--repeats", type=int, default=3, help="Times each claim is run")
+    parser.add_argument("--concurrency", type=int, default=1, help="Claims run at the same time")
+    parser.add_argument("--es-latency-ms", type=float, default=0, help="Added latency per fake Elasticsearch request")
+    parser.add_argument("--model-delay-ms", type=float, default=0, help="Added latency per stand-in model call")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="Added latency per stub LLM request")
+    parser.add_argument("--llm-token-latency-ms", type=float, default=0, help="Added latency per streamed stub LLM token")
+    parser.add_argument("--real-models", action="store_true", help="Use the app's own retriever (real models and Elasticsearch from .env) instead of the stand-ins")
+    args = parser.parse_args()
+
+    server, llm_url = start_stub_llm(args.llm_latency_ms, token_latency_ms=args.llm_token_latency_ms)
+    configure(args, llm_url)
+
+    with open(args.claims_file, "r") as f:
+        claims = [line.strip() for line in f if line.strip()]
+
+    load_start = time.perf_counter()
+    from app import metrics
+    print("App loaded in {:.2f}s".format(time.perf_counter() - load_start))
+
+    # Warm up caches that would be warm in a running server, e.g. spaCy and the first model calls
+    run_claim(claims[0])
+
+    # Generation and embedding caches are per process, so repeats measure the warm path
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(run_claim, claims * args.repeats))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    stage_times = {}
+    for task_id, _ in results:
+        for stage, seconds in metrics.summary(task_id)["stages"].items():
+            stage_times.setdefault(stage, []).append(seconds)
+
+    print("\n{:<50} {:>10} {:>10}".format("stage", "p50 (s)", "p95 (s)"))
+    for stage, times in sorted(stage_times.items()):
+        print("{:<50} {:>10.4f} {:>10.4f}".format(stage, *percentiles(times)))
+    print("{:<50} {:>10.4f} {:>10.4f}".format("end to end", *percentiles([seconds for _, seconds in results])))
+
+    print("\nClaims: {}  Concurrency: {}  Seconds: {:.2f}  Claims/min: {:.1f}".format(len(results), args.concurrency, elapsed, len(results) / elapsed * 60))
+    peak = peak_rss_bytes()
+    print("Peak RSS: " + ("{:.1f} MB".format(peak / 1024 / 1024) if peak is not None else "unavailable"))
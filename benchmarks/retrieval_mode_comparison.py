@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Document retrieval in the local (in-memory DPR over text matches) and knn (Elasticsearch kNN) retrieval modes over a fixed claim set
+# Reports latency percentiles, Elasticsearch response bytes, docs returned and the recall of the local mode's docs in the knn mode's docs
+# The knn mode's docs per claim depend on its score cutoff, so the threshold it ran with is printed alongside
+
+CLAIMS_FILE = os.path.join(ROOT, "benchmarks", "fixtures", "claims.txt")
+
+class CountingElasticsearch:
+    # Wraps an Elasticsearch client, adding up the JSON size of every response
+    def __init__(self, es):
+        self.es = es
+        self.bytes = 0
+
+    def count(self, response):
+        self.bytes += len(json.dumps(getattr(response, "body", response), default=str))
+        return response
+
+    def search(self, *args, **kwargs):
+        return self.count(self.es.search(*args, **kwargs))
+
+    def msearch(self, *args, **kwargs):
+        return self.count(self.es.msearch(*args, **kwargs))
+
+    def mget(self, *args, **kwargs):
+        return self.count(self.es.mget(*args, **kwargs))
+
+def configure(args):
+    # Defaults for the settings the app requires, anything already set in the environment wins
+    defaults = {
+        "TITLE_MATCH_DOCS_LIMIT": "20",
+        "TEXT_MATCH_SEARCH_DB_LIMIT": "1000",
+        "TITLE_MATCH_SEARCH_THRESHOLD": "0",
+        "ANSWERABILITY_THRESHOLD": "0.1",
+        "READER_THRESHOLD": "0.7",
+        "CLAIM_CACHE_SIZE": "0",
+        "EVIDENCE_WORKERS": "0"
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    if not args.real_models:
+        os.environ.setdefault("RETRIEVER_FACTORY", "benchmarks.stand_ins:build_retriever")
+    os.environ["BENCHMARK_ES_LATENCY_MS"] = str(args.es_latency_ms)
+    if args.knn_threshold is not None:
+        os.environ["KNN_THRESHOLD"] = str(args.knn_threshold)
+
+def run_mode(retriever, claims, repeats):
+    es = CountingElasticsearch(retriever.es)
+    retriever.es = es
+    retriever.retrieve_documents(claims[0])
+
+    times = []
+    docs = {}
+    es.bytes = 0
+    for _ in range(repeats):
+        for claim in claims:
+            start = time.perf_counter()
+            evidence_wrapper = retriever.retrieve_documents(claim)
+            times.append(time.perf_counter() - start)
+            docs[claim] = {evidence.id for evidence in evidence_wrapper.get_evidences()}
+    return times, es.bytes / (len(claims) * repeats), docs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--claims-file", default=CLAIMS_FILE, help="File with one claim per line")
+    parser.add_argument("--repeats", type=int, default=3, help="Times each claim is run")
+    parser.add_argument("--es-latency-ms", type=float, default=0, help="Added latency per fake Elasticsearch request")
+    parser.add_argument("--knn-threshold", type=float, default=None, help="Score cutoff for kNN hits on the (1 + cosine) / 2 scale, defaults to KNN_THRESHOLD")
+    parser.add_argument("--real-models", action="store_true", help="Use the app's own retriever (real models and Elasticsearch from .env) instead of the stand-ins")
+    args = parser.parse_args()
+    configure(args)
+
+    with open(args.claims_file, "r") as f:
+        claims = [line.strip() for line in f if line.strip()]
+
+    from app import retriever_kwargs, evidence_retriever
+
+    # The app's retriever covers its own RETRIEVAL_MODE, a second one of the same class is built for the other mode
+    results = {}
+    for mode in ("local", "knn"):
+        retriever = evidence_retriever if evidence_retriever.retrieval_mode == mode else type(evidence_retriever)(**dict(retriever_kwargs, retrieval_mode=mode))
+        retriever.wait_until_ready()
+        results[mode] = run_mode(retriever, claims, args.repeats)
+
+    print("\nkNN hits kept above a score of {:.2f}, (1 + cosine) / 2".format(retriever_kwargs["knn_threshold"]))
+    print("{:<10} {:>10} {:>10} {:>16} {:>14}".format("mode", "p50 (s)", "p95 (s)", "ES bytes/claim", "docs/claim"))
+    for mode, (times, es_bytes, docs) in results.items():
+        label = "knn@{:.2f}".format(retriever_kwargs["knn_threshold"]) if mode == "knn" else mode
+        print("{:<10} {:>10.4f} {:>10.4f} {:>16.0f} {:>14.1f}".format(label, np.percentile(times, 50), np.percentile(times, 95), es_bytes, np.mean([len(ids) for ids in docs.values()])))
+
+    local_docs, knn_docs = results["local"][2], results["knn"][2]
+    recalls = [len(local_docs[claim] & knn_docs[claim]) / len(local_docs[claim]) for claim in claims if local_docs[claim]]
+    print("\nRecall of local docs in knn docs: {:.3f} over {} claims".format(np.mean(recalls) if recalls else 0, len(recalls)))
@@ -0,0 +1,210 @@
+import os
+import re
+import json
+import time
+import fnmatch
+import hashlib
+from types import SimpleNamespace
+import numpy as np
+import spacy
+
+from app.ESOTERIC.evidence_retrieval import EvidenceRetriever
+from app.ESOTERIC.tools.generation import CachedGenerationPipe
+
+# Offline stand-ins for Elasticsearch and the transformer models, deterministic and fast enough to expose pipeline overheads
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CAPITALIZED_SPAN = re.compile(r"[A-Z][\w'-]*(?:\s+(?:of\s+|the\s+|a\s+)?[A-Z0-9][\w'-]*)*")
+
+def hashed_embedding(text, dim):
+    # Normalized bag-of-words vector with tokens hashed into dim buckets
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in re.findall(r"\w+", text.lower()):
+        vector[int(hashlib.md5(token.encode("utf-8")).hexdigest(), 16) % dim] += 1
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def content_words(text):
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 3}
+
+def delay():
+    # Optional per-call latency so model cost can be emulated, BENCHMARK_MODEL_DELAY_MS
+    milliseconds = float(os.environ.get("BENCHMARK_MODEL_DELAY_MS", 0))
+    if milliseconds:
+        time.sleep(milliseconds / 1000)
+
+class FakeElasticsearch:
+    # In-process index over a fixture corpus answering the queries built in tools/document_retrieval.py
+    def __init__(self, corpus_path=None, latency_ms=0, dim=768):
+        corpus_path = corpus_path or os.path.join(FIXTURES_DIR, "corpus.jsonl")
+        self.latency = latency_ms / 1000
+        self.docs = {}
+        with open(corpus_path, "r") as f:
+            for i, line in enumerate(f):
+                doc = json.loads(line)
+                doc["embedding"] = hashed_embedding(doc["doc_id"].replace("_", " ") + " " + doc["content"], dim).tolist()
+                self.docs[str(i)] = doc
+        self.requests = 0
+
+    def wait(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def score(self, doc, clause):
+        # Returns a relevance score, 0 when the clause doesn't match
+        if "bool" in clause:
+            should = clause["bool"].get("should", [])
+            scores = [self.score(doc, sub_clause) for sub_clause in should]
+            matched = [score for score in scores if score > 0]
+            return sum(matched) if len(matched) >= clause["bool"].get("minimum_should_match", 1) else 0
+        if "term" in clause:
+            field, value = next(iter(clause["term"].items()))
+            return 1 if doc[field] == value else 0
+        if "wildcard" in clause:
+            field, spec = next(iter(clause["wildcard"].items()))
+            return 1 if fnmatch.fnmatchcase(doc[field], spec["value"]) else 0
+        if "match_phrase" in clause:
+            field, phrase = next(iter(clause["match_phrase"].items()))
+            return doc[field].lower().count(phrase.lower())
+        raise ValueError("Unsupported query clause: " + str(clause))
+
+    def hit(self, id, doc, source, score=1):
+        fields = source if source is not None else ["doc_id", "content", "embedding"]
+        return {"_id": id, "_score": score, "_source": {field: doc[field] for field in fields if field in doc}}
+
+    def knn_search(self, body):
+        # Exact nearest neighbours by cosine similarity, scored (1 + cosine) / 2 like a cosine dense_vector field
+        knn = body["knn"]
+        query_vector = np.asarray(knn["query_vector"], dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1)
+        scored = []
+        for id, doc in self.docs.items():
+            if "filter" in knn and self.score(doc, knn["filter"]) <= 0:
+                continue
+            embedding = np.asarray(doc["embedding"], dtype=np.float32)
+            scored.append(((1 + float(embedding @ query_vector / (np.linalg.norm(embedding) or 1))) / 2, id, doc))
+        scored = sorted(scored, key=lambda item: item[0], reverse=True)[:knn["k"]]
+        hits = [self.hit(id, doc, body.get("_source"), score) for score, id, doc in scored[:body.get("size", 10)]]
+        return {"hits": {"total": {"value": len(scored)}, "hits": hits}}
+
+    def run_search(self, body):
+        if "knn" in body:
+            return self.knn_search(body)
+        scored = [(self.score(doc, body["query"]), id, doc) for id, doc in self.docs.items()]
+        scored = sorted([item for item in scored if item[0] > 0], key=lambda item: item[0], reverse=True)
+        hits = [self.hit(id, doc, body.get("_source"), score) for score, id, doc in scored[:body.get("size", 10)]]
+        return {"hits": {"total": {"value": len(scored)}, "hits": hits}}
+
+    def search(self, index=None, body=None, **kwargs):
+        self.wait()
+        return self.run_search(body)
+
+    def msearch(self, searches=None, **kwargs):
+        self.wait()
+        bodies = searches[1::2]
+        return {"responses": [self.run_search(body) for body in bodies]}
+
+    def mget(self, index=None, ids=None, source=None, **kwargs):
+        self.wait()
+        docs = []
+        for id in ids:
+            if id in self.docs:
+                docs.append(dict(self.hit(id, self.docs[id], source), found=True))
+            else:
+                docs.append({"_id": id, "found": False})
+        return {"docs": docs}
+
+class StandInGenerationPipe:
+    # text2text-generation stand-in for both T5 models
+    def __init__(self, name):
+        self.model = SimpleNamespace(name_or_path=name)
+
+    def generate(self, prompt):
+        if prompt.startswith("extract entities:") or prompt.startswith("extract answers:"):
+            text = prompt.split("<ha>")[1]
+            spans = CAPITALIZED_SPAN.findall(text) + re.findall(r"\b\d{4}\b", text)
+            return {"generated_text": "<sep>".join(spans) + "<sep>"}
+        answer, context = re.match(r"answer: (.*) context: (.*)", prompt, re.S).groups()
+        if answer == "No":
+            return {"generated_text": "question: Is it true that " + context.rstrip(".") + "?"}
+        return {"generated_text": "question: What is " + answer + "?"}
+
+    def __call__(self, inputs, batch_size=None, **kwargs):
+        delay()
+        if isinstance(inputs, str):
+            return [self.generate(inputs)]
+        return [self.generate(prompt) for prompt in inputs]
+
+class StandInNER:
+    def __call__(self, text):
+        delay()
+        return [{"word": span, "entity_group": "MISC", "score": 1.0} for span in CAPITALIZED_SPAN.findall(text)]
+
+class StandInSentenceModel:
+    def __init__(self, dim=64):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, convert_to_tensor=False, **kwargs):
+        delay()
+        if isinstance(sentences, str):
+            return hashed_embedding(sentences, self.dim)
+        return np.stack([hashed_embedding(sentence, self.dim) for sentence in sentences]) if sentences else np.zeros((0, self.dim), dtype=np.float32)
+
+class StandInRelevanceClassifier:
+    # Labels a (claim, sentence) pair relevant when they share at least two content words
+    def classify(self, pair):
+        claim, sentence = pair.split(" [SEP] ", 1)
+        overlap = len(content_words(claim) & content_words(sentence))
+        return {"label": "LABEL_1" if overlap >= 2 else "LABEL_0", "score": min(1.0, 0.5 + overlap / 10)}
+
+    def __call__(self, inputs, batch_size=None, **kwargs):
+        delay()
+        if isinstance(inputs, str):
+            return [self.classify(inputs)]
+        return [self.classify(pair) for pair in inputs]
+
+class StandInDPR:
+    # Scores candidate docs by the dot product of hashed question and document embeddings
+    def __init__(self, dim=768, top_k=10):
+        self.dim = dim
+        self.top_k = top_k
+
+    def embed_queries(self, queries):
+        return np.stack([hashed_embedding(query, self.dim) for query in queries])
+
+    def retrieve_batch(self, queries, document_store=None, top_k=None, **kwargs):
+        delay()
+        docs = document_store.get_all_documents(return_embedding=True)
+        if not docs:
+            return [[] for _ in queries]
+        embeddings = np.stack([np.asarray(doc.embedding, dtype=np.float32) for doc in docs])
+        scores = self.embed_queries(queries) @ embeddings.T
+        results = []
+        for question_scores in scores:
+            best = np.argsort(-question_scores)[:top_k or self.top_k]
+            results.append([SimpleNamespace(id=docs[i].id, score=float(question_scores[i])) for i in best])
+        return results
+
+    def retrieve(self, query, document_store=None, top_k=None, **kwargs):
+        return self.retrieve_batch([query], document_store=document_store, top_k=top_k)[0]
+
+class StandInEvidenceRetriever(EvidenceRetriever):
+    def connect_elasticsearch(self):
+        return FakeElasticsearch(os.environ.get("BENCHMARK_CORPUS"), float(os.environ.get("BENCHMARK_ES_LATENCY_MS", 0)))
+
+    def load_models(self):
+        print("Loading stand-in models")
+        self.nlp = spacy.load('en_core_web_sm')
+        self.NER_model = StandInNER()
+        self.question_generation_pipe = CachedGenerationPipe(StandInGenerationPipe("stand-in-question-generation"), max_size=self.generation_cache_size)
+        self.answer_extraction_pipe = CachedGenerationPipe(StandInGenerationPipe("stand-in-answer-extraction"), max_size=self.generation_cache_size)
+        self.sim_model = StandInSentenceModel()
+        self.dpr_retriever = StandInDPR()
+        self.relevance_classification_tokenizer_pipe = StandInRelevanceClassifier()
+
+def build_retriever(**kwargs):
+    return StandInEvidenceRetriever(**kwargs)
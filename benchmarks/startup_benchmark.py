@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Time from launching the server to serving the form page and to the models being ready, per model loading mode
+# Needs the same .env as the app itself, combine with RETRIEVER_FACTORY=benchmarks.stand_ins:build_retriever to run offline
+
+def wait_for(url, process, timeout, ok_status=200):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code " + str(process.returncode))
+        try:
+            if requests.get(url, timeout=1).status_code == ok_status:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(url + " not ready after " + str(timeout) + "s")
+
+def measure(mode, load_workers, model_cache_dir, port, timeout):
+    env = dict(os.environ, MODEL_LOADING=mode, MODEL_LOAD_WORKERS=str(load_workers))
+    if model_cache_dir:
+        env["MODEL_CACHE_DIR"] = model_cache_dir
+    command = [sys.executable, "-c", "from app import app; app.run(port=" + str(port) + ")"]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = "http://127.0.0.1:" + str(port)
+        wait_for(base_url + "/", process, timeout)
+        first_page = time.perf_counter() - start
+        wait_for(base_url + "/ready", process, timeout)
+        ready = time.perf_counter() - start
+        details = requests.get(base_url + "/ready").json()
+    finally:
+        process.terminate()
+        process.wait()
+    return first_page, ready, details
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["eager", "background"], help="MODEL_LOADING modes to compare")
+    parser.add_argument("--load-workers", type=int, nargs="+", default=[1, 4], help="MODEL_LOAD_WORKERS values to compare")
+    parser.add_argument("--model-cache-dir", help="MODEL_CACHE_DIR to load local model copies from, filled on the first run")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--timeout", type=float, default=900)
+    args = parser.parse_args()
+
+    print("{:>12} {:>8} {:>16} {:>12}".format("mode", "workers", "first page (s)", "ready (s)"))
+    for mode in args.modes:
+        for load_workers in args.load_workers:
+            first_page, ready, details = measure(mode, load_workers, args.model_cache_dir, args.port, args.timeout)
+            print("{:>12} {:>8} {:>16.2f} {:>12.2f}".format(mode, load_workers, first_page, ready))
+            print("    models: " + str(details.get("models")))
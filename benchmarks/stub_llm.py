@@ -0,0 +1,70 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local chat-completions endpoint returning a fixed verdict, so the verdict stage costs a round trip but no API call
+# Streams the verdict word by word as server-sent events when the request asks for it, and can fail the first requests to exercise retries
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.last_request = request
+            failing = self.server.requests <= self.server.fail_first
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if failing:
+            self.send_body(503, {"error": "stub failure"})
+        elif request.get("stream"):
+            self.send_stream()
+        else:
+            self.send_body(200, {"choices": [{"message": {"role": "assistant", "content": self.server.verdict}}]})
+
+    def send_body(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = self.server.verdict.split(" ")
+        for i, word in enumerate(words):
+            if self.server.token_latency:
+                time.sleep(self.server.token_latency)
+            chunk = {"choices": [{"delta": {"content": word if i == len(words) - 1 else word + " "}}]}
+            self.write_chunk("data: " + json.dumps(chunk) + "\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_llm(latency_ms=0, verdict="Not enough evidence.", token_latency_ms=0, fail_first=0):
+    # Serves on a free local port in a daemon thread, returns the server and its chat completions URL
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLLMHandler)
+    server.latency = latency_ms / 1000
+    server.token_latency = token_latency_ms / 1000
+    server.verdict = verdict
+    server.fail_first = fail_first
+    server.requests = 0
+    server.last_request = None
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1]) + "/v1/chat/completions"
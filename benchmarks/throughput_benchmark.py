@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Claims per minute against the number of model-serving worker processes (EVIDENCE_WORKERS)
+# Needs the same .env and running Elasticsearch as the app itself
+
+CLAIMS = [
+    "Nikolaj Coster-Waldau worked with the Fox Broadcasting Company.",
+    "Roman Atwood is a content creator.",
+    "History of art includes architecture, dance, sculpture, music, painting, poetry literature, theatre, narrative, film, photography and graphic arts.",
+    "Adrienne Bailon is an accountant.",
+    "System of a Down briefly disbanded in limbo.",
+    "Homeland is an American television spy thriller based on the Israeli television series Prisoners of War.",
+    "Beautiful reached number two on the Billboard Hot 100 in 2003.",
+    "Fox 2000 Pictures released the film Soul Food.",
+]
+
+def run(workers, claims):
+    # Runs inside a fresh interpreter so the app is built with the requested worker count
+    from app import evidence_retriever
+
+    if workers > 0:
+        while evidence_retriever.ready < workers:
+            time.sleep(1)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(lambda claim: evidence_retriever.retrieve_evidence(claim, None), claims))
+    elapsed = time.perf_counter() - start
+    print("RESULT {} {} {:.2f}".format(workers, len(claims), elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="Worker process counts to compare, 0 runs the models in-process")
+    parser.add_argument("--claims-file", help="File with one claim per line, defaults to a fixed FEVER sample")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    claims = CLAIMS
+    if args.claims_file:
+        with open(args.claims_file, "r") as f:
+            claims = [line.strip() for line in f if line.strip()]
+
+    if args.run is not None:
+        run(args.run, claims)
+        sys.exit(0)
+
+    print("{:>8} {:>8} {:>12} {:>14}".format("workers", "claims", "seconds", "claims/min"))
+    for workers in args.workers:
+        env = dict(os.environ, EVIDENCE_WORKERS=str(workers), JOB_WORKERS=str(max(workers, 1)))
+        command = [sys.executable, os.path.abspath(__file__), "--run", str(workers)]
+        if args.claims_file:
+            command += ["--claims-file", args.claims_file]
+        output = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True).stdout
+        results = [line.split() for line in output.splitlines() if line.startswith("RESULT ")]
+        if not results:
+            print("{:>8} failed".format(workers))
+            continue
+        _, _, count, elapsed = results[-1]
+        print("{:>8} {:>8} {:>12} {:>14.2f}".format(workers, count, elapsed, int(count) / float(elapsed) * 60))
@@ -0,0 +1,41 @@
+import os
+import time
+import argparse
+
+# Offline job storing each Elasticsearch document's sentence offsets and sentence embeddings, point SENTENCE_INDEX_DIR at the output
+# Uses the app's own spaCy pipeline, similarity model and connection so the index matches what retrieval computes at query time
+os.environ["EVIDENCE_WORKERS"] = "0"
+os.environ["MODEL_LOADING"] = "eager"
+os.environ.pop("SENTENCE_INDEX_DIR", None)
+
+from elasticsearch.helpers import scan
+from app import evidence_retriever
+from app.ESOTERIC.tools.sentence_index import build_sentence_index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir", help="Directory to write the sentence index to, replaced once the build finishes")
+    parser.add_argument("--index", default="documents", help="Elasticsearch index to read documents from")
+    parser.add_argument("--batch-size", type=int, default=256, help="Documents split and embedded per batch")
+    parser.add_argument("--limit", type=int, help="Only index the first N documents")
+    args = parser.parse_args()
+
+    def documents():
+        hits = scan(evidence_retriever.es, index=args.index, query={"query": {"match_all": {}}}, _source=["content"], size=1000)
+        for i, hit in enumerate(hits):
+            if args.limit is not None and i >= args.limit:
+                break
+            yield hit["_id"], hit["_source"]["content"]
+
+    embedding_cache = evidence_retriever.embedding_cache
+    start = time.perf_counter()
+    doc_count, sentence_count = build_sentence_index(
+        documents(),
+        evidence_retriever.nlp,
+        lambda sentences: evidence_retriever.sim_model.encode(sentences, batch_size=evidence_retriever.relevance_batch_size, convert_to_numpy=True),
+        args.output_dir,
+        dim=embedding_cache.dim,
+        backend=evidence_retriever.inference_backend,
+        batch_size=args.batch_size
+    )
+    print("Indexed {} docs and {} sentences in {:.1f}s".format(doc_count, sentence_count, time.perf_counter() - start))
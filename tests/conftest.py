@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing the app package creates the Flask app, loads the models and connects to Elasticsearch
+# The tests only need the plain modules under it, so the packages are registered without running their __init__
+for name, path in (("app", "app"), ("app.ESOTERIC", os.path.join("app", "ESOTERIC")), ("app.ESOTERIC.tools", os.path.join("app", "ESOTERIC", "tools"))):
+    if name not in sys.modules:
+        package = types.ModuleType(name)
+        package.__path__ = [os.path.join(ROOT, path)]
+        sys.modules[name] = package
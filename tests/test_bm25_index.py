@@ -0,0 +1,82 @@
+import re
+from types import SimpleNamespace
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from app.ESOTERIC.tools.bm25_index import BM25SentenceIndex
+
+class FakeNlp:
+    # Sentences end at a full stop and tokens are words and full stops, "the" is the only stop word
+    # Checks the index never holds its lock while text is parsed
+    def __init__(self):
+        self.index = None
+
+    def __call__(self, text):
+        assert not self.index.lock.locked()
+        return self.parse(text)
+
+    def pipe(self, texts):
+        assert not self.index.lock.locked()
+        return [self.parse(text) for text in texts]
+
+    def parse(self, text):
+        return Doc([Span(match) for match in re.finditer(r"[^.]+\.?", text)])
+
+class Doc:
+    def __init__(self, sents):
+        self.sents = sents
+
+    def __iter__(self):
+        return (token for sentence in self.sents for token in sentence)
+
+class Span:
+    def __init__(self, match):
+        self.start_char = match.start()
+        self.end_char = match.end()
+        self.tokens = [SimpleNamespace(text=word, is_stop=word == "the", is_punct=word == ".") for word in re.findall(r"\w+|\.", match.group())]
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+def make_index(**kwargs):
+    nlp = FakeNlp()
+    index = BM25SentenceIndex(nlp, **kwargs)
+    nlp.index = index
+    return index
+
+def evidence(id, text):
+    return SimpleNamespace(id=id, doc_id=id, evidence_text=text)
+
+EVIDENCES = [
+    evidence("1", "The cat sat on the mat. A dog barked."),
+    evidence("2", "Cats and dogs are pets. The cat is asleep."),
+    evidence("3", "Paris is the capital of France.")
+]
+
+def expected_scores(query, evidences):
+    sentences = [sentence for item in evidences for sentence in re.findall(r"[^.]+\.?", item.evidence_text)]
+    corpus = [[word for word in re.findall(r"\w+", sentence) if word != "the"] for sentence in sentences]
+    return BM25Okapi(corpus).get_scores([word for word in query.split() if word != "the"])
+
+def test_scores_match_bm25okapi():
+    index = make_index()
+    rows, scores, tokenized = index.score("cat sat", EVIDENCES)
+    assert tokenized == 3
+    assert [(row[0].id, row[1], row[2]) for row in rows][:2] == [("1", 0, 23), ("1", 23, 37)]
+    np.testing.assert_allclose(scores, expected_scores("cat sat", EVIDENCES), rtol=1e-5)
+
+    _, scores, tokenized = index.score("cat sat", EVIDENCES)
+    assert tokenized == 0
+    np.testing.assert_allclose(scores, expected_scores("cat sat", EVIDENCES), rtol=1e-5)
+
+def test_vocabulary_is_rebuilt_with_the_doc_cache():
+    index = make_index(max_vocabulary=5)
+    index.score("cat", EVIDENCES[:1])
+    assert index.stats()["vocabulary"] > 5
+
+    _, scores, tokenized = index.score("Paris capital", EVIDENCES[1:])
+    assert index.stats()["vocabulary_resets"] == 1
+    assert tokenized == 2
+    assert index.stats()["docs"] == 2
+    np.testing.assert_allclose(scores, expected_scores("Paris capital", EVIDENCES[1:]), rtol=1e-5)
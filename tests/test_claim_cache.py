@@ -0,0 +1,45 @@
+from app.claim_cache import ClaimCache
+
+def test_cached_results_are_copies():
+    cache = ClaimCache(config={})
+    result = {"status": "completed", "questions": [{"question": "q"}], "evidence": [{"doc_id": "a"}]}
+    cache.put("A claim.", result)
+    result["questions"].append({"question": "changed"})
+
+    first = cache.get("a claim")
+    assert first["questions"] == [{"question": "q"}]
+    first["evidence"].append({"doc_id": "b"})
+    assert cache.get("A CLAIM")["evidence"] == [{"doc_id": "a"}]
+
+def test_disabled_cache_stores_nothing():
+    cache = ClaimCache(config={}, max_size=0)
+    cache.put("claim", {"status": "completed"})
+    assert cache.get("claim") is None
+
+def test_near_duplicate_lookup_waits_for_the_model():
+    import numpy as np
+    encoded = []
+    def encode(claim):
+        encoded.append(claim)
+        return np.array([1.0, 0.0], dtype=np.float32)
+    ready = {"value": False}
+    cache = ClaimCache(config={}, encode=encode, similarity_threshold=0.9, ready=lambda: ready["value"])
+
+    cache.put("first claim", {"status": "completed"})
+    assert cache.get("second claim") is None
+    assert encoded == []
+
+    ready["value"] = True
+    cache.put("first claim", {"status": "completed"})
+    assert cache.get("second claim") == {"status": "completed"}
+    assert encoded == ["first claim", "second claim"]
+
+def test_saves_on_interval_not_on_put(tmp_path):
+    path = str(tmp_path / "claims.json")
+    cache = ClaimCache(config={"a": 1}, path=path, save_interval=3600)
+    cache.put("claim", {"status": "completed"})
+    assert not (tmp_path / "claims.json").exists()
+
+    cache.save()
+    assert ClaimCache(config={"a": 1}, path=path, save_interval=3600).get("claim") == {"status": "completed"}
+    assert ClaimCache(config={"a": 2}, path=path, save_interval=3600).get("claim") is None
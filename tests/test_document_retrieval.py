@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.ESOTERIC.tools.document_retrieval import merge_retrieved_docs, title_and_text_match_search, fetch_embeddings, PhraseVectors
+
+def doc(id, score, doc_id=None):
+    return {"id": id, "doc_id": doc_id or id, "score": score}
+
+def result(id, score):
+    # Stands in for a retrieved haystack Document, only its id and score are read
+    return SimpleNamespace(id=id, score=score)
+
+def test_exact_title_docs_keep_their_score():
+    title_doc = doc("t", 1.0)
+    candidates = [doc("t", 0), doc("a", 0)]
+    merged = merge_retrieved_docs([title_doc], candidates, [result("t", 0.9), result("a", 0.8)], threshold=0.5)
+    assert [(d["id"], d["score"]) for d in merged] == [("t", 1.0), ("a", 0.8)]
+    assert candidates[0]["score"] == 0
+
+def test_results_at_or_below_threshold_are_dropped():
+    candidates = [doc("a", 0), doc("b", 0), doc("c", 0)]
+    merged = merge_retrieved_docs([], candidates, [result("a", 0.5), result("b", 0.4), result("c", 0.51)], threshold=0.5)
+    assert [d["id"] for d in merged] == ["c"]
+
+def test_higher_score_replaces_lower():
+    candidates = [doc("a", 0)]
+    merged = merge_retrieved_docs([], candidates, [result("a", 0.6), result("a", 0.9), result("a", 0.7)], threshold=0.5)
+    assert [(d["id"], d["score"]) for d in merged] == [("a", 0.9)]
+
+def test_duplicate_ids_are_returned_once():
+    first, second = doc("a", 0, doc_id="first"), doc("a", 0, doc_id="second")
+    merged = merge_retrieved_docs([], [first, second], [result("a", 0.7), result("a", 0.8)], threshold=0.5)
+    assert merged == [first]
+    assert first["score"] == 0.8
+    assert second["score"] == 0
+
+def test_results_not_among_candidates_are_ignored():
+    merged = merge_retrieved_docs([], [doc("a", 0)], [result("x", 0.9), result("a", 0.6)], threshold=0.5)
+    assert [d["id"] for d in merged] == ["a"]
+
+class FakeElasticsearch:
+    # Records the msearch and mget requests and answers them from fixed hits and stored embeddings
+    def __init__(self, title_hits=(), text_hits=(), embeddings=None, error=None):
+        self.title_hits = list(title_hits)
+        self.text_hits = list(text_hits)
+        self.embeddings = embeddings or {}
+        self.error = error
+        self.msearches = []
+        self.mgets = []
+
+    def msearch(self, searches):
+        self.msearches.append(searches)
+        text_response = {"error": self.error} if self.error else {"hits": {"hits": self.text_hits}}
+        return {"responses": [{"hits": {"hits": self.title_hits}}, text_response]}
+
+    def mget(self, index, ids, source):
+        self.mgets.append({"index": index, "ids": sorted(ids), "source": source})
+        return {"docs": [{"_id": id, "found": True, "_source": {"embedding": self.embeddings[id]}} if id in self.embeddings else {"_id": id, "found": False} for id in ids]}
+
+def hit(id, doc_id, embedding=None):
+    source = {"doc_id": doc_id, "content": doc_id + " text"}
+    if embedding is not None:
+        source["embedding"] = embedding
+    return {"_id": id, "_source": source}
+
+def test_title_and_text_match_is_one_msearch():
+    es = FakeElasticsearch(title_hits=[hit("1", "paris", [1, 0])], text_hits=[hit("2", "france", [0, 1])])
+    title_docs, text_docs = title_and_text_match_search(["Paris"], es, limit=50)
+
+    assert len(es.msearches) == 1
+    header, title_query, text_header, text_query = es.msearches[0]
+    assert header == text_header == {"index": "documents"}
+    assert title_query["query"]["bool"]["should"][0] == {"term": {"doc_id": "paris"}}
+    assert text_query["query"]["bool"]["should"] == [{"match_phrase": {"content": "Paris"}}]
+    assert text_query["size"] == 50
+    assert title_query["_source"] == text_query["_source"] == ["doc_id", "content", "embedding"]
+
+    assert [(doc["id"], doc["doc_id"]) for doc in title_docs] == [("1", "paris")]
+    assert [(doc["id"], doc["method"], doc["score"]) for doc in text_docs] == [("2", "text_match", 0)]
+    assert text_docs[0]["embedding"].dtype == np.float32
+
+def test_search_without_embeddings_leaves_them_out_of_source():
+    es = FakeElasticsearch(text_hits=[hit("2", "france")])
+    _, text_docs = title_and_text_match_search(["Paris"], es, fetch_embeddings=False)
+    _, title_query, _, text_query = es.msearches[0]
+    assert title_query["_source"] == text_query["_source"] == ["doc_id", "content"]
+    assert text_docs[0]["embedding"] is None
+
+def test_msearch_error_is_raised():
+    with pytest.raises(RuntimeError, match="multi-search failed"):
+        title_and_text_match_search(["Paris"], FakeElasticsearch(error="boom"))
+
+def test_fetch_embeddings_only_requests_missing_ones():
+    es = FakeElasticsearch(embeddings={"2": [0.5, 0.5]})
+    docs = [{"id": "1", "embedding": np.array([1, 0], dtype=np.float32)}, {"id": "2", "embedding": None}, {"id": "2", "embedding": None}]
+    fetch_embeddings(docs, es)
+
+    assert es.mgets == [{"index": "documents", "ids": ["2"], "source": ["embedding"]}]
+    assert docs[0]["embedding"].tolist() == [1, 0]
+    assert docs[1]["embedding"].tolist() == docs[2]["embedding"].tolist() == [0.5, 0.5]
+
+def test_fetch_embeddings_skips_mget_when_nothing_is_missing():
+    es = FakeElasticsearch()
+    fetch_embeddings([{"id": "1", "embedding": np.array([1, 0], dtype=np.float32)}], es)
+    assert es.mgets == []
+
+def test_fetch_embeddings_leaves_docs_not_found_without_embedding():
+    es = FakeElasticsearch(embeddings={"1": [1, 0]})
+    docs = [{"id": "1", "embedding": None}, {"id": "gone", "embedding": None}]
+    fetch_embeddings(docs, es)
+    assert es.mgets[0]["ids"] == ["1", "gone"]
+    assert docs[0]["embedding"].tolist() == [1, 0]
+    assert docs[1]["embedding"] is None
+
+class FakeNlp:
+    # nlp.pipe giving each phrase a vector of its length, and evicting from the cache mid-call when asked
+    def __init__(self, on_pipe=None):
+        self.on_pipe = on_pipe
+        self.piped = []
+
+    def pipe(self, phrases, batch_size):
+        self.piped.extend(phrases)
+        if self.on_pipe:
+            self.on_pipe()
+        return [SimpleNamespace(vector=np.array([len(phrase), 1], dtype=np.float32)) for phrase in phrases]
+
+def test_phrase_vectors_only_pipe_new_phrases():
+    phrase_vectors = PhraseVectors()
+    nlp = FakeNlp()
+    phrase_vectors.get(nlp, ["a", "bb"])
+    vectors = phrase_vectors.get(nlp, ["bb", "ccc", "bb"])
+    assert nlp.piped == ["a", "bb", "ccc"]
+    assert vectors[:, 0].tolist() == [2, 3, 2]
+    assert phrase_vectors.stats() == {"entries": 3, "hits": 2, "misses": 3}
+
+def test_phrase_vectors_survive_eviction_during_pipe():
+    phrase_vectors = PhraseVectors(max_size=2)
+    phrase_vectors.get(FakeNlp(), ["a", "bb"])
+    # Another request fills the cache while this one is running its missing phrases through the pipe
+    nlp = FakeNlp(on_pipe=lambda: phrase_vectors.get(FakeNlp(), ["xxxx", "yyyyy"]))
+    vectors = phrase_vectors.get(nlp, ["a", "ccc"])
+    assert vectors[:, 0].tolist() == [1, 3]
+    assert len(phrase_vectors.vectors) == 2
@@ -0,0 +1,71 @@
+import os
+import json
+
+import numpy as np
+
+from app.ESOTERIC.tools.embedding_cache import EmbeddingCache
+
+class FakeModel:
+    # Encodes a text as its length repeated over every dimension, counting the texts it was run on
+    def __init__(self, dim=3):
+        self.dim = dim
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size, convert_to_numpy):
+        self.encoded.extend(texts)
+        return np.array([[len(text)] * self.dim for text in texts], dtype=np.float32)
+
+def test_vectors_are_reused_from_the_store(tmp_path):
+    EmbeddingCache(FakeModel(), store_dir=str(tmp_path), model_id="model pytorch").encode(["a", "bb"])
+    model = FakeModel()
+    cache = EmbeddingCache(model, store_dir=str(tmp_path), model_id="model pytorch")
+    assert cache.encode(["bb", "ccc"])[:, 0].tolist() == [2, 3]
+    assert model.encoded == ["ccc"]
+    assert json.loads((tmp_path / "meta.json").read_text()) == {"model": "model pytorch", "dim": 3}
+
+def test_store_from_another_model_or_dim_is_started_again(tmp_path):
+    EmbeddingCache(FakeModel(), store_dir=str(tmp_path), model_id="model pytorch").encode(["a", "bb"])
+
+    model = FakeModel()
+    cache = EmbeddingCache(model, store_dir=str(tmp_path), model_id="model onnx")
+    assert cache.stats()["disk_entries"] == 0
+    cache.encode(["bb"])
+    assert model.encoded == ["bb"]
+
+    model = FakeModel(dim=4)
+    cache = EmbeddingCache(model, store_dir=str(tmp_path), model_id="model onnx")
+    assert cache.encode(["bb"]).shape == (1, 4)
+    assert model.encoded == ["bb"]
+
+def test_rows_without_a_key_are_dropped_after_a_crash(tmp_path):
+    EmbeddingCache(FakeModel(), store_dir=str(tmp_path), model_id="model").encode(["a", "bb"])
+    # A crash after appending a vector but before appending its key
+    with open(tmp_path / "embeddings.f32", "ab") as f:
+        f.write(np.full(3, 9, dtype=np.float32).tobytes())
+
+    cache = EmbeddingCache(FakeModel(), store_dir=str(tmp_path), model_id="model")
+    assert os.path.getsize(tmp_path / "embeddings.f32") == 2 * 3 * 4
+    cache.encode(["dddd"])
+
+    model = FakeModel()
+    cache = EmbeddingCache(model, store_dir=str(tmp_path), model_id="model")
+    assert cache.encode(["a", "bb", "dddd"])[:, 0].tolist() == [1, 2, 4]
+    assert model.encoded == []
+
+def test_keys_without_a_full_vector_are_dropped(tmp_path):
+    EmbeddingCache(FakeModel(), store_dir=str(tmp_path), model_id="model").encode(["a", "bb"])
+    # A torn write of the last vector, and a key cut off mid-line
+    with open(tmp_path / "embeddings.f32", "r+b") as f:
+        f.truncate(3 * 4 + 5)
+    with open(tmp_path / "index.txt", "a") as f:
+        f.write("0123")
+
+    model = FakeModel()
+    cache = EmbeddingCache(model, store_dir=str(tmp_path), model_id="model")
+    assert cache.stats()["disk_entries"] == 1
+    assert cache.encode(["a", "bb"])[:, 0].tolist() == [1, 2]
+    assert model.encoded == ["bb"]
+    assert (tmp_path / "index.txt").read_text().count("\n") == 2
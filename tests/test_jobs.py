@@ -0,0 +1,45 @@
+import threading
+
+import pytest
+
+from app.jobs import JobQueue, QueueFullError
+
+def test_jobs_run_on_the_workers_with_their_arguments():
+    queue = JobQueue(workers=2)
+    done = threading.Event()
+    ran = []
+    def job(task_id, claim):
+        ran.append((task_id, claim, threading.current_thread().name))
+        done.set()
+    queue.submit("task", job, "claim")
+    assert done.wait(5)
+    assert ran[0][:2] == ("task", "claim")
+    assert ran[0][2].startswith("job-worker-")
+
+def test_full_queue_rejects_jobs():
+    queue = JobQueue(workers=1, max_queue_size=2)
+    release = threading.Event()
+    started = threading.Event()
+    def blocking(task_id):
+        started.set()
+        release.wait(5)
+    queue.submit("running", blocking)
+    assert started.wait(5)
+
+    assert queue.submit("first", blocking) == 1
+    assert queue.submit("second", blocking) == 2
+    with pytest.raises(QueueFullError, match="2 jobs waiting"):
+        queue.submit("third", blocking)
+    assert [queue.position(task_id) for task_id in ("running", "first", "second", "third")] == [0, 1, 2, 0]
+    assert queue.stats() == {"workers": 1, "running": 1, "queued": 2, "max_queue_size": 2}
+    release.set()
+
+def test_a_failing_job_leaves_the_worker_running():
+    queue = JobQueue(workers=1)
+    done = threading.Event()
+    def failing(task_id):
+        raise ValueError("boom")
+    queue.submit("failing", failing)
+    queue.submit("next", lambda task_id: done.set())
+    assert done.wait(5)
+    assert queue.workers[0].is_alive()
@@ -0,0 +1,41 @@
+from app.metrics import Metrics
+
+def worker_summary():
+    # What a worker process publishes for one claim
+    worker = Metrics()
+    worker.record_stage("task", "retrieve_evidence", 0.3)
+    worker.record_stage("task", "retrieve_evidence/retrieve_documents", 0.2)
+    worker.count("task", "docs_returned", 4)
+    worker.critical_path("task", {"es_search": 0.1})
+    return worker.summary("task")
+
+def test_merge_adds_a_worker_summary_to_the_task_and_totals():
+    metrics = Metrics()
+    metrics.record_stage("task", "verdict", 1.5)
+    metrics.merge("task", worker_summary())
+    summary = metrics.summary("task")
+    assert summary["stages"] == {"verdict": 1.5, "retrieve_evidence": 0.3, "retrieve_evidence/retrieve_documents": 0.2}
+    assert summary["counters"] == {"docs_returned": 4}
+    assert summary["critical_path"] == {"es_search": 0.1}
+    assert metrics.tasks_recorded == 1
+
+def test_prometheus_text_after_merge():
+    metrics = Metrics()
+    metrics.merge("task", worker_summary())
+    metrics.merge("other", worker_summary())
+    lines = metrics.prometheus({"jobs_running": 1}).splitlines()
+
+    assert "# TYPE esoteric_stage_seconds histogram" in lines
+    assert 'esoteric_stage_seconds_bucket{stage="retrieve_evidence",le="0.25"} 0' in lines
+    assert 'esoteric_stage_seconds_bucket{stage="retrieve_evidence",le="0.5"} 2' in lines
+    assert 'esoteric_stage_seconds_bucket{stage="retrieve_evidence",le="+Inf"} 2' in lines
+    assert 'esoteric_stage_seconds_sum{stage="retrieve_evidence"} 0.6' in lines
+    assert 'esoteric_stage_seconds_count{stage="retrieve_evidence/retrieve_documents"} 2' in lines
+    assert 'esoteric_events_total{name="docs_returned"} 8' in lines
+    assert "esoteric_tasks_total 2" in lines
+    assert lines[-2:] == ["# TYPE esoteric_jobs_running gauge", "esoteric_jobs_running 1"]
+
+def test_labels_are_escaped():
+    metrics = Metrics()
+    metrics.count("task", 'say "hi"\n')
+    assert 'esoteric_events_total{name="say \\"hi\\"\\n"} 1' in metrics.prometheus().splitlines()
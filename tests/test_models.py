@@ -0,0 +1,99 @@
+import random
+
+from app.models import Evidence, EvidenceWrapper, Sentence, convert_brc
+
+# The previous models kept plain lists, re-sorting after every insert and scanning for lookups
+# These reference versions of that behaviour are checked against the indexed models on random inputs
+
+def scan_by_id(evidences, id):
+    for evidence in evidences:
+        if evidence.id == id:
+            return evidence
+    return None
+
+def reference_seperate_sort(evidences):
+    with_sentences = [evidence for evidence in evidences if evidence.sentences]
+    without_sentences = [evidence for evidence in evidences if not evidence.sentences]
+    with_sentences.sort(key=lambda x: max(sentence.score for sentence in x.sentences), reverse=True)
+    without_sentences.sort(key=lambda x: x.doc_score, reverse=True)
+    return with_sentences + without_sentences
+
+def reference_merge(sentences, text):
+    merged = []
+    for sentence in sorted(sentences, key=lambda x: x.start):
+        if merged and sentence.start <= merged[-1][3]:
+            _, score, start, end = merged[-1]
+            start, end = min(start, sentence.start), max(end, sentence.end)
+            merged[-1] = (text[start:end], max(score, sentence.score), start, end)
+        else:
+            merged.append((sentence.sentence, sentence.score, sentence.start, sentence.end))
+    return merged
+
+def random_sentence(rng, text):
+    start = rng.randrange(len(text) - 5)
+    end = start + rng.randrange(1, 6)
+    # Scores from a small set so ties are common
+    return Sentence(sentence=text[start:end], score=rng.choice([0.1, 0.5, 0.5, 0.9]), start=start, end=end)
+
+def test_add_sentence_matches_append_and_stable_sort():
+    rng = random.Random(0)
+    text = "abcdefghijklmnopqrstuvwxyz" * 4
+    for _ in range(50):
+        evidence = Evidence(query="q", evidence_text=text)
+        expected = []
+        for _ in range(rng.randrange(1, 20)):
+            sentence = random_sentence(rng, text)
+            evidence.add_sentence(sentence)
+            expected.append(sentence)
+            expected.sort(key=lambda x: x.score, reverse=True)
+            assert evidence.sentences == expected
+        # Replacing the list and adding again goes back to the same order
+        evidence.sentences = list(reversed(expected))
+        sentence = random_sentence(rng, text)
+        evidence.add_sentence(sentence)
+        expected = sorted(list(reversed(expected)) + [sentence], key=lambda x: x.score, reverse=True)
+        assert evidence.sentences == expected
+
+def test_lookup_by_id_matches_scan():
+    rng = random.Random(1)
+    for _ in range(50):
+        wrapper = EvidenceWrapper("q")
+        # Repeated ids, as the same doc can come from title and text matching
+        for _ in range(rng.randrange(1, 15)):
+            wrapper.add_evidence(Evidence(query="q", evidence_text="text", id=str(rng.randrange(6)), doc_score=rng.random()))
+        for step in range(5):
+            action = rng.choice(["remove", "sort_by_doc_score", "seperate_sort"])
+            if action == "remove" and wrapper.get_evidences():
+                wrapper.remove_evidence(rng.choice(wrapper.get_evidences()))
+            elif action != "remove":
+                getattr(wrapper, action)()
+            for id in map(str, range(7)):
+                assert wrapper.get_evidence_by_id(id) is scan_by_id(wrapper.get_evidences(), id)
+
+def test_seperate_sort_matches_previous_order():
+    rng = random.Random(2)
+    text = "abcdefghijklmnopqrstuvwxyz" * 4
+    for _ in range(50):
+        wrapper = EvidenceWrapper("q")
+        for i in range(rng.randrange(1, 10)):
+            evidence = Evidence(query="q", evidence_text=text, id=str(i), doc_score=rng.choice([0.2, 0.4, 0.6]))
+            for _ in range(rng.randrange(3)):
+                evidence.add_sentence(random_sentence(rng, text))
+            wrapper.add_evidence(evidence)
+        expected = reference_seperate_sort(wrapper.get_evidences())
+        wrapper.seperate_sort()
+        assert wrapper.get_evidences() == expected
+
+def test_merge_overlapping_sentences_matches_previous_merge():
+    rng = random.Random(3)
+    text = "abcdefghijklmnopqrstuvwxyz" * 4
+    for _ in range(50):
+        evidence = Evidence(query="q", evidence_text=text)
+        for _ in range(rng.randrange(1, 10)):
+            evidence.add_sentence(random_sentence(rng, text))
+        expected = reference_merge(evidence.sentences, text)
+        evidence.merge_overlapping_sentences()
+        assert [(sentence.sentence, sentence.score, sentence.start, sentence.end) for sentence in evidence.sentences] == expected
+
+def test_convert_brc():
+    assert convert_brc("Paris_-LRB-city-RRB--COLON-_France") == "Paris_(city):_France"
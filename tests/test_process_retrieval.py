@@ -0,0 +1,57 @@
+import sys
+import threading
+
+from app.progress import ProgressStore
+from app.metrics import Metrics
+
+# The retriever reads the server process's shared progress store and metrics from the app package
+sys.modules["app"].progress_store = ProgressStore()
+sys.modules["app"].metrics = Metrics()
+
+from app.ESOTERIC import process_retrieval
+from app.ESOTERIC.process_retrieval import ProcessEvidenceRetriever
+
+def make_retriever(store):
+    # A retriever without worker processes, events are handed to it directly
+    process_retrieval.progress_store = store
+    retriever = ProcessEvidenceRetriever.__new__(ProcessEvidenceRetriever)
+    retriever.pending = {}
+    retriever.abandoned = {}
+    retriever.lock = threading.Lock()
+    return retriever
+
+def test_progress_is_applied_to_a_running_task():
+    store = ProgressStore()
+    store["task"] = {"status": "queued", "log": []}
+    retriever = make_retriever(store)
+    retriever.handle("progress", "task", ("log", "Starting"))
+    retriever.handle("progress", "task", ("step", {"status": "in progress", "step": "start"}))
+    retriever.handle("progress", "task", ("question", {"question": "Who?", "answer": "Paris"}))
+    retriever.handle("progress", "task", ("question", {"question": "Where?", "answer": "France"}))
+    retriever.handle("progress", "task", ("metrics", {"stages": {}, "counters": {}, "memory": {}, "critical_path": {}}))
+    entry = store["task"]
+    assert (entry["status"], entry["step"], entry["log"]) == ("in progress", "start", ["Starting"])
+    assert [question["question"] for question in entry["questions"]] == ["Who?", "Where?"]
+    assert "metrics" not in entry
+    assert [event for _, event, _ in store.events["task"]] == ["step", "question", "question", "metrics"]
+
+def test_progress_never_reopens_a_finished_or_dropped_task():
+    store = ProgressStore()
+    store["task"] = {"status": "in progress"}
+    store.finish("task", "failed", "Evidence retrieval timed out")
+    retriever = make_retriever(store)
+    retriever.handle("progress", "task", ("step", {"status": "in progress", "step": "retrieve_docs"}))
+    retriever.handle("progress", "gone", ("step", {"status": "in progress", "step": "start"}))
+    assert store["task"]["status"] == "failed"
+    assert "gone" not in store
+
+def test_progress_of_abandoned_jobs_is_dropped_until_they_report_back():
+    store = ProgressStore()
+    store["task"] = {"status": "in progress"}
+    retriever = make_retriever(store)
+    retriever.abandoned["job"] = "task"
+    retriever.handle("progress", "task", ("step", {"status": "in progress", "step": "late"}))
+    assert "step" not in store["task"]
+
+    retriever.handle("result", "job", None)
+    assert retriever.abandoned == {}
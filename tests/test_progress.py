@@ -0,0 +1,76 @@
+import time
+
+from app.progress import ProgressStore
+
+def test_size_eviction_keeps_running_tasks():
+    store = ProgressStore(max_entries=2)
+    store["queued"] = {"status": "queued"}
+    store["running"] = {"status": "in progress"}
+    store["done"] = {"status": "completed"}
+    store["other"] = {"status": "completed"}
+    assert set(store.entries) == {"queued", "running"}
+    assert store.evicted == 2
+
+def test_size_eviction_prefers_finished_tasks():
+    store = ProgressStore(max_entries=2)
+    store["unknown"] = {}
+    store["done"] = {"status": "failed"}
+    store["running"] = {"status": "in progress"}
+    assert set(store.entries) == {"unknown", "running"}
+
+def test_ttl_expiry_keeps_running_tasks():
+    store = ProgressStore(ttl=0.01)
+    store["queued"] = {"status": "queued"}
+    store["running"] = {"status": "in progress"}
+    store["done"] = {"status": "completed"}
+    time.sleep(0.02)
+    store.prune()
+    assert set(store.entries) == {"queued", "running"}
+    assert store.expired == 1
+
+    store["running"]["status"] = "completed"
+    time.sleep(0.02)
+    store.prune()
+    assert set(store.entries) == {"queued"}
+
+def test_events_since_replays_kept_events():
+    store = ProgressStore(max_log_entries=3)
+    store["task"] = {"status": "in progress", "log": []}
+    for i in range(3):
+        store.publish("task", "step", {"step": i})
+    assert [data["step"] for _, _, data in store.events_since("task", 1)] == [1, 2]
+
+def test_events_since_sends_snapshot_once_events_are_trimmed():
+    store = ProgressStore(max_log_entries=3)
+    store["task"] = {"status": "in progress", "step": None, "log": ["started"]}
+    for i in range(5):
+        store["task"]["step"] = i
+        store.publish("task", "step", {"step": i})
+
+    # Sequences 1 and 2 were trimmed, a stream that has seen 2 can still catch up from the kept events
+    assert [data["step"] for _, _, data in store.events_since("task", 2)] == [2, 3, 4]
+    (sequence, event, data), = store.events_since("task", 1)
+    assert (sequence, event) == (5, "snapshot")
+    assert data == {"status": "in progress", "step": 4}
+    assert "log" in store["task"]
+
+    store.pop("task")
+    assert store.dropped == {}
+
+def test_snapshot_is_a_deep_copy():
+    store = ProgressStore()
+    store["task"] = {"status": "in progress", "log": ["started"], "entities": ["Paris"], "entity_colors": {"Paris": "#000000"}}
+    _, snapshot = store.snapshot("task", exclude=("log",))
+    store["task"]["entities"].append("France")
+    store["task"]["entity_colors"]["France"] = "#FFFFFF"
+    assert snapshot == {"status": "in progress", "entities": ["Paris"], "entity_colors": {"Paris": "#000000"}}
+
+def test_log_lines_reach_listeners():
+    store = ProgressStore()
+    forwarded = []
+    store.listeners.append(lambda task_id, event, data: forwarded.append((task_id, event, data)))
+    store["task"] = {"status": "in progress", "log": []}
+    store.append_log("task", "Starting")
+    store.publish("task", "step", {"step": "start"})
+    assert forwarded == [("task", "log", "Starting"), ("task", "step", {"step": "start"})]
+    assert [event for _, event, _ in store.events["task"]] == ["step"]
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+from app.ESOTERIC.tools.reader import read_answers
+
+class FakeReader:
+    # Follows FARMReader.predict_batch: a list of document lists pairs the nth question with the nth list,
+    # a flat list answers every question against every document separately
+    def __init__(self):
+        self.calls = []
+
+    def answer(self, question, documents, top_k):
+        answers = [SimpleNamespace(context=question + " in " + document, document_ids=[document], score=len(document)) for document in documents]
+        return sorted(answers, key=lambda answer: answer.score, reverse=True)[:top_k]
+
+    def predict_batch(self, queries, documents, top_k):
+        self.calls.append((queries, documents, top_k))
+        if isinstance(documents[0], list):
+            assert len(documents) == len(queries)
+            return {"answers": [self.answer(query, query_documents, top_k) for query, query_documents in zip(queries, documents)]}
+        per_document = [[self.answer(query, [document], top_k) for document in documents] for query in queries]
+        return {"answers": per_document[0] if len(queries) == 1 else per_document}
+
+DOCUMENTS = ["a", "bbb", "cc"]
+
+def test_single_question_gets_answers_from_every_document():
+    reader = FakeReader()
+    answers = read_answers(reader, ["q1"], DOCUMENTS, top_k=30)
+    assert [(question, answer.document_ids[0]) for question, answer in answers] == [("q1", "bbb"), ("q1", "cc"), ("q1", "a")]
+    assert len(reader.calls) == 1
+
+def test_several_questions_get_one_combined_answer_list_each():
+    reader = FakeReader()
+    answers = read_answers(reader, ["q1", "q2", "q3"], DOCUMENTS, top_k=30)
+    assert len(answers) == 9
+    for question in ("q1", "q2", "q3"):
+        assert [answer.document_ids[0] for asked, answer in answers if asked == question] == ["bbb", "cc", "a"]
+    assert len(reader.calls) == 1
+
+def test_top_k_applies_across_documents():
+    answers = read_answers(FakeReader(), ["q1", "q2"], DOCUMENTS, top_k=2)
+    assert [(question, answer.document_ids[0]) for question, answer in answers] == [("q1", "bbb"), ("q1", "cc"), ("q2", "bbb"), ("q2", "cc")]
+
+def test_answers_without_context_are_skipped():
+    class EmptyContextReader(FakeReader):
+        def answer(self, question, documents, top_k):
+            return [SimpleNamespace(context=None, document_ids=[document], score=1) for document in documents]
+    assert read_answers(EmptyContextReader(), ["q1", "q2"], DOCUMENTS) == []
+
+def test_no_questions_skips_the_reader():
+    reader = FakeReader()
+    assert read_answers(reader, [], DOCUMENTS) == []
+    assert reader.calls == []
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("flask_wtf")
+pytest.importorskip("requests")
+
+from flask import Flask
+
+from app.progress import ProgressStore
+from app.metrics import Metrics
+from app.jobs import JobQueue
+from app.claim_cache import ClaimCache
+from app.verdict import VerdictClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FakeRetriever:
+    def readiness(self):
+        return {"ready": True, "error": None, "load_seconds": 2.5}
+
+class FakeBackend:
+    model = "fake"
+
+    def complete(self, messages, on_token=None):
+        return "Not enough evidence."
+
+# The routes import their shared objects from the app package, which is given small ones here instead of loading the models
+# The job queue has no workers, so submitted claims stay queued
+app = sys.modules["app"]
+app.app = Flask("app", root_path=os.path.join(ROOT, "app"))
+app.app.config.update(SECRET_KEY="test", WTF_CSRF_ENABLED=False)
+app.evidence_retriever = FakeRetriever()
+app.progress_store = ProgressStore()
+app.job_queue = JobQueue(workers=0, max_queue_size=1)
+app.claim_cache = ClaimCache(config={})
+app.verdict_client = VerdictClient(FakeBackend())
+app.metrics = Metrics()
+app.metrics_in_progress = False
+app.startup = {"started": 0, "app_created_seconds": 1.0, "first_request_seconds": None}
+
+from app import routes
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+def test_metrics_include_a_merged_worker_summary(client):
+    worker = Metrics()
+    worker.record_stage("task", "retrieve_evidence", 0.3)
+    worker.count("task", "docs_returned", 4)
+    app.metrics.merge("task", worker.summary("task"))
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    lines = response.get_data(as_text=True).splitlines()
+    assert 'esoteric_stage_seconds_count{stage="retrieve_evidence"} 1' in lines
+    assert 'esoteric_events_total{name="docs_returned"} 4' in lines
+    assert "esoteric_models_ready 1" in lines
+    assert "esoteric_startup_models_loaded_seconds 2.5" in lines
+    assert "esoteric_jobs_queued 0" in lines
+
+def test_claims_are_rejected_once_the_queue_is_full(client):
+    try:
+        with client.session_transaction() as session:
+            session["claim"] = "Paris is in France."
+        assert client.get("/demo").status_code == 200
+        with client.session_transaction() as session:
+            queued_task = session["task_id"]
+
+        response = client.get("/demo")
+        assert response.status_code == 200
+        with client.session_transaction() as session:
+            rejected_task = session["task_id"]
+
+        assert client.get("/progress/" + queued_task).get_json()["queue_position"] == 1
+        rejected = client.get("/progress/" + rejected_task).get_json()
+        assert rejected["status"] == "rejected"
+        assert rejected["error"] == "Job queue is full (1 jobs waiting)"
+    finally:
+        with app.job_queue.condition:
+            app.job_queue.pending.clear()
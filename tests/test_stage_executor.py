@@ -0,0 +1,59 @@
+import time
+import pytest
+
+from app.metrics import Metrics
+from app.ESOTERIC.tools.stage_executor import Stage, StageExecutor
+
+def stages(log):
+    def stage(name, seconds=0):
+        def run(*inputs):
+            time.sleep(seconds)
+            log.append(name)
+            return name + "(" + ",".join(inputs) + ")"
+        return run
+    return [
+        Stage("a", stage("a")),
+        Stage("b", stage("b", 0.05), ["a"]),
+        Stage("c", stage("c", 0.01), ["a"]),
+        Stage("d", stage("d"), ["b", "c"])
+    ]
+
+# Run serially c waits for b, so the critical path goes through whichever finished last
+@pytest.mark.parametrize("max_workers, path", [(1, ["a", "c", "d"]), (3, ["a", "b", "d"])])
+def test_results_are_passed_to_dependent_stages(max_workers, path):
+    log = []
+    metrics = Metrics()
+    results, critical_path = StageExecutor(metrics, max_workers).run(stages(log), "task")
+    assert results["d"] == "d(b(a()),c(a()))"
+    assert log[0] == "a" and log[-1] == "d"
+    assert list(critical_path) == path
+    assert set(metrics.summary("task")["stages"]) == {"a", "b", "c", "d"}
+
+def test_serial_run_keeps_list_order_among_ready_stages():
+    log = []
+    StageExecutor(Metrics(), 1).run(stages(log))
+    assert log == ["a", "b", "c", "d"]
+
+def test_stages_nest_under_the_callers_stage():
+    metrics = Metrics()
+    with metrics.stage("task", "retrieve"):
+        StageExecutor(metrics, 2).run(stages([]), "task")
+    assert "retrieve/b" in metrics.summary("task")["stages"]
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_missing_dependency_names_the_stage(max_workers):
+    with pytest.raises(ValueError, match="'b' depends on stages that don't exist: x"):
+        StageExecutor(Metrics(), max_workers).run([Stage("a", lambda: 1), Stage("b", lambda a, x: 2, ["a", "x"])])
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_cycle_names_the_stages(max_workers):
+    ran = []
+    with pytest.raises(ValueError, match="'b', 'c' can't run"):
+        StageExecutor(Metrics(), max_workers).run([Stage("a", lambda: ran.append("a")), Stage("b", lambda c: 1, ["c"]), Stage("c", lambda b: 2, ["b"])])
+    assert ran == []
+
+def test_stage_errors_are_raised():
+    def fail(a):
+        raise RuntimeError("stage failed")
+    with pytest.raises(RuntimeError, match="stage failed"):
+        StageExecutor(Metrics(), 2).run([Stage("a", lambda: 1), Stage("b", fail, ["a"])])
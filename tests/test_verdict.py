@@ -0,0 +1,77 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+
+from benchmarks.stub_llm import start_stub_llm
+from app.verdict import ChatCompletionsBackend, VerdictClient, VerdictError, verdict_prompt
+
+VERDICT = "The claim is supported."
+
+def make_backend(url, **kwargs):
+    return ChatCompletionsBackend(url, api_key="key", model="stub-model", **dict(dict(connect_timeout=1, read_timeout=2, retries=0, backoff=0), **kwargs))
+
+def test_prompt_lists_the_claim_and_each_evidence_sentence():
+    prompt = verdict_prompt("Paris is in France.", ["Paris is the capital of France.", "France is in Europe."])
+    assert prompt.endswith("\n\nClaim: Paris is in France.\n\nEvidence:\nParis is the capital of France.\nFrance is in Europe.")
+
+def test_response_is_parsed_without_streaming():
+    server, url = start_stub_llm(verdict=VERDICT)
+    try:
+        backend = make_backend(url, streaming=False)
+        assert backend.complete([{"role": "system", "content": "prompt"}], on_token=lambda token: None) == VERDICT
+        assert server.last_request == {"model": "stub-model", "messages": [{"role": "system", "content": "prompt"}], "stream": False}
+    finally:
+        server.shutdown()
+
+def test_streamed_tokens_are_passed_on_and_joined():
+    server, url = start_stub_llm(verdict=VERDICT)
+    try:
+        tokens = []
+        assert make_backend(url).complete([{"role": "system", "content": "prompt"}], tokens.append) == VERDICT
+        assert tokens == ["The ", "claim ", "is ", "supported."]
+        assert server.last_request["stream"] is True
+    finally:
+        server.shutdown()
+
+def test_failed_requests_are_retried():
+    server, url = start_stub_llm(verdict=VERDICT, fail_first=1)
+    try:
+        backend = make_backend(url, retries=1)
+        assert backend.complete([{"role": "system", "content": "prompt"}]) == VERDICT
+        assert backend.stats() == {"requests": 2, "retries": 1, "failures": 0}
+    finally:
+        server.shutdown()
+
+def test_error_status_raises_after_retries():
+    server, url = start_stub_llm(fail_first=10)
+    try:
+        backend = make_backend(url, retries=1)
+        with pytest.raises(VerdictError) as error:
+            backend.complete([{"role": "system", "content": "prompt"}])
+        assert error.value.status == 503
+        assert backend.stats() == {"requests": 2, "retries": 1, "failures": 1}
+    finally:
+        server.shutdown()
+
+def test_read_timeout_raises():
+    server, url = start_stub_llm(latency_ms=500)
+    try:
+        backend = make_backend(url, read_timeout=0.1)
+        with pytest.raises(VerdictError, match="Verdict request failed") as error:
+            backend.complete([{"role": "system", "content": "prompt"}])
+        assert error.value.status is None
+    finally:
+        server.shutdown()
+
+def test_client_caches_verdicts_per_prompt():
+    server, url = start_stub_llm(verdict=VERDICT)
+    try:
+        client = VerdictClient(make_backend(url))
+        assert client.verdict("prompt") == VERDICT
+        tokens = []
+        assert client.verdict("prompt", tokens.append) == VERDICT
+        assert tokens == [VERDICT]
+        assert server.requests == 1
+        assert client.stats()["cache_hits"] == 1
+    finally:
+        server.shutdown()